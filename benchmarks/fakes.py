@@ -0,0 +1,203 @@
+import hashlib
+import threading
+import time
+import numpy as np
+
+
+def text_seed(text):
+    """Returns a stable integer seed for the text."""
+    return int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+
+
+class FakeEmbedding:
+    def __init__(self, values):
+        self.values = values
+
+
+class FakeEmbeddingModel:
+    """Deterministic stand-in for the Vertex AI TextEmbeddingModel.
+
+    Every text gets a unit-length vector seeded by its hash, so equal texts get
+    equal vectors on every run. latency_ms simulates the round trip of a request.
+    """
+
+    def __init__(self, dimensions=768, latency_ms=0.0):
+        self.dimensions = dimensions
+        self.latency_ms = latency_ms
+        self.requests = 0
+
+    def get_embeddings(self, texts):
+        self.requests += 1
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        embeddings = []
+        for text in texts:
+            vector = np.random.default_rng(text_seed(text)).standard_normal(self.dimensions)
+            embeddings.append(FakeEmbedding((vector / np.linalg.norm(vector)).tolist()))
+        return embeddings
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGenerativeModel:
+    """Deterministic stand-in for the Gemini GenerativeModel.
+
+    Image descriptions and answers are derived from the hash of the prompt, and
+    end with a summary line so the combined description prompt can be split.
+    Images are passed as plain strings built by image_part, so no Vertex AI types are needed.
+    """
+
+    def __init__(self, latency_ms=0.0, words=120):
+        self.latency_ms = latency_ms
+        self.words = words
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def image_part(self, uri, mime_type):
+        return f"[{mime_type} {uri}]"
+
+    def _text(self, prompt):
+        seed = text_seed(repr(prompt))
+        rng = np.random.default_rng(seed)
+        words = " ".join(f"word{value}" for value in rng.integers(0, 5000, size=self.words))
+        return f"Headline {seed % 1000}\n{words}\nSUMMARY: Summary of content {seed % 1000}."
+
+    def generate_content(self, prompt, generation_config=None, stream=False):
+        with self._lock:
+            self.requests += 1
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        text = self._text(prompt)
+        if stream:
+            return iter([FakeResponse(part + " ") for part in text.split(" ")])
+        return FakeResponse(text)
+
+
+class InMemoryGraph:
+    """In-memory stand-in for the Chunk functions of src/graphdb.py that ingestion and retrieval use.
+
+    The graph is passed as the store of ingest_file and retrieve_context, and as their
+    driver, so the methods take the same arguments as the functions of the same name.
+    Synthetic chunks added with add_synthetic_chunks only exist for retrieval: get_chunks
+    generates their text, and fetch_embeddings returns their vectors for rescoring.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.chunks = {}
+        self.synthetic = {}
+        self.image_of = {}
+        self.next_links = 0
+        self.writes = 0
+
+    def _chunk(self, folder, name, element):
+        key = (folder, name, element)
+        if key not in self.chunks:
+            self.chunks[key] = {"name": name, "folder": folder, "element": element, "status": "new", "in_query": True}
+        return self.chunks[key]
+
+    def get_chunk_states(self, driver, folder_name, chunk_names=None):
+        with self._lock:
+            return {(chunk["name"], chunk["element"]): {
+                        "name": chunk["name"], "element": chunk["element"], "status": chunk.get("status"),
+                        "text": chunk.get("text"), "text_short": chunk.get("text_short"),
+                        "content_hash": chunk.get("content_hash"),
+                        "blob": chunk.get("blob") or f"{chunk['folder']}/{chunk['name']}"}
+                    for (folder, name, element), chunk in self.chunks.items()
+                    if folder == folder_name and (chunk_names is None or name in chunk_names)}
+
+    def set_chunk_status(self, driver, folder_name, chunk_name, status):
+        with self._lock:
+            for (folder, name, element), chunk in self.chunks.items():
+                if folder == folder_name and name == chunk_name:
+                    chunk["status"] = status
+
+    def create_and_return_chunk(self, driver, chunk_name, folder_name, status="new", element=0, content_hash=None, blob=None):
+        with self._lock:
+            if (folder_name, chunk_name, element) not in self.chunks:
+                self._chunk(folder_name, chunk_name, element).update(status=status, content_hash=content_hash, blob=blob)
+            return chunk_name
+
+    def write_chunks(self, driver, chunks, batch_size=None):
+        with self._lock:
+            self.writes += 1
+            for chunk in chunks:
+                stored = self._chunk(chunk["folder"], chunk["name"], chunk["element"])
+                # Missing properties keep their stored value, as in write_chunks
+                for key in ("status", "chunk_type", "text", "embedding_string", "text_short", "content_hash", "blob"):
+                    if chunk.get(key) is not None:
+                        stored[key] = chunk[key]
+                if chunk.get("parent_chunk"):
+                    self.image_of[(chunk["folder"], chunk["name"])] = chunk["parent_chunk"]
+
+    def find_chunks_by_hash(self, driver, content_hashes):
+        content_hashes = set(content_hashes)
+        found = {}
+        with self._lock:
+            for chunk in self.chunks.values():
+                content = chunk.get("content_hash")
+                if content in content_hashes and (content not in found or (chunk.get("embedding_string") and not found[content]["embedding"])):
+                    found[content] = {"content_hash": content, "text": chunk.get("text"), "text_short": chunk.get("text_short"),
+                                      "embedding": chunk.get("embedding_string"),
+                                      "blob": chunk.get("blob") or f"{chunk['folder']}/{chunk['name']}"}
+        return found
+
+    def find_document_by_hash(self, driver, content_hash, folder_name, chunk_name):
+        with self._lock:
+            for (folder, name, element), chunk in self.chunks.items():
+                if (element == 0 and chunk.get("content_hash") == content_hash and chunk.get("status") == "linked"
+                        and (folder, name) != (folder_name, chunk_name)):
+                    return folder, name
+        return None
+
+    def copy_document_chunks(self, driver, source_folder, source_name, folder_name, chunk_name):
+        with self._lock:
+            pages = [dict(chunk) for (folder, name, element), chunk in self.chunks.items()
+                     if folder == source_folder and name == source_name and element >= 0]
+            for page in pages:
+                copy = self._chunk(folder_name, chunk_name, page["element"])
+                copy.update({key: page.get(key) for key in ("text", "embedding_string", "chunk_type")}, status="embedded")
+            images = [dict(self.chunks[(folder, name, -1)]) for (folder, name), parent in list(self.image_of.items())
+                      if folder == source_folder and parent == source_name]
+            for image in images:
+                copy = self._chunk(folder_name, image["name"], -1)
+                copy.update({key: image.get(key) for key in ("text", "text_short", "embedding_string", "chunk_type", "content_hash")},
+                            blob=image.get("blob") or f"{source_folder}/{image['name']}", status="linked")
+                self.image_of[(folder_name, image["name"])] = chunk_name
+            return len(pages) + len(images)
+
+    def create_consecutive_relationships(self, driver, folder_name, chunk_name, from_element=None):
+        with self._lock:
+            pages = sum(1 for (folder, name, element) in self.chunks if folder == folder_name and name == chunk_name and element >= 0)
+            self.next_links += max(pages - 1, 0)
+
+    def get_image_text_short_by_chunk_name(self, driver, name, element=-1):
+        with self._lock:
+            return "\n".join(chunk.get("text_short") or "" for (folder, chunk_name, chunk_element), chunk in self.chunks.items()
+                             if chunk_name == name and chunk_element == element)
+
+    def add_synthetic_chunks(self, keys, chunk_types, vectors=None):
+        """Adds (folder, name, element) chunks with their chunk types and, to rescore quantized searches, their vectors."""
+        for row, (key, chunk_type) in enumerate(zip(keys, chunk_types)):
+            self.synthetic[key] = (chunk_type, None if vectors is None else vectors[row])
+
+    def get_chunks(self, driver, chunks):
+        found = {}
+        with self._lock:
+            for chunk in chunks:
+                key = (chunk["folder"], chunk["name"], chunk["element"])
+                if key in self.chunks:
+                    stored = self.chunks[key]
+                    found[key] = {"text": stored.get("text"), "folder": key[0], "chunk_type": stored.get("chunk_type"),
+                                  "blob": stored.get("blob") or f"{key[0]}/{key[1]}"}
+                elif key in self.synthetic:
+                    found[key] = {"text": f"Text of {key[1]} element {key[2]}", "folder": key[0],
+                                  "chunk_type": self.synthetic[key][0], "blob": f"{key[0]}/{key[1]}"}
+        return found
+
+    def fetch_embeddings(self, keys):
+        """Returns the stored vectors of the keys, for the fetch_embeddings of EmbeddingIndex."""
+        return {key: self.synthetic[key][1] for key in keys if key in self.synthetic and self.synthetic[key][1] is not None}
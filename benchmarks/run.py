@@ -0,0 +1,279 @@
+"""Offline benchmarks of ingestion throughput and retrieval latency.
+
+Vertex AI, Neo4j and GCS are replaced by the local stand-ins in benchmarks/fakes.py
+and a temporary directory, so the benchmarks need no credentials or network:
+
+    python -m benchmarks.run
+    python -m benchmarks.run --sizes 1000,100000 --output results.json
+    python -m benchmarks.run --baseline results.json
+
+With --baseline the run fails if a throughput or latency is more than --tolerance
+worse than in the baseline results.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+WORK_DIR = tempfile.mkdtemp(prefix="rag-benchmark-")
+
+# Point every service and cache at the temporary directory before keys.py is imported
+os.environ.update({
+    "RETRIEVAL_BACKEND": "memory",
+    "GCP_BUCKET": "benchmark",
+    "GCS_LOCAL_ROOT": os.path.join(WORK_DIR, "gcs"),
+    "EMBEDDING_CACHE_PATH": os.path.join(WORK_DIR, "embeddings.sqlite"),
+    "IMAGE_CACHE_DIR": os.path.join(WORK_DIR, "thumbnails"),
+    "ANN_INDEX_DIR": os.path.join(WORK_DIR, "ann"),
+    "JOB_QUEUE_PATH": os.path.join(WORK_DIR, "jobs.sqlite"),
+    "JOB_SPOOL_DIR": os.path.join(WORK_DIR, "spool"),
+})
+
+import fitz
+import numpy as np
+from benchmarks.fakes import FakeEmbeddingModel, FakeGenerativeModel, InMemoryGraph
+from src import ingestion, resources, utils
+from src.ann import IvfIndex
+from src.documents import content_hash
+from src.gcputils import upload_file_to_folder
+from src.index import EmbeddingIndex
+import keys
+
+GCP_BUCKET = keys.GCP_BUCKET
+
+GENERATION_CONFIG = {"max_output_tokens": 2048, "temperature": 0.1, "top_p": 1.0, "top_k": 32}
+# Chunks per synthetic document and documents per synthetic folder
+PAGES_PER_DOCUMENT = 20
+DOCUMENTS_PER_FOLDER = 1000
+# Every tenth synthetic chunk is an image
+IMAGE_EVERY = 10
+# Spread of the synthetic vectors around their cluster centre, about 0.67 cosine within a cluster
+CLUSTER_SPREAD = 0.7
+
+
+def random_image(rng, size=32):
+    """Returns a PNG of random pixels, so every image has distinct content."""
+    samples = rng.integers(0, 256, size=size * size * 3, dtype=np.uint8).tobytes()
+    return fitz.Pixmap(fitz.csRGB, size, size, samples, False).tobytes("png")
+
+
+def make_pdf(index, pages, images_per_page, rng):
+    """Builds a PDF with a page of text and images_per_page distinct images on every page."""
+    document = fitz.open()
+    for page_number in range(pages):
+        page = document.new_page()
+        words = " ".join(f"term{value}" for value in rng.integers(0, 5000, size=300))
+        page.insert_text((72, 72), f"Document {index}, page {page_number + 1}", fontsize=14)
+        page.insert_textbox(fitz.Rect(72, 100, 540, 560), words, fontsize=9)
+        for image_index in range(images_per_page):
+            left = 72 + 100 * image_index
+            page.insert_image(fitz.Rect(left, 600, left + 64, 664), stream=random_image(rng))
+    data = document.tobytes()
+    document.close()
+    return data
+
+
+def benchmark_ingestion(documents_count=10, pages=10, images_per_page=1, image_files=20, latency_ms=0.0, seed=0):
+    """Ingests synthetic PDFs and images with the fake models and graph.
+    Returns:
+        dict: Pages and images ingested per second.
+    """
+    graph = InMemoryGraph()
+    model = FakeGenerativeModel(latency_ms=latency_ms)
+    embedding_model = FakeEmbeddingModel(latency_ms=latency_ms)
+    resources.set_embedding_model(embedding_model)
+    rng = np.random.default_rng(seed)
+
+    # The upload is done by the app before a job is queued, so it is not timed
+    pdfs = []
+    for index in range(documents_count):
+        folder, body = f"benchmark_pdf_{index}", f"document_{index}"
+        data = make_pdf(index, pages, images_per_page, rng)
+        upload_file_to_folder(GCP_BUCKET, folder, data, f"{body}.pdf", 'string')
+        graph.create_and_return_chunk(graph, f"{body}.pdf", folder, "uploaded", content_hash=content_hash(data), blob=f"{folder}/{body}.pdf")
+        pdfs.append((folder, body, data))
+    images = []
+    for index in range(image_files):
+        folder, body = f"benchmark_image_{index}", f"image_{index}"
+        data = random_image(rng, size=256)
+        upload_file_to_folder(GCP_BUCKET, folder, data, f"{body}.png", 'string')
+        graph.create_and_return_chunk(graph, f"{body}.png", folder, "uploaded", content_hash=content_hash(data), blob=f"{folder}/{body}.png")
+        images.append((folder, body))
+
+    started_at = time.perf_counter()
+    for folder, body, data in pdfs:
+        ingestion.ingest_file(graph, model, GENERATION_CONFIG, folder, body, ".pdf", f"{body}.pdf", file_bytes=data, store=graph)
+    pdf_seconds = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    for folder, body in images:
+        ingestion.ingest_file(graph, model, GENERATION_CONFIG, folder, body, ".png", f"{body}.png", store=graph)
+    image_seconds = time.perf_counter() - started_at
+
+    # A run whose images were not all described measured less work than it reports
+    undescribed = [name for (folder, name, element), chunk in graph.chunks.items()
+                   if (element == -1 or chunk.get("chunk_type") == "image") and chunk.get("text") is None]
+    if undescribed:
+        raise RuntimeError(f"{len(undescribed)} images were not described, e.g. {undescribed[0]}")
+
+    total_pages = documents_count * pages
+    return {
+        "pages": total_pages,
+        "pages_per_second": total_pages / pdf_seconds if pdf_seconds else 0.0,
+        "pdf_images_per_second": total_pages * images_per_page / pdf_seconds if pdf_seconds else 0.0,
+        "images": image_files,
+        "images_per_second": image_files / image_seconds if image_seconds else 0.0,
+        "model_requests": model.requests,
+        "embedding_requests": embedding_model.requests,
+    }
+
+
+def synthetic_chunk(row):
+    """Returns (name, element, chunk_type, folder, document) of a synthetic chunk."""
+    document = f"doc_{row // PAGES_PER_DOCUMENT}.pdf"
+    folder = f"folder_{row // (PAGES_PER_DOCUMENT * DOCUMENTS_PER_FOLDER)}"
+    if row % IMAGE_EVERY == IMAGE_EVERY - 1:
+        return f"image_{row}.png", -1, "pdf_image", folder, document
+    return document, row % PAGES_PER_DOCUMENT, "text", folder, document
+
+
+def synthetic_vectors(size, dimensions, seed=0, block=10000):
+    """Yields (start, vectors) blocks of clustered unit-length vectors."""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((max(1, int(np.sqrt(size))), dimensions)).astype(np.float32)
+    centres /= np.linalg.norm(centres, axis=1, keepdims=True)
+    for start in range(0, size, block):
+        count = min(block, size - start)
+        noise = rng.standard_normal((count, dimensions)).astype(np.float32)
+        noise /= np.linalg.norm(noise, axis=1, keepdims=True)
+        vectors = centres[rng.integers(0, len(centres), size=count)] + CLUSTER_SPREAD * noise
+        yield start, vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def build_index(backend, mode, size, dimensions, graph, seed=0):
+    """Fills an index of the given backend with size synthetic chunks, which are also added to the graph.
+
+    The quantized modes rescore their shortlists with the vectors kept in the graph,
+    as they would with the embeddings stored in Neo4j.
+    Returns:
+        tuple: The index and a sample of stored vectors to derive the queries from.
+    """
+    if backend == "ivf":
+        index = IvfIndex(directory=os.path.join(WORK_DIR, "ann", f"{mode}_{size}"), train_rows=min(keys.ANN_TRAIN_ROWS, size))
+        index._open()
+    else:
+        index = EmbeddingIndex(mode=mode, fetch_embeddings=graph.fetch_embeddings)
+    rescored = backend == "memory" and mode != "float32"
+    sample = []
+    for start, vectors in synthetic_vectors(size, dimensions, seed):
+        sample.append(vectors[:10].copy())
+        chunks = [synthetic_chunk(start + offset) for offset in range(len(vectors))]
+        graph.add_synthetic_chunks([(folder, name, element) for name, element, chunk_type, folder, document in chunks],
+                                   [chunk_type for name, element, chunk_type, folder, document in chunks],
+                                   vectors if rescored else None)
+        if backend == "ivf":
+            index.upsert_many([(name, element, chunk_type, vector, True, 1.0, folder, document)
+                               for (name, element, chunk_type, folder, document), vector in zip(chunks, vectors)])
+        else:
+            for (name, element, chunk_type, folder, document), vector in zip(chunks, vectors):
+                index.upsert(name, element, chunk_type, vector, norm=1.0, folder=folder, document=document)
+    if backend == "ivf":
+        # Wait for the background training, so every query probes trained lists
+        index.train()
+    index.loaded = True
+    return index, np.concatenate(sample)
+
+
+def benchmark_retrieval(backend, mode, size, dimensions, queries=200, seed=0):
+    """Measures the latency of retrieve_context over an index of size synthetic chunks.
+    Returns:
+        dict: Build time and p50/p99 retrieval latency in milliseconds.
+    """
+    graph = InMemoryGraph()
+    started_at = time.perf_counter()
+    index, sample = build_index(backend, mode, size, dimensions, graph, seed)
+    build_seconds = time.perf_counter() - started_at
+
+    rng = np.random.default_rng(seed + 1)
+    # Questions close to stored chunks, so the hits pass the similarity thresholds
+    rows = rng.integers(0, len(sample), size=queries)
+    noise = rng.standard_normal((queries, dimensions)).astype(np.float32)
+    noise /= np.linalg.norm(noise, axis=1, keepdims=True)
+    query_vectors = sample[rows] + 0.3 * noise
+
+    latencies = []
+    for query in query_vectors:
+        started_at = time.perf_counter()
+        utils.retrieve_context(graph, query, top_k=5, top_k_images=3, index=index, store=graph)
+        latencies.append(1000 * (time.perf_counter() - started_at))
+    p50, p99 = np.percentile(latencies, [50, 99])
+    return {"backend": backend, "mode": mode, "chunks": size, "build_seconds": build_seconds,
+            "p50_ms": float(p50), "p99_ms": float(p99)}
+
+
+def find_regressions(results, baseline, tolerance):
+    """Compares the results with a baseline run.
+    Returns:
+        list: Descriptions of the measurements that are more than tolerance worse.
+    """
+    regressions = []
+    for key in ("pages_per_second", "images_per_second"):
+        current, previous = results["ingestion"].get(key), baseline.get("ingestion", {}).get(key)
+        if current is not None and previous and current < previous * (1 - tolerance):
+            regressions.append(f"ingestion {key} {current:.1f} < {previous:.1f}")
+    previous_runs = {(run["backend"], run["mode"], run["chunks"]): run for run in baseline.get("retrieval", [])}
+    for run in results["retrieval"]:
+        previous = previous_runs.get((run["backend"], run["mode"], run["chunks"]))
+        for key in ("p50_ms", "p99_ms"):
+            if previous and run[key] > previous[key] * (1 + tolerance):
+                regressions.append(f"{run['backend']}/{run['mode']} at {run['chunks']} chunks {key} {run[key]:.2f} > {previous[key]:.2f}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline ingestion and retrieval benchmarks")
+    parser.add_argument("--sizes", default="1000,100000,1000000", help="comma-separated numbers of synthetic chunks")
+    parser.add_argument("--backends", default="memory/float32,memory/int8,memory/binary,ivf/float32",
+                        help="comma-separated backend/mode pairs to measure retrieval with")
+    parser.add_argument("--dimensions", type=int, default=keys.EMBEDDING_DIMENSIONS)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--documents", type=int, default=10, help="synthetic PDFs to ingest")
+    parser.add_argument("--pages", type=int, default=10, help="pages per synthetic PDF")
+    parser.add_argument("--images", type=int, default=20, help="synthetic image files to ingest")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated latency of every model request")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression against the baseline")
+    args = parser.parse_args(argv)
+
+    try:
+        results = {"ingestion": benchmark_ingestion(args.documents, args.pages, 1, args.images, args.latency_ms), "retrieval": []}
+        print(f"Ingestion: {results['ingestion']['pages_per_second']:.1f} pages/s, "
+              f"{results['ingestion']['images_per_second']:.1f} images/s")
+        for size in [int(size) for size in args.sizes.split(",")]:
+            for pair in args.backends.split(","):
+                backend, mode = pair.split("/")
+                run = benchmark_retrieval(backend, mode, size, args.dimensions, args.queries)
+                results["retrieval"].append(run)
+                print(f"Retrieval {backend}/{mode}, {size} chunks: p50 {run['p50_ms']:.2f} ms, p99 {run['p99_ms']:.2f} ms "
+                      f"(built in {run['build_seconds']:.1f} s)")
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
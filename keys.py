@@ -1,10 +1,9 @@
 import dotenv
 import os
 
-# load environment variables
-load_status = dotenv.load_dotenv(".env")
-if load_status is False:
-    raise RuntimeError('Environment variables are not found.')
+# load environment variables from .env if it exists, otherwise they are read from the environment.
+# Missing credentials are reported when a client is first created in src/resources.py.
+dotenv.load_dotenv(".env")
 
 NEO4J_URI = os.getenv("NEO4J_URI")
 NEO4J_USERNAME = os.getenv('NEO4J_USERNAME')
@@ -21,4 +20,38 @@ GCP_BUCKET: str = os.getenv("GCP_BUCKET")
 GCP_SERVICE_ACCOUNT: str = os.getenv("GCP_SERVICE_ACCOUNT")
 GCP_PROJECT_ID: str = os.getenv("GCP_PROJECT_ID")
 GCP_LOCATION: str = os.getenv("GCP_LOCATION")
-
+RETRIEVAL_BACKEND: str = os.getenv("RETRIEVAL_BACKEND", "memory")
+EMBEDDING_DIMENSIONS: int = int(os.getenv("EMBEDDING_DIMENSIONS", "768"))
+VECTOR_QUERY_CANDIDATES: int = int(os.getenv("VECTOR_QUERY_CANDIDATES", "100"))
+EMBEDDING_BATCH_SIZE: int = int(os.getenv("EMBEDDING_BATCH_SIZE", "250"))
+EMBEDDING_MAX_BATCH_TOKENS: int = int(os.getenv("EMBEDDING_MAX_BATCH_TOKENS", "20000"))
+EMBEDDING_CACHE_PATH: str = os.getenv("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite")
+EMBEDDING_CACHE_MEMORY_ITEMS: int = int(os.getenv("EMBEDDING_CACHE_MEMORY_ITEMS", "10000"))
+EMBEDDING_CACHE_DISK_MB: int = int(os.getenv("EMBEDDING_CACHE_DISK_MB", "512"))
+CHUNK_WRITE_BATCH_SIZE: int = int(os.getenv("CHUNK_WRITE_BATCH_SIZE", "200"))
+SCHEMA_CHECK_PLANS: bool = os.getenv("SCHEMA_CHECK_PLANS", "false").lower() == "true"
+IMAGE_DESCRIPTION_CONCURRENCY: int = int(os.getenv("IMAGE_DESCRIPTION_CONCURRENCY", "8"))
+IMAGE_DESCRIPTION_COMBINED: bool = os.getenv("IMAGE_DESCRIPTION_COMBINED", "false").lower() == "true"
+GCS_LOCAL_ROOT: str = os.getenv("GCS_LOCAL_ROOT", "")
+GCS_MAX_WORKERS: int = int(os.getenv("GCS_MAX_WORKERS", "16"))
+JOB_QUEUE_PATH: str = os.getenv("JOB_QUEUE_PATH", ".cache/jobs.sqlite")
+JOB_SPOOL_DIR: str = os.getenv("JOB_SPOOL_DIR", ".cache/spool")
+INGESTION_WORKERS: int = int(os.getenv("INGESTION_WORKERS", "2"))
+JOB_LEASE_SECONDS: int = int(os.getenv("JOB_LEASE_SECONDS", "120"))
+ANSWER_CACHE_THRESHOLD: float = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_TTL_SECONDS: int = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+ANSWER_CACHE_MAX_ITEMS: int = int(os.getenv("ANSWER_CACHE_MAX_ITEMS", "500"))
+IMAGE_CACHE_DIR: str = os.getenv("IMAGE_CACHE_DIR", ".cache/thumbnails")
+IMAGE_CACHE_MEMORY_MB: int = int(os.getenv("IMAGE_CACHE_MEMORY_MB", "64"))
+IMAGE_CACHE_DISK_MB: int = int(os.getenv("IMAGE_CACHE_DISK_MB", "256"))
+THUMBNAIL_WIDTH: int = int(os.getenv("THUMBNAIL_WIDTH", "300"))
+STREAM_RESPONSES: bool = os.getenv("STREAM_RESPONSES", "true").lower() == "true"
+EMBEDDING_INDEX_MODE: str = os.getenv("EMBEDDING_INDEX_MODE", "float32")
+EMBEDDING_RESCORE_CANDIDATES: int = int(os.getenv("EMBEDDING_RESCORE_CANDIDATES", "50"))
+ANN_INDEX_DIR: str = os.getenv("ANN_INDEX_DIR", ".cache/ann")
+ANN_LISTS: int = int(os.getenv("ANN_LISTS", "0"))
+ANN_PROBES: int = int(os.getenv("ANN_PROBES", "8"))
+ANN_TRAIN_ROWS: int = int(os.getenv("ANN_TRAIN_ROWS", "10000"))
+TELEMETRY_SINKS: str = os.getenv("TELEMETRY_SINKS", "")
+TELEMETRY_PROMETHEUS_DIR: str = os.getenv("TELEMETRY_PROMETHEUS_DIR", ".cache/metrics")
+TELEMETRY_FLUSH_SECONDS: int = int(os.getenv("TELEMETRY_FLUSH_SECONDS", "15"))
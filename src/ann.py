@@ -0,0 +1,566 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+from src.index import EmbeddingIndex, PartitionMap, document_of, to_vector, normalize
+import keys
+
+ANN_INDEX_DIR = keys.ANN_INDEX_DIR
+ANN_LISTS = keys.ANN_LISTS
+ANN_PROBES = keys.ANN_PROBES
+ANN_TRAIN_ROWS = keys.ANN_TRAIN_ROWS
+
+INITIAL_CAPACITY = 4096
+KMEANS_ITERATIONS = 10
+# Rows sampled per list to train the centroids
+KMEANS_SAMPLE_PER_LIST = 64
+# Rows assigned or scored per block, bounding the temporaries
+BLOCK_ROWS = 8192
+LOAD_BATCH_SIZE = 1000
+
+# Fields of the shared header file
+HEADER_ROWS, HEADER_DIMENSIONS, HEADER_CAPACITY, HEADER_GENERATION, HEADER_TRAINED_ROWS = range(5)
+HEADER_FIELDS = 8
+
+# Bits of the per-row flags
+TEXT, IMAGE, IN_QUERY = 1, 2, 4
+
+
+def nearest_centroids(vectors, centroids):
+    """Returns the index of the most similar centroid for every unit-length vector."""
+    assignment = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), BLOCK_ROWS):
+        assignment[start:start + BLOCK_ROWS] = np.argmax(np.asarray(vectors[start:start + BLOCK_ROWS]) @ centroids.T, axis=1)
+    return assignment
+
+
+def train_centroids(sample, lists, iterations=KMEANS_ITERATIONS, seed=0):
+    """Clusters unit-length vectors with spherical k-means.
+    Returns:
+        np.ndarray: (lists, dimensions) unit-length centroids.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), size=lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest_centroids(sample, centroids)
+        counts = np.bincount(assignment, minlength=lists)
+        order = np.argsort(assignment, kind="stable")
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        filled = counts > 0
+        sums = np.add.reduceat(sample[order], starts[filled], axis=0)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids[filled] = sums / np.where(norms == 0, 1, norms)
+        # Lists that lost all their vectors restart from a random sample vector
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = sample[rng.choice(len(sample), size=len(empty), replace=False)]
+    return centroids.astype(np.float32)
+
+
+class IvfIndex:
+    """Inverted-file approximate nearest-neighbour index persisted in memory-mapped files.
+
+    Embeddings are clustered into lists around k-means centroids, and a search only
+    scores the rows of the probes lists whose centroids are closest to the question,
+    so more probes trade latency for recall. The unit-length float32 vectors, the list
+    and the flags of every row live in files under directory that every app process
+    maps, so the processes share one copy through the page cache. Chunk keys are kept
+    in SQLite, whose write lock also serializes writers across processes. Rows are
+    added as chunks are written, and the lists are retrained in a background thread
+    whenever the index has grown fourfold since the last training, holding the
+    locks only to swap in the new lists. The folder and document of every row and
+    the PART_OF links of the parent Nodes are kept in SQLite as well, so a search scoped
+    to folders or Nodes scans only their rows exactly, and a Node switched off in one
+    process is excluded from the searches of every process.
+    """
+
+    def __init__(self, directory=ANN_INDEX_DIR, lists=ANN_LISTS, probes=ANN_PROBES, train_rows=ANN_TRAIN_ROWS):
+        self._lock = threading.RLock()
+        self.directory = directory
+        self.lists = lists
+        self.probes = probes
+        self.train_rows = train_rows
+        self._connection = None
+        self._header = None
+        self._vectors = None
+        self._lists = None
+        self._flags = None
+        self._capacity = 0
+        self._generation = None
+        self._centroids = None
+        self._members = None
+        self._members_key = None
+        self._excluded = None
+        self._excluded_key = None
+        self._training = None
+        self._training_lock = threading.Lock()
+        self.loaded = False
+
+    def __len__(self):
+        return 0 if self._header is None else int(self._header[HEADER_ROWS])
+
+    @property
+    def dimensions(self):
+        return None if self._header is None or not self._header[HEADER_DIMENSIONS] else int(self._header[HEADER_DIMENSIONS])
+
+    @property
+    def synced_at(self):
+        """Time up to which finished ingestion jobs have been added, kept across restarts."""
+        if self._connection is None:
+            return 0.0
+        row = self._connection.execute("SELECT value FROM meta WHERE key = 'synced_at'").fetchone()
+        return row[0] if row else 0.0
+
+    @synced_at.setter
+    def synced_at(self, value):
+        self._connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('synced_at', ?)", (value,))
+
+    def _rows(self):
+        # Rows readable through this process's mappings; another process may have grown the files since the last _sync
+        return min(len(self), self._capacity)
+
+    def _path(self, file_name):
+        return os.path.join(self.directory, file_name)
+
+    @contextmanager
+    def _write(self):
+        # BEGIN IMMEDIATE takes the SQLite write lock, which every writing process shares
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+            self._connection.execute("COMMIT")
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._connection = sqlite3.connect(self._path("chunks.sqlite"), timeout=60, isolation_level=None, check_same_thread=False)
+        # Chunks are unique on (folder, name, element): the images of a PDF uploaded to two folders share their names
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (folder TEXT, name TEXT NOT NULL, element INTEGER NOT NULL, "
+            "row INTEGER NOT NULL, document TEXT, PRIMARY KEY (folder, name, element))"
+        )
+        self._connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS chunks_row ON chunks (row)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS chunks_partition ON chunks (folder, document)")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS node_documents (node TEXT NOT NULL, folder TEXT, document TEXT NOT NULL, "
+            "PRIMARY KEY (node, folder, document))"
+        )
+        self._connection.execute("CREATE TABLE IF NOT EXISTS disabled_nodes (node TEXT PRIMARY KEY)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL)")
+        # Rows whose vectors were replaced while the lists are being trained, which train() reassigns
+        self._connection.execute("CREATE TABLE IF NOT EXISTS replaced_rows (row INTEGER PRIMARY KEY)")
+        with self._write():
+            if not os.path.exists(self._path("header.i64")):
+                with open(self._path("header.i64"), "wb") as f:
+                    f.write(bytes(8 * HEADER_FIELDS))
+        self._header = np.memmap(self._path("header.i64"), dtype=np.int64, mode="r+", shape=(HEADER_FIELDS,))
+        self._sync()
+
+    def _remap(self):
+        # Map the row files at the capacity recorded in the header
+        capacity = int(self._header[HEADER_CAPACITY])
+        dimensions = int(self._header[HEADER_DIMENSIONS])
+        if capacity:
+            self._vectors = np.memmap(self._path("vectors.f32"), dtype=np.float32, mode="r+", shape=(capacity, dimensions))
+            self._lists = np.memmap(self._path("lists.i32"), dtype=np.int32, mode="r+", shape=(capacity,))
+            self._flags = np.memmap(self._path("flags.u8"), dtype=np.uint8, mode="r+", shape=(capacity,))
+        self._capacity = capacity
+
+    def _sync(self):
+        # Pick up growth and retraining done by other processes
+        if int(self._header[HEADER_CAPACITY]) != self._capacity:
+            self._remap()
+        generation = int(self._header[HEADER_GENERATION])
+        if generation != self._generation:
+            path = self._path("centroids.npy")
+            self._centroids = np.load(path) if os.path.exists(path) else None
+            self._generation = generation
+            self._members_key = None
+
+    def _ensure_capacity(self, rows, dimensions):
+        if not self._header[HEADER_DIMENSIONS]:
+            self._header[HEADER_DIMENSIONS] = dimensions
+        capacity = int(self._header[HEADER_CAPACITY])
+        if rows <= capacity:
+            return
+        new_capacity = max(capacity, INITIAL_CAPACITY)
+        while new_capacity < rows:
+            new_capacity *= 2
+        # Grow the files geometrically; the new space reads as zeros
+        for file_name, row_bytes in (("vectors.f32", 4 * dimensions), ("lists.i32", 4), ("flags.u8", 1)):
+            with open(self._path(file_name), "a+b") as f:
+                f.truncate(new_capacity * row_bytes)
+        self._header[HEADER_CAPACITY] = new_capacity
+        self._header.flush()
+        self._remap()
+        self._lists[capacity:] = -1
+
+    def upsert_many(self, chunks):
+        """Adds or replaces the embeddings of many chunks in one write.
+
+        A chunk whose embedding cannot be decoded or has another dimension than the
+        index is skipped with a message, without failing the other chunks.
+        Args:
+            chunks (list): (name, element, chunk_type, embedding, in_query, norm, folder, document) tuples.
+        """
+        prepared = []
+        for name, element, chunk_type, embedding, in_query, norm, folder, document in chunks:
+            try:
+                vector = normalize(to_vector(embedding), norm).astype(np.float32)
+            except (TypeError, ValueError) as e:
+                print(f"Procedure IvfIndex.upsert_many: Skipping chunk {name} of folder {folder}: {e}")
+                continue
+            flags = (TEXT if element != -1 else 0) | (IMAGE if element == -1 or chunk_type == "image" else 0) | (IN_QUERY if in_query else 0)
+            prepared.append((name, element, flags, vector, folder, document_of(name, document)))
+        if not prepared:
+            return
+        with self._lock, self._write():
+            self._sync()
+            dimensions = self.dimensions or prepared[0][3].shape[0]
+            for name, element, flags, vector, folder, document in prepared:
+                if vector.shape[0] != dimensions:
+                    print(f"Procedure IvfIndex.upsert_many: Skipping chunk {name} of folder {folder}: "
+                          f"embedding has {vector.shape[0]} dimensions, index has {dimensions}")
+            prepared = [chunk for chunk in prepared if chunk[3].shape[0] == dimensions]
+            rows = int(self._header[HEADER_ROWS])
+            self._ensure_capacity(rows + len(prepared), dimensions)
+            reassigned = False
+            for name, element, flags, vector, folder, document in prepared:
+                record = self._connection.execute("SELECT row FROM chunks WHERE folder IS ? AND name = ? AND element = ?",
+                                                  (folder, name, element)).fetchone()
+                if record is None:
+                    row = rows
+                    rows += 1
+                    self._connection.execute("INSERT INTO chunks (folder, name, element, row, document) VALUES (?, ?, ?, ?, ?)",
+                                             (folder, name, element, row, document))
+                else:
+                    row = record[0]
+                    self._connection.execute("UPDATE chunks SET document = ? WHERE row = ?", (document, row))
+                    # Processes that sync the same ingestion job write identical rows
+                    if self._flags[row] == flags and np.array_equal(self._vectors[row], vector):
+                        continue
+                    self._connection.execute("INSERT OR IGNORE INTO replaced_rows (row) VALUES (?)", (row,))
+                assigned = int(np.argmax(self._centroids @ vector)) if self._centroids is not None else -1
+                reassigned = reassigned or (record is not None and self._lists[row] != assigned)
+                self._vectors[row] = vector
+                self._lists[row] = assigned
+                self._flags[row] = flags
+            for array in (self._vectors, self._lists, self._flags):
+                array.flush()
+            # Readers only look at rows below HEADER_ROWS, so it is advanced after the rows are written
+            self._header[HEADER_ROWS] = rows
+            if reassigned:
+                self._header[HEADER_GENERATION] += 1
+            self._header.flush()
+        if self._needs_training():
+            self._train_in_background()
+
+    def upsert(self, name, element, chunk_type, embedding, in_query=True, norm=None, folder=None, document=None):
+        """Adds or replaces the embedding of the chunk identified by (folder, name, element)."""
+        self.upsert_many([(name, element, chunk_type, embedding, in_query, norm, folder, document)])
+
+    def _bump_partitions(self):
+        # Searches in every process recompute their excluded rows when the version changes
+        self._connection.execute(
+            "INSERT INTO meta (key, value) VALUES ('partitions_version', 1) "
+            "ON CONFLICT (key) DO UPDATE SET value = value + 1"
+        )
+
+    def link_node(self, folder, document, node):
+        """Records that a document is part of a parent Node."""
+        with self._lock, self._write():
+            self._connection.execute("INSERT OR IGNORE INTO node_documents (node, folder, document) VALUES (?, ?, ?)",
+                                     (node, folder, document))
+            self._bump_partitions()
+
+    def set_node_in_query(self, node, in_query):
+        """Switches the documents of a parent Node in or out of retrieval without touching their rows."""
+        with self._lock, self._write():
+            if in_query:
+                self._connection.execute("DELETE FROM disabled_nodes WHERE node = ?", (node,))
+            else:
+                self._connection.execute("INSERT OR IGNORE INTO disabled_nodes (node) VALUES (?)", (node,))
+            self._bump_partitions()
+
+    def _load_partitions(self, driver):
+        # Replace the PART_OF links and Node flags with those in the graph database
+        partitions = PartitionMap()
+        partitions.load(driver)
+        with self._lock, self._write():
+            self._connection.execute("DELETE FROM node_documents")
+            self._connection.execute("DELETE FROM disabled_nodes")
+            self._connection.executemany(
+                "INSERT INTO node_documents (node, folder, document) VALUES (?, ?, ?)",
+                [(node, folder, document) for node, documents in partitions.node_partitions.items()
+                 for folder, document in documents])
+            self._connection.executemany("INSERT INTO disabled_nodes (node) VALUES (?)",
+                                         [(node,) for node in partitions.disabled_nodes])
+            self._bump_partitions()
+
+    def _partition_rows(self, condition, parameters):
+        # Rows of the documents whose node_documents entry matches the condition
+        return np.array(sorted(row for (row,) in self._connection.execute(
+            "SELECT c.row FROM chunks c JOIN node_documents d ON d.folder IS c.folder AND d.document = c.document "
+            f"WHERE {condition}", parameters)), dtype=np.int64)
+
+    def _excluded_rows(self):
+        # Rows of the documents of disabled Nodes, cached until the partitions or the rows change
+        record = self._connection.execute("SELECT value FROM meta WHERE key = 'partitions_version'").fetchone()
+        key = (record[0] if record else 0, self._rows())
+        if self._excluded_key != key:
+            self._excluded = self._partition_rows("d.node IN (SELECT node FROM disabled_nodes)", ())
+            self._excluded_key = key
+        return self._excluded
+
+    def _scope_rows(self, folders, nodes):
+        # Rows in the given folders or in the documents of the given Nodes
+        folders, nodes = list(folders or ()), list(nodes or ())
+        rows = set()
+        if folders:
+            rows.update(row for (row,) in self._connection.execute(
+                f"SELECT row FROM chunks WHERE folder IN ({','.join('?' * len(folders))})", folders))
+        if nodes:
+            rows.update(self._partition_rows(f"d.node IN ({','.join('?' * len(nodes))})", nodes).tolist())
+        capacity = self._capacity
+        return np.array(sorted(row for row in rows if row < capacity), dtype=np.int64)
+
+    def _needs_training(self):
+        # The lists are first trained at train_rows rows, then whenever the index has grown fourfold
+        rows, trained_rows = len(self), int(self._header[HEADER_TRAINED_ROWS])
+        return (trained_rows == 0 and rows >= self.train_rows) or (trained_rows > 0 and rows >= 4 * trained_rows)
+
+    def _train_in_background(self):
+        # Training reads every row, so it never runs in the request that wrote the chunks
+        with self._lock:
+            if self._training is not None and self._training.is_alive():
+                return
+            self._training = threading.Thread(target=self._train_quietly, name="ivf-training", daemon=True)
+            self._training.start()
+
+    def _train_quietly(self):
+        try:
+            self.train()
+        except Exception as e:
+            print(f"Procedure IvfIndex.train: Error training the lists: {e}")
+
+    def train(self, force=False):
+        """Trains the centroids on a sample of the rows and reassigns every row to its nearest list.
+
+        The centroids and the lists of the rows present when training starts are
+        computed without holding any lock, so searches and writers are not held up.
+        The locks are only taken to assign the rows added or replaced in the meantime
+        and to swap in the new centroids and lists.
+        Args:
+            force (bool): Train even if the index has not grown enough since the last training.
+        Returns:
+            bool: Whether the lists were trained.
+        """
+        with self._training_lock:
+            with self._lock, self._write():
+                self._sync()
+                if len(self) == 0 or not (force or self._needs_training()):
+                    return False
+                rows = self._rows()
+                trained_rows = int(self._header[HEADER_TRAINED_ROWS])
+                vectors = self._vectors
+                # Rows replaced from now on are reassigned when the new lists are swapped in
+                self._connection.execute("DELETE FROM replaced_rows")
+            lists = max(1, min(self.lists or int(np.sqrt(rows)), rows))
+            rng = np.random.default_rng(0)
+            sample_rows = np.sort(rng.choice(rows, size=min(rows, lists * KMEANS_SAMPLE_PER_LIST), replace=False))
+            centroids = train_centroids(np.asarray(vectors[sample_rows]), lists)
+            assignment = nearest_centroids(vectors[:rows], centroids)
+            with self._lock, self._write():
+                self._sync()
+                # Another process trained the lists while this one was computing its centroids
+                if not force and int(self._header[HEADER_TRAINED_ROWS]) != trained_rows:
+                    return False
+                replaced = np.array([row for (row,) in self._connection.execute(
+                    "SELECT row FROM replaced_rows WHERE row < ? ORDER BY row", (rows,))], dtype=np.int64)
+                self._connection.execute("DELETE FROM replaced_rows")
+                current = self._rows()
+                np.save(self._path("centroids.tmp.npy"), centroids)
+                os.replace(self._path("centroids.tmp.npy"), self._path("centroids.npy"))
+                self._lists[:rows] = assignment
+                if len(replaced):
+                    self._lists[replaced] = nearest_centroids(self._vectors[replaced], centroids)
+                if current > rows:
+                    self._lists[rows:current] = nearest_centroids(self._vectors[rows:current], centroids)
+                self._lists.flush()
+                self._header[HEADER_TRAINED_ROWS] = current
+                self._header[HEADER_GENERATION] += 1
+                self._header.flush()
+                self._sync()
+            return True
+
+    def _candidates(self, query, probes):
+        # Rows of the lists closest to the query; every row until the lists are trained
+        rows = self._rows()
+        if self._centroids is None:
+            return np.arange(rows)
+        if self._members_key != (rows, self._generation):
+            order = np.argsort(self._lists[:rows], kind="stable")
+            sorted_lists = np.asarray(self._lists[:rows])[order]
+            self._members = (order, np.searchsorted(sorted_lists, np.arange(-1, len(self._centroids)), side="left"),
+                             np.searchsorted(sorted_lists, np.arange(-1, len(self._centroids)), side="right"))
+            self._members_key = (rows, self._generation)
+        order, starts, ends = self._members
+        probes = min(probes, len(self._centroids))
+        nearest = np.argpartition(-(self._centroids @ query), probes - 1)[:probes]
+        # Position 0 holds the rows written before the first training finished
+        selected = [order[starts[0]:ends[0]]] + [order[starts[probe + 1]:ends[probe + 1]] for probe in nearest]
+        return np.sort(np.concatenate(selected))
+
+    def search(self, query_embedding, top_k, kind="text", probes=None, folders=None, nodes=None):
+        """Returns the approximate top_k most similar chunks of the given kind.
+        Args:
+            query_embedding (list or np.ndarray): The query embedding.
+            top_k (int): Maximum number of hits.
+            kind (str): "text" for page and file chunks, "image" for image chunks.
+            probes (int): Number of lists to scan, the configured default if not given.
+            folders (list): Only search the chunks in these folders.
+            nodes (list): Only search the chunks of the documents that are part of these Nodes.
+                A scoped search scans every row of its scope exactly instead of probing lists.
+        Returns:
+            list: (folder, chunk_name, element, similarity) tuples sorted by descending similarity.
+        """
+        query = normalize(to_vector(query_embedding)).astype(np.float32)
+        with self._lock:
+            self._sync()
+            if len(self) == 0 or top_k <= 0:
+                return []
+            if query.shape[0] != self.dimensions:
+                raise ValueError(f"Query has {query.shape[0]} dimensions, index has {self.dimensions}")
+            if folders or nodes:
+                candidates = self._scope_rows(folders, nodes)
+            else:
+                candidates = self._candidates(query, probes or self.probes)
+            wanted = (TEXT if kind == "text" else IMAGE) | IN_QUERY
+            candidates = candidates[(self._flags[candidates] & wanted) == wanted]
+            excluded = self._excluded_rows()
+            if len(excluded):
+                candidates = candidates[~np.isin(candidates, excluded, assume_unique=True)]
+            if len(candidates) == 0:
+                return []
+            scores = np.concatenate([np.asarray(self._vectors[candidates[start:start + BLOCK_ROWS]]) @ query
+                                     for start in range(0, len(candidates), BLOCK_ROWS)])
+            count = min(top_k, len(candidates))
+            top = np.argpartition(-scores, count - 1)[:count]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            top_rows = [int(row) for row in candidates[top]]
+            names = {row: (folder, name, element) for row, folder, name, element in self._connection.execute(
+                f"SELECT row, folder, name, element FROM chunks WHERE row IN ({','.join('?' * len(top_rows))})", top_rows)}
+            return [names[row] + (float(score),) for row, score in zip(top_rows, scores[top]) if row in names]
+
+    def load(self, driver, folder=None):
+        """Opens the index files and adds chunk embeddings from the graph database.
+
+        An index that already has rows is reused as it is, and only the chunks of
+        ingestion jobs finished since synced_at are added by sync_embedding_index.
+        Args:
+            driver: Neo4j driver.
+            folder (str): Only load the chunks of this folder. None builds the index
+                from every chunk if it is empty.
+        """
+        started_at = time.time()
+        with self._lock:
+            if self._connection is None:
+                self._open()
+            if folder is None and len(self) > 0:
+                # The rows are reused, but Nodes may have changed while no process had the index open
+                self._load_partitions(driver)
+                self.loaded = True
+                return
+        with driver.session() as session:
+            query = (
+                "MATCH (c:Chunk) "
+                "WHERE (c.embedding IS NOT NULL OR c.embedding_string IS NOT NULL) AND ($folder IS NULL OR c.folder = $folder) "
+                "RETURN c.name AS chunk_name, c.element AS element, c.chunk_type AS chunk_type, c.in_query AS in_query, "
+                "c.folder AS folder, coalesce(head([(c)-[:IMAGE_OF]->(p:Chunk) | p.name]), c.name) AS document, "
+                "c.embedding AS embedding, c.embedding_norm AS embedding_norm, "
+                "CASE WHEN c.embedding IS NULL THEN c.embedding_string END AS embedding_string"
+            )
+            batch = []
+            for record in session.run(query, folder=folder):
+                embedding = record["embedding"] or record["embedding_string"]
+                try:
+                    # Decode here so a broken embedding only skips its own chunk
+                    normalize(to_vector(embedding), record["embedding_norm"] if record["embedding"] else None)
+                except (TypeError, ValueError) as e:
+                    print(f"Procedure IvfIndex.load: Error processing chunk {record['chunk_name']}: {e}")
+                    continue
+                batch.append((record["chunk_name"], record["element"], record["chunk_type"], embedding,
+                              record["in_query"] is True, record["embedding_norm"] if record["embedding"] else None,
+                              record["folder"], record["document"]))
+                if len(batch) >= LOAD_BATCH_SIZE:
+                    self.upsert_many(batch)
+                    batch = []
+            self.upsert_many(batch)
+        if folder is None:
+            self._load_partitions(driver)
+            self.loaded = True
+            self.synced_at = started_at
+
+    def rebuild(self, driver):
+        """Deletes the index files and builds the index again from the graph database.
+        Run it while no app process has the index open.
+        """
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+            self._connection = None
+            self._header = self._vectors = self._lists = self._flags = None
+            self._capacity = 0
+            self._generation = None
+            for file_name in ("chunks.sqlite", "header.i64", "vectors.f32", "lists.i32", "flags.u8", "centroids.npy"):
+                if os.path.exists(self._path(file_name)):
+                    os.remove(self._path(file_name))
+            self.loaded = False
+        self.load(driver)
+        # Train on every loaded row rather than on the rows present when the background training started
+        self.train(force=len(self) >= self.train_rows)
+
+
+def measure_recall(driver, probes=(1, 2, 4, 8, 16, 32), sample_size=100, top_k=5, seed=0):
+    """Measures the recall and latency of the IVF index against the exact cosine search.
+
+    Stored text embeddings serve as the sample queries.
+    Returns:
+        dict: probes -> {"recall": mean recall@top_k, "latency_ms": mean search time}.
+    """
+    exact = EmbeddingIndex(mode="float32")
+    exact.load(driver)
+    index = IvfIndex()
+    index.load(driver)
+    rows = np.flatnonzero(exact._is_text[:len(exact)] & exact._in_query[:len(exact)])
+    rows = np.random.default_rng(seed).choice(rows, size=min(sample_size, len(rows)), replace=False)
+    queries = [exact._matrix[row].copy() for row in rows]
+    expected = [{hit[:3] for hit in exact.search(query, top_k)} for query in queries]
+    results = {}
+    for probe_count in probes:
+        found = []
+        started_at = time.perf_counter()
+        for query, truth in zip(queries, expected):
+            hits = index.search(query, top_k, probes=probe_count)
+            found.append(len(truth & {hit[:3] for hit in hits}) / max(len(truth), 1))
+        elapsed = time.perf_counter() - started_at
+        results[probe_count] = {"recall": float(np.mean(found)) if found else 1.0,
+                                "latency_ms": 1000 * elapsed / max(len(queries), 1)}
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+    from neo4j import GraphDatabase
+    with GraphDatabase.driver(keys.NEO4J_URI, auth=(keys.NEO4J_USERNAME, keys.NEO4J_PASSWORD)) as driver:
+        if sys.argv[1:] == ["build"]:
+            index = IvfIndex()
+            index.rebuild(driver)
+            print(f"Built the IVF index with {len(index)} chunks.")
+        else:
+            for probe_count, result in measure_recall(driver).items():
+                print(f"probes {probe_count}: recall@5 {result['recall']:.3f}, {result['latency_ms']:.2f} ms per search")
@@ -0,0 +1,284 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+import keys
+
+EMBEDDING_MODEL = keys.EMBEDDING_MODEL
+EMBEDDING_CACHE_PATH = keys.EMBEDDING_CACHE_PATH
+EMBEDDING_CACHE_MEMORY_ITEMS = keys.EMBEDDING_CACHE_MEMORY_ITEMS
+EMBEDDING_CACHE_DISK_MB = keys.EMBEDDING_CACHE_DISK_MB
+ANSWER_CACHE_THRESHOLD = keys.ANSWER_CACHE_THRESHOLD
+ANSWER_CACHE_TTL_SECONDS = keys.ANSWER_CACHE_TTL_SECONDS
+ANSWER_CACHE_MAX_ITEMS = keys.ANSWER_CACHE_MAX_ITEMS
+
+# How long a write waits for another process holding the SQLite write lock
+SQLITE_BUSY_TIMEOUT_SECONDS = 10
+
+
+def content_key(model_name, text):
+    """Returns the cache key of the text for the given embedding model."""
+    return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Content-addressed embedding cache with an in-process LRU tier and a SQLite disk tier.
+
+    Entries are keyed on (embedding model name, SHA-256 of the text). Vectors are
+    stored on disk as float32 bytes and the disk tier evicts the least recently
+    used entries once it grows past max_disk_bytes. The disk tier is shared by the
+    app and worker processes, so its size is read from the database, and a disk
+    error counts as a miss or a skipped write instead of failing the caller.
+    """
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_memory_items=EMBEDDING_CACHE_MEMORY_ITEMS,
+                 max_disk_bytes=EMBEDDING_CACHE_DISK_MB * 1024 * 1024):
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._connection = None
+        if path:
+            try:
+                directory = os.path.dirname(path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._connection = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT_SECONDS, check_same_thread=False)
+                # Readers do not block the writer of another process and the other way round
+                self._connection.execute("PRAGMA journal_mode=WAL")
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS embeddings "
+                    "(key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_access REAL NOT NULL)"
+                )
+                self._connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)")
+                self._connection.commit()
+            except sqlite3.Error as e:
+                print(f"Procedure EmbeddingCache: Disk tier disabled, could not open {path}: {e}")
+                self._connection = None
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get_many(self, model_name, texts):
+        """Looks up the embeddings of the texts.
+        Args:
+            model_name (str): The embedding model name.
+            texts (list): The texts to look up.
+        Returns:
+            list: The cached embedding for each text, or None where the text is not cached.
+        """
+        cache_keys = [content_key(model_name, text) for text in texts]
+        vectors = [None] * len(texts)
+        with self._lock:
+            missing = []
+            for i, key in enumerate(cache_keys):
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    vectors[i] = vector
+                    self.memory_hits += 1
+                else:
+                    missing.append(i)
+            if missing and self._connection is not None:
+                found = self._read(list({cache_keys[i] for i in missing}))
+                still_missing = []
+                for i in missing:
+                    vector = found.get(cache_keys[i])
+                    if vector is not None:
+                        vectors[i] = vector
+                        self._remember(cache_keys[i], vector)
+                        self.disk_hits += 1
+                    else:
+                        still_missing.append(i)
+                missing = still_missing
+            self.misses += len(missing)
+        return vectors
+
+    def _read(self, wanted):
+        # Vectors of the keys found on disk; a disk error leaves the rest as misses
+        found = {}
+        try:
+            # Stay under SQLite's limit on the number of query parameters
+            for start in range(0, len(wanted), 500):
+                part = wanted[start:start + 500]
+                rows = self._connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+                found.update((key, np.frombuffer(blob, dtype=np.float32).tolist()) for key, blob in rows)
+            if found:
+                now = time.time()
+                with self._connection:
+                    self._connection.executemany(
+                        "UPDATE embeddings SET last_access = ? WHERE key = ?", [(now, key) for key in found]
+                    )
+        except sqlite3.Error as e:
+            print(f"Procedure EmbeddingCache.get_many: Disk tier read failed: {e}")
+        return found
+
+    def put_many(self, model_name, texts, vectors):
+        """Stores the embeddings of the texts in both tiers."""
+        rows = []
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                if not text or not vector:
+                    continue
+                key = content_key(model_name, text)
+                vector = list(vector)
+                self._remember(key, vector)
+                rows.append((key, np.asarray(vector, dtype=np.float32).tobytes()))
+            if rows and self._connection is not None:
+                now = time.time()
+                try:
+                    with self._connection:
+                        self._connection.executemany(
+                            "INSERT OR REPLACE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?)",
+                            [(key, blob, now) for key, blob in rows]
+                        )
+                    if self._disk_bytes() > self.max_disk_bytes:
+                        self._evict()
+                except sqlite3.Error as e:
+                    print(f"Procedure EmbeddingCache.put_many: Disk tier write skipped: {e}")
+
+    def _disk_bytes(self):
+        # Bytes in use by the database file, the same for every process sharing it
+        page_count = self._connection.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = self._connection.execute("PRAGMA freelist_count").fetchone()[0]
+        page_size = self._connection.execute("PRAGMA page_size").fetchone()[0]
+        return (page_count - free_pages) * page_size
+
+    def _evict(self):
+        # Drop the least recently used entries until the disk tier is back under 90% of its budget.
+        # Each round deletes the number of oldest rows that the excess bytes hold on average.
+        target = int(self.max_disk_bytes * 0.9)
+        for _ in range(8):
+            used = self._disk_bytes()
+            if used <= target:
+                return
+            rows = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            if rows == 0:
+                return
+            excess_rows = max(1, int((used - target) * rows / used) + 1)
+            with self._connection:
+                self._connection.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_access LIMIT ?)", (excess_rows,)
+                )
+
+    def stats(self):
+        """Returns the hit and miss counters of the cache."""
+        with self._lock:
+            try:
+                disk_bytes = self._disk_bytes() if self._connection is not None else 0
+            except sqlite3.Error:
+                disk_bytes = None
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_items": len(self._memory),
+                "disk_bytes": disk_bytes,
+            }
+
+
+class AnswerCache:
+    """Semantic cache of chat answers keyed by the embedding of the question.
+
+    A question whose embedding has a cosine similarity of at least threshold with
+    a cached question, asked with the same generation settings and retrieval scope
+    after the same conversation history, is answered from the cache. A follow-up
+    question only matches questions that followed the same conversation. Entries expire after ttl seconds, the least recently used entries
+    are evicted beyond max_items, and invalidate() drops everything when the set
+    of chunks taking part in retrieval changes.
+    """
+
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL_SECONDS, max_items=ANSWER_CACHE_MAX_ITEMS):
+        self._lock = threading.Lock()
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_items = max_items
+        self._entries = OrderedDict()
+        self._next_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.synced_at = 0.0
+
+    @staticmethod
+    def _settings_key(generation_config, scope=None, history=None):
+        # The answer depends on the conversation so far, which is in the prompt
+        history_key = hashlib.sha256(json.dumps(history or [], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        return json.dumps([generation_config or {}, scope or {}, history_key], sort_keys=True)
+
+    @staticmethod
+    def _normalize(query_embedding):
+        vector = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if vector.ndim == 1 and norm > 0 else None
+
+    def _expire(self, now):
+        for entry_id in [entry_id for entry_id, entry in self._entries.items() if now - entry["created_at"] > self.ttl]:
+            del self._entries[entry_id]
+
+    def get(self, query_embedding, generation_config=None, scope=None, history=None):
+        """Returns the cached (answer, images) of the most similar earlier question, or None.
+        Args:
+            scope (dict): The folders and Nodes the question was restricted to, if any.
+            history (list): The conversation before the question, as passed to the model.
+        """
+        vector = self._normalize(query_embedding)
+        if vector is None or self.max_items <= 0:
+            return None
+        settings = self._settings_key(generation_config, scope, history)
+        with self._lock:
+            self._expire(time.time())
+            candidates = [(entry_id, entry) for entry_id, entry in self._entries.items()
+                          if entry["settings"] == settings and entry["vector"].shape == vector.shape]
+            if candidates:
+                similarities = np.stack([entry["vector"] for _, entry in candidates]) @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    entry_id, entry = candidates[best]
+                    self._entries.move_to_end(entry_id)
+                    self.hits += 1
+                    return entry["answer"], entry["images"]
+            self.misses += 1
+            return None
+
+    def put(self, query_embedding, answer, images, generation_config=None, scope=None, history=None):
+        """Stores the answer and retrieved images of a question."""
+        vector = self._normalize(query_embedding)
+        if vector is None or self.max_items <= 0:
+            return
+        with self._lock:
+            self._entries[self._next_id] = {
+                "vector": vector,
+                "settings": self._settings_key(generation_config, scope, history),
+                "answer": answer,
+                "images": images,
+                "created_at": time.time(),
+            }
+            self._next_id += 1
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        """Drops all cached answers, for example after chunks were added to or removed from retrieval."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the hit and miss counters of the cache."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "items": len(self._entries)}
+
+
+# The embedding cache opens its file on first use, through src.resources.get_embedding_cache
+answer_cache = AnswerCache()
@@ -0,0 +1,160 @@
+from concurrent.futures import ThreadPoolExecutor
+from src.telemetry import span, record_usage
+import keys
+
+IMAGE_DESCRIPTION_CONCURRENCY = keys.IMAGE_DESCRIPTION_CONCURRENCY
+IMAGE_DESCRIPTION_COMBINED = keys.IMAGE_DESCRIPTION_COMBINED
+
+DESCRIBE_PROMPT = """Give overall headline for the image and one line description. Then read the text in the image and output the text in detail. If the image is a spreadsheet then output what you see in JSON format and extract table info from the image. If you are not able to extract JSON then output only text."""
+DESCRIBE_SHORT_PROMPT = """Read the text of the image and create a one-sentence summary of the image's content."""
+SUMMARY_MARKER = "SUMMARY:"
+DESCRIBE_COMBINED_PROMPT = DESCRIBE_PROMPT + f""" Finally, on the last line, write {SUMMARY_MARKER} followed by a one-sentence summary of the image's content."""
+
+
+def is_transient_error(error):
+    """Checks whether a failed model call may succeed when retried, e.g. after a timeout, quota or server error."""
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    try:
+        from google.api_core import exceptions
+    except ImportError:
+        return False
+    return isinstance(error, (exceptions.TooManyRequests, exceptions.ServerError))
+
+
+def image_part(image_file, file_extension, model=None):
+    # Validate file extension
+    if file_extension not in ['.png', '.jpg', '.jpeg']:
+        raise ValueError("Unsupported file extension. Please use '.png', '.jpg', or '.jpeg'.")
+
+    # Determine MIME type
+    if file_extension == '.png':
+        mime_type = "image/png"
+    else:
+        mime_type = "image/jpg"
+
+    # Models that are not Vertex AI models, such as the benchmark stand-in, build their own parts
+    if hasattr(model, "image_part"):
+        return model.image_part(uri=image_file, mime_type=mime_type)
+
+    # Imported on first use, so importing this module does not load the Vertex AI SDK
+    from vertexai.generative_models import Part
+
+    # Create image file part
+    return Part.from_uri(
+        uri=image_file,
+        mime_type=mime_type,
+    )
+
+
+def describe_image(image_file, file_extension, model, generation_config):
+    """Describes an image in detail.
+    Returns:
+        str: The description, or None if the model cannot describe the image, e.g. an unsupported
+        format or a blocked response.
+    Raises:
+        Exception: The error of a model call that failed transiently and can be retried.
+    """
+    try:
+        prompt = [DESCRIBE_PROMPT, image_part(image_file, file_extension, model)]
+        # Generate content
+        with span("gemini.describe_image", image=image_file):
+            response = model.generate_content(prompt, generation_config=generation_config)
+        record_usage(response, "describe_image")
+        return response.text
+
+    except ValueError as ve:
+        print(f"Procedure describe_image: ValueError: {ve}")
+        return None
+    except AttributeError as ae:
+        print(f"Procedure describe_image: AttributeError: {ae}. Check if 'Part' and 'model' are correctly defined and used.")
+        return None
+    except Exception as e:
+        if is_transient_error(e):
+            raise
+        print(f"Procedure describe_image: An error occurred: {e}")
+        return None
+
+
+def describe_image_short(image_file, file_extension, model, generation_config):
+    try:
+        prompt = [DESCRIBE_SHORT_PROMPT, image_part(image_file, file_extension, model)]
+        # Generate content
+        with span("gemini.describe_image", image=image_file, short=True):
+            response = model.generate_content(prompt, generation_config=generation_config)
+        record_usage(response, "describe_image")
+        return response.text
+
+    except ValueError as ve:
+        print(f"Procedure describe_image_short: ValueError: {ve}")
+        return None
+    except Exception as e:
+        if is_transient_error(e):
+            raise
+        print(f"Procedure describe_image_short: An error occurred: {e}")
+        return None
+
+
+def describe_image_combined(image_file, file_extension, model, generation_config):
+    """Produces the long and the short description of an image with a single model call.
+    Returns:
+        tuple: (text, text_short), or (None, None) if the model cannot describe the image.
+    Raises:
+        Exception: The error of a model call that failed transiently and can be retried.
+    """
+    try:
+        prompt = [DESCRIBE_COMBINED_PROMPT, image_part(image_file, file_extension, model)]
+        # Generate content
+        with span("gemini.describe_image", image=image_file, combined=True):
+            response = model.generate_content(prompt, generation_config=generation_config)
+        record_usage(response, "describe_image")
+        text = response.text
+
+        # Split off the summary line, falling back to the headline if the model left it out
+        if SUMMARY_MARKER in text:
+            text, text_short = text.rsplit(SUMMARY_MARKER, 1)
+            return text.strip(), text_short.strip()
+        return text, text.strip().split("\n", 1)[0]
+
+    except ValueError as ve:
+        print(f"Procedure describe_image_combined: ValueError: {ve}")
+        return None, None
+    except Exception as e:
+        if is_transient_error(e):
+            raise
+        print(f"Procedure describe_image_combined: An error occurred: {e}")
+        return None, None
+
+
+def describe_images(images, model, generation_config, max_workers=IMAGE_DESCRIPTION_CONCURRENCY, combined=IMAGE_DESCRIPTION_COMBINED):
+    """Describes many images concurrently.
+    Args:
+        images (list): (image_uri, file_extension) tuples.
+        model: The Gemini model used to read the images.
+        generation_config (dict): Generation parameters passed to the model.
+        max_workers (int): Maximum number of concurrent model calls.
+        combined (bool): Produce both descriptions with one model call per image instead of two.
+    Returns:
+        list: (text, text_short) tuples in the same order as the images. Images the model cannot
+        describe get ("", ""), and images whose description failed transiently get (None, None).
+    """
+    def describe(image):
+        image_file, file_extension = image
+        try:
+            if combined:
+                text, text_short = describe_image_combined(image_file, file_extension, model, generation_config)
+            else:
+                text, text_short = (describe_image(image_file, file_extension, model, generation_config),
+                                    describe_image_short(image_file, file_extension, model, generation_config))
+        except Exception as e:
+            print(f"Procedure describe_images: Could not describe {image_file} for now, it will be retried: {e}")
+            return None, None
+        if not text:
+            return "", ""
+        return text, text_short or ""
+
+    if not images:
+        return []
+    # Each worker makes one model call at a time, so max_workers caps the calls in flight
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(images))) as executor:
+        return list(executor.map(describe, images))
@@ -1,26 +1,57 @@
+import hashlib
 import io
 import fitz
-from src.utils import generate_embedding
-from src.gcputils import read_pdf_from_gcs, list_objects_in_bucket, upload_file_to_folder
+from src.utils import generate_embeddings
+from src.gcputils import read_pdf_from_gcs
 import pymupdf4llm
-from src.graphdb import get_image_text_short_by_chunk_name, create_and_return_chunk, create_consecutive_relationships, update_chunk
+from src import graphdb
+from src.telemetry import span, count
 
 
-def split_pdf_to_chunks(driver, bucket, folder_name, file_body, extension, image_list):
+def load_pdf_bytes(bucket, folder_name, file_body, extension):
     # Construct the GCS path
     source_blob_name = f"{folder_name}/{file_body}{extension}"
 
-    # List objects in the bucket to verify the presence of the file
-    objects = list_objects_in_bucket(bucket)
-    if source_blob_name not in objects:
-        raise FileNotFoundError(f"No such object: {bucket}/{source_blob_name}")
-
-    # Read the PDF file from GCS
-    pdf_bytes = read_pdf_from_gcs(bucket, source_blob_name)
-
-    # Open the PDF file from bytes
-    pdf_document = fitz.open(stream=io.BytesIO(pdf_bytes), filetype="pdf")
-    md_text = pymupdf4llm.to_markdown(doc=pdf_document, page_chunks=True)
+    # Read the PDF file from GCS, raises FileNotFoundError if the object does not exist
+    return read_pdf_from_gcs(bucket, source_blob_name)
+
+def content_hash(data):
+    """Returns the SHA-256 hash of the content, used to find identical files and images."""
+    return hashlib.sha256(data).hexdigest()
+
+def read_pdf(pdf_bytes, file_body):
+    """Opens the PDF once and extracts its images and page markdown without uploading anything.
+    Args:
+        pdf_bytes (bytes): The PDF content.
+        file_body (str): File name without extension, used to name the images.
+    Returns:
+        tuple: Image dictionaries with name, page, data and content_hash, and the page markdown chunks.
+    """
+    with span("pdf.parse", bytes=len(pdf_bytes)) as parse_span:
+        # Open the PDF file from bytes
+        pdf_document = fitz.open(stream=io.BytesIO(pdf_bytes), filetype="pdf")
+        try:
+            images = list(iterate_pdf_images(pdf_document, file_body))
+            md_text = pymupdf4llm.to_markdown(doc=pdf_document, page_chunks=True)
+        finally:
+            pdf_document.close()
+        parse_span.set(pages=len(md_text), images=len(images))
+    count("bytes", len(pdf_bytes), stage="pdf.parse")
+    count("pages", len(md_text), stage="pdf.parse")
+    return images, md_text
+
+def split_pdf_to_chunks(driver, bucket, folder_name, file_body, extension, image_list, md_text=None, image_texts=None, completed_pages=(), chunk_name=None,
+                        store=None):
+    # The Chunk functions of src.graphdb, unless the caller passes another store such as the benchmark graph
+    store = graphdb if store is None else store
+    # The pages are stored under the unique chunk name of the document when it is given
+    if chunk_name is None:
+        chunk_name = f"{file_body}{extension}"
+    if md_text is None:
+        # Open the PDF file from bytes
+        pdf_bytes = load_pdf_bytes(bucket, folder_name, file_body, extension)
+        with fitz.open(stream=io.BytesIO(pdf_bytes), filetype="pdf") as pdf_document:
+            md_text = pymupdf4llm.to_markdown(doc=pdf_document, page_chunks=True)
     number_of_pages = len(md_text)
 
     # Create a dictionary to map page numbers to their respective image names
@@ -28,8 +59,12 @@ def split_pdf_to_chunks(driver, bucket, folder_name, file_body, extension, image
     for image_name, page_number in image_list:
         if page_number not in page_images:
             page_images[page_number] = []
-        page_images[page_number].append(get_image_text_short_by_chunk_name(driver, image_name))
+        if image_texts is not None:
+            page_images[page_number].append(image_texts.get(image_name) or "")
+        else:
+            page_images[page_number].append(store.get_image_text_short_by_chunk_name(driver, image_name))
 
+    chunks = []
     for i in range(number_of_pages):
         prev_text = md_text[i-1]['text'][-1500:] if i > 0 else ""
         next_text = md_text[i+1]['text'][:1500] if i < number_of_pages-1 else ""
@@ -40,34 +75,26 @@ def split_pdf_to_chunks(driver, bucket, folder_name, file_body, extension, image
 
         # Append image names to the chunk if there are images on the current page
         if current_page_number in page_images:
-            image_texts = "\n".join(page_images[current_page_number])
-            chunk += f"\n\nImages on this page:\n{image_texts}"
+            page_image_text = "\n".join(page_images[current_page_number])
+            chunk += f"\n\nImages on this page:\n{page_image_text}"
         chunk += "\n\n" + md_text[i]['text'] + next_text
-
-        create_and_return_chunk(driver, f"{file_body}{extension}", folder_name, status="new", element=i)
-        embedding_string = generate_embedding(chunk)
-        update_chunk(driver, f"{file_body}{extension}", chunk, embedding_string, element = i, chunk_type="text")
-    create_consecutive_relationships(driver, folder_name, f"{file_body}{extension}")
+        chunks.append(chunk)
+
+    # Pages embedded before an interrupted ingestion are not embedded again
+    pending = [i for i in range(number_of_pages) if i not in completed_pages]
+
+    # Embed all pages in as few requests as the model allows and write them in bulk
+    embeddings = generate_embeddings([chunks[i] for i in pending])
+    store.write_chunks(driver, [
+        {"name": chunk_name, "folder": folder_name, "element": i, "text": chunks[i], "embedding_string": embedding_string, "chunk_type": "text", "status": "embedded"}
+        for i, embedding_string in zip(pending, embeddings)
+    ])
+    store.create_consecutive_relationships(driver, folder_name, chunk_name)
+    store.set_chunk_status(driver, folder_name, chunk_name, "linked")
   
 
 
-def extract_images_from_pdf(bucket, folder_name, file_body, extension):
-    # Construct the GCS path
-    source_blob_name = f"{folder_name}/{file_body}{extension}"
-
-    # List objects in the bucket to verify the presence of the file
-    objects = list_objects_in_bucket(bucket)
-    if source_blob_name not in objects:
-        raise FileNotFoundError(f"No such object: {bucket}/{source_blob_name}")
-
-    # Read the PDF file from GCS
-    pdf_bytes = read_pdf_from_gcs(bucket, source_blob_name)
-
-    # Open the PDF file from bytes
-    pdf_document = fitz.open(stream=io.BytesIO(pdf_bytes), filetype="pdf")
-
-    images = []
-
+def iterate_pdf_images(pdf_document, file_body):
     # Iterate through each page
     for page_number in range(len(pdf_document)):
         page = pdf_document.load_page(page_number)
@@ -80,9 +107,5 @@ def extract_images_from_pdf(bucket, folder_name, file_body, extension):
             image_bytes = base_image["image"]
             image_ext = base_image["ext"]
             image_filename = f"{file_body}_image_{page_number+1}_{image_index+1}.{image_ext}"
-            images.append((image_filename, page_number + 1))  # Include page number in the tuple
-            # Save the image
-            upload_file_to_folder(bucket, folder_name, image_bytes, image_filename, 'string')
-
-    return images
-
+            # Include page number and content hash with the image
+            yield {"name": image_filename, "page": page_number + 1, "data": image_bytes, "content_hash": content_hash(image_bytes)}
@@ -1,12 +1,15 @@
 import os
 import streamlit as st
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part
-from src.graphdb import get_list_of_nodes, generate_unique_chunk_name, create_and_return_chunk, create_chunk_and_relationship, update_chunk, get_chunk_attributes
+from concurrent.futures import ThreadPoolExecutor
+from src.graphdb import get_list_of_nodes, generate_unique_chunk_name, create_and_return_chunk, create_chunk_and_relationship, get_chunk_attributes, find_chunks_by_hash, get_node_states, set_node_in_query
 from datetime import datetime
-from src.gcputils import create_folder, upload_file_to_folder, get_image_from_gcp
-from src.documents import extract_images_from_pdf, split_pdf_to_chunks
-from src.utils import get_substring_before_keyword, retrieve_relevant_documents, retrieve_relevant_images, generate_embedding
+from src.gcputils import create_folder, upload_file_to_folder
+from src.cache import answer_cache
+from src.documents import content_hash
+from src.telemetry import span, count, record_usage
+from src.resources import get_generative_model, get_thumbnail_cache
+from src.jobs import JobQueue, start_workers, new_batch_id, sync_embedding_index
+from src.utils import get_substring_before_keyword, retrieve_context, generate_embedding
 import keys
 
 GEMINI_MODEL = keys.GEMINI_MODEL
@@ -18,12 +21,9 @@ FIRESTORE_URL = keys.FIRESTORE_URL
 FIRESTORE_API_KEY = keys.FIRESTORE_API_KEY
 GCP_PROJECT_ID = keys.GCP_PROJECT_ID
 GCP_LOCATION = keys.GCP_LOCATION
+STREAM_RESPONSES = keys.STREAM_RESPONSES
 
 
-vertexai.init(project=GCP_PROJECT_ID, location=GCP_LOCATION)
-model = GenerativeModel(GEMINI_MODEL)
-model_image = GenerativeModel(GEMINI_IMAGE_MODEL)
-
 # Set up the page configuration
 st.set_page_config(layout="wide")
 
@@ -43,6 +43,7 @@ def initialize_session_parameters():
     st.session_state.document_names = []
     st.session_state.new_parent = []
     st.session_state.unique_id = ""
+    st.session_state.ingestion_batch = ""
 
 
 def sidebar_menus():
@@ -62,9 +63,29 @@ def sidebar_menus():
         if st.sidebar.button("Clear Chat history", type="primary"):
             st.session_state.pop("chat", None)
 
+def retrieval_scope(driver):
+    """Shows the parent selection of the chat in the sidebar.
+    Returns:
+        dict: The parents a question is restricted to, or None to search every parent that is switched on.
+    """
+    if "node_states" not in st.session_state:
+        st.session_state.node_states = get_node_states(driver)
+    node_states = st.session_state.node_states
+    nodes = st.sidebar.multiselect("Search only these parents:", list(node_states), key="scope_nodes")
+    # Switching a parent off only writes its Node, the index skips its documents when it searches
+    with st.sidebar.expander("Parents used in retrieval"):
+        for node, in_query in node_states.items():
+            checked = st.checkbox(node, value=in_query, key=f"in_query_{node}")
+            if checked != in_query:
+                set_node_in_query(driver, node, checked)
+                node_states[node] = checked
+    return {"nodes": nodes} if nodes else None
+
 def create_relationships_for_chunks(driver, chunks, node_name):
     for chunk_name in chunks:
         create_chunk_and_relationship(driver, chunk_name, node_name)
+    # Reload the parents shown in the chat sidebar
+    st.session_state.pop("node_states", None)
 
 def create_relationships(driver):
 
@@ -85,85 +106,13 @@ def create_relationships(driver):
                 st.session_state.files = "ready"
 
 
-def describe_image(image_file, file_extension, model):
-    try:
-        text_prompt = """Give overall headline for the image and one line description. Then read the text in the image and output the text in detail. If the image is a spreadsheet then output what you see in JSON format and extract table info from the image. If you are not able to extract JSON then output only text."""
-
-        # Validate file extension
-        if file_extension not in ['.png', '.jpg', '.jpeg']:
-            raise ValueError("Unsupported file extension. Please use '.png', '.jpg', or '.jpeg'.")
-
-        # Determine MIME type
-        if file_extension == '.png':
-            mime_type = "image/png"
-        else:
-            mime_type = "image/jpg"
-
-        # Create image file part
-        image_file = Part.from_uri(
-            uri=image_file,
-            mime_type=mime_type,
-        )
-
-        prompt = [text_prompt, image_file]
-        generation_config = {
-                "max_output_tokens" : st.session_state.max_tokens,
-                "temperature" : st.session_state.temperature,
-                "top_p" : st.session_state.top_p,
-                "top_k" : st.session_state.top_k
-            }
-        # Generate content
-        response = model_image.generate_content(prompt, generation_config=generation_config)
-        return response.text
-
-    except ValueError as ve:
-        print(f"Procedure describe_image: ValueError: {ve}")
-        return None
-    except AttributeError as ae:
-        print(f"Procedure describe_image: AttributeError: {ae}. Check if 'Part' and 'model' are correctly defined and used.")
-        return None
-    except Exception as e:
-        print(f"Procedure describe_image: An error occurred: {e}")
-        return None
-
-
-def describe_image_short(image_file, file_extension, model):
-    try:
-        text_prompt = """Read the text of the image and create a one-sentence summary of the image's content."""
-
-        # Validate file extension
-        if file_extension not in ['.png', '.jpg', '.jpeg']:
-            raise ValueError("Unsupported file extension. Please use '.png', '.jpg', or '.jpeg'.")
-
-        # Determine MIME type
-        if file_extension == '.png':
-            mime_type = "image/png"
-        else:
-            mime_type = "image/jpg"
-
-        # Create image file part
-        image_file = Part.from_uri(
-            uri=image_file,
-            mime_type=mime_type,
-        )
-
-        prompt = [text_prompt, image_file]
-        generation_config = {
-                "max_output_tokens" : st.session_state.max_tokens,
-                "temperature" : st.session_state.temperature,
-                "top_p" : st.session_state.top_p,
-                "top_k" : st.session_state.top_k
-            }
-        # Generate content
-        response = model_image.generate_content(prompt, generation_config=generation_config)
-        return response.text
-
-    except ValueError as ve:
-        print(f"Procedure describe_image_short: ValueError: {ve}")
-        return None
-    except Exception as e:
-        print(f"Procedure describe_image_short: An error occurred: {e}")
-        return None
+def get_generation_config():
+    return {
+            "max_output_tokens" : st.session_state.max_tokens,
+            "temperature" : st.session_state.temperature,
+            "top_p" : st.session_state.top_p,
+            "top_k" : st.session_state.top_k
+        }
 
 def upload_files(driver):
     with st.session_state.container.container():
@@ -179,49 +128,70 @@ def upload_files(driver):
                 st.session_state.numb_of_files = len(uploaded_files)
                 status_container = st.empty()
                 st.session_state.document_names = []
+                # Describing, embedding and storing run in the background ingestion workers
+                queue = start_workers()
+                st.session_state.ingestion_batch = new_batch_id()
+                generation_config = get_generation_config()
                 with status_container.container():
                     for file in uploaded_files:
                         file_name_body = os.path.splitext(file.name.lower())[0].strip()
                         file_extension = os.path.splitext(file.name.lower())[1].strip()
                         file_name = file_name_body + file_extension
-                        # Upload the file to the folder
-                        st.write(f"Uploading file {file_name}")
-                        upload_file_to_folder(GCP_BUCKET, st.session_state.folder_name, file, file_name)
+                        file_bytes = file.getvalue()
+                        file_hash = content_hash(file_bytes)
+                        # A file with identical content reuses the GCS object that is already stored
+                        existing = find_chunks_by_hash(driver, [file_hash]).get(file_hash)
+                        if existing:
+                            st.write(f"The file {file_name} has the same content as {existing['blob']}, the stored file is reused")
+                            blob = existing["blob"]
+                        else:
+                            # Upload the file to the folder, keeping its bytes for parsing
+                            st.write(f"Uploading file {file_name}")
+                            upload_file_to_folder(GCP_BUCKET, st.session_state.folder_name, file_bytes, file_name, 'string')
+                            blob = f"{st.session_state.folder_name}/{file_name}"
                         unique_chunk_name = generate_unique_chunk_name(driver, file_name_body, file_extension)
                         if unique_chunk_name != file_name:
                             st.write(f"The file with same name {file_name} already exists on the database. The file is renamed to {unique_chunk_name}")
-                        chunk_name = create_and_return_chunk(driver, unique_chunk_name, st.session_state.folder_name, "new")
-                        if file_extension in ('.png', '.jpg', '.jpeg'):
-                            image_text = describe_image(f"gs://{GCP_BUCKET}/{st.session_state.folder_name}/{file_name}", file_extension, model)
-                            embedding_string = generate_embedding(image_text)
-                            update_chunk(driver, chunk_name, image_text, embedding_string)
-                        elif file_extension in ('.pdf'):
-                            image_list = extract_images_from_pdf(GCP_BUCKET, st.session_state.folder_name, file_name_body, file_extension) 
-                            for image_name, page_number in image_list:
-                                image_extension = os.path.splitext(image_name.lower())[1]
-                                image_text = describe_image(f"gs://{GCP_BUCKET}/{st.session_state.folder_name}/{image_name}", image_extension, model)
-                                image_text_short = describe_image_short(f"gs://{GCP_BUCKET}/{st.session_state.folder_name}/{image_name}", image_extension, model)
-                                embedding_string = generate_embedding(image_text)
-                                chunk_image_name = create_and_return_chunk(driver, image_name, st.session_state.folder_name, "new", element=-1)
-                                update_chunk(driver, chunk_image_name, image_text, embedding_string, parent_chunk = chunk_name, element = -1, chunk_type="pdf_image", text_short=image_text_short)
-                            split_pdf_to_chunks(driver, GCP_BUCKET, st.session_state.folder_name, file_name_body, file_extension, image_list)    
+                        chunk_name = create_and_return_chunk(driver, unique_chunk_name, st.session_state.folder_name, "uploaded", content_hash=file_hash, blob=blob)
+                        # Images are read from GCS by the model, PDFs are parsed from the spooled bytes
+                        queue.enqueue(st.session_state.ingestion_batch, st.session_state.folder_name, file_name_body, file_extension, chunk_name,
+                                      generation_config, file_bytes=file_bytes if file_extension == '.pdf' else None)
                         st.session_state.document_names.append(chunk_name)
                 status_container.empty()
                 st.session_state.files = "load_ready"
 
+@st.fragment(run_every=2)
+def show_ingestion_progress():
+    jobs = JobQueue().batch_jobs(st.session_state.ingestion_batch)
+    if not jobs:
+        return
+    st.subheader("Processing files")
+    for job in jobs:
+        if job["status"] == "failed":
+            st.error(f"{job['chunk_name']}: failed: {job['error']}")
+        elif job["status"] == "done":
+            st.progress(1.0, text=f"{job['chunk_name']}: done")
+        else:
+            st.progress(job["progress"], text=f"{job['chunk_name']}: {job['stage']}")
+    # Failed files resume from their last checkpoint
+    if any(job["status"] == "failed" for job in jobs) and st.button("Retry failed files"):
+        JobQueue().retry_failed(st.session_state.ingestion_batch)
+
 def streamlit_role(role):
   if role == "model":
     return "assistant"
   else:
     return role
   
-def plot_images(driver, chunk_names):
-    chunk_attributes = get_chunk_attributes(driver, chunk_names)
-    for chunk in chunk_attributes:
-        folder = chunk["folder"]
-        name = chunk["name"]
-        image = get_image_from_gcp(GCP_BUCKET, folder, name)
-        st.image(image, caption=f"{folder}/{name}", width=300)
+def plot_images(driver, images):
+    # Retrieval returns the image attributes; chat histories from older sessions only hold the names
+    if images and isinstance(images[0], str):
+        images = get_chunk_attributes(driver, images)
+    # Images with identical content share one GCS object, and its display-size thumbnail is cached
+    thumbnails = get_thumbnail_cache().get_many(GCP_BUCKET, [chunk["blob"] for chunk in images])
+    for chunk, thumbnail in zip(images, thumbnails):
+        if thumbnail is not None:
+            st.image(thumbnail, caption=f"{chunk['folder']}/{chunk['name']}", width=300)
 
 def role_to_streamlit(role):
     if role == 'user':
@@ -250,7 +220,21 @@ def remove_image_roles(data_list):
     """
     return [entry for entry in data_list if entry.get('role') != 'image']
 
+def stream_text(response):
+    """Yields the text of a streamed Gemini response, skipping chunks that carry no text."""
+    chunk = None
+    for chunk in response:
+        try:
+            yield chunk.text
+        except ValueError as e:
+            print(f"Procedure stream_text: Response chunk without text: {e}")
+    # The last chunk of a stream carries the token usage of the whole response
+    if chunk is not None:
+        record_usage(chunk, "generate_content")
+
 def show_chat(driver):
+    # Created on first use in the process and shared by every session and rerun
+    model = get_generative_model(GEMINI_MODEL)
 
     # select chat window as Gemini
     st.header("Chat with your Data", divider="rainbow")       
@@ -260,7 +244,11 @@ def show_chat(driver):
     if "chat" not in st.session_state:
         sys_instructions = """You are an AI assistant and give good and precise answers to user's questions."""
         st.session_state.chat = model.start_chat(history = [])
+    scope = retrieval_scope(driver)
  
+    # Load the thumbnails of the whole conversation in parallel before it is replayed
+    get_thumbnail_cache().prefetch(GCP_BUCKET, [chunk["blob"] for message in st.session_state.chat.history
+                                          if message['role'] == 'image' for chunk in message['text'] if isinstance(chunk, dict)])
     for message in st.session_state.chat.history:
         display_function = role_to_streamlit(message['role'])
         if message['role'] == 'image':
@@ -273,27 +261,42 @@ def show_chat(driver):
     if prompt := st.chat_input("What would you like to know?"):
         st.chat_message("user").text(prompt)
                 
-        generation_config = {
-                "max_output_tokens" : st.session_state.max_tokens,
-                "temperature" : st.session_state.temperature,
-                "top_p" : st.session_state.top_p,
-                "top_k" : st.session_state.top_k
-            }
+        generation_config = get_generation_config()
+        # Pick up the chunks that the background ingestion workers have written
+        sync_embedding_index(driver, JobQueue())
         query_embedding = generate_embedding(prompt)
-        documents, score = retrieve_relevant_documents(driver, query_embedding, top_k=5)
-        image_text, chunk_names = retrieve_relevant_images(driver, query_embedding, score, top_k=3)
-        documents_string = "\n".join(documents)
-        documents_string += "\n".join(image_text)
-        prompt_template = f"CONTEXT: {documents_string}\n\nCONVERSATION HISTORY: {remove_image_roles(st.session_state.chat.history)}\n\nQUESTION: {prompt}"
-        response = model.generate_content(prompt_template,generation_config=generation_config)
-                
-    # Display the response
-        with st.chat_message("assistant"):
-            st.markdown(response.text)   
-        plot_images(driver, chunk_names) 
+        history = remove_image_roles(st.session_state.chat.history)
+        # A question close enough to an earlier one after the same conversation is answered
+        # from the answer cache without retrieval or a model call
+        cached = answer_cache.get(query_embedding, generation_config, scope, history)
+        count("cache.hits" if cached is not None else "cache.misses", cache="answer")
+        if cached is not None:
+            answer, images = cached
+            with st.chat_message("assistant"):
+                st.markdown(answer)
+        else:
+            documents, image_text, images = retrieve_context(driver, query_embedding, top_k=5, top_k_images=3, **(scope or {}))
+            documents_string = "\n".join(documents)
+            documents_string += "\n".join(image_text)
+            prompt_template = f"CONTEXT: {documents_string}\n\nCONVERSATION HISTORY: {history}\n\nQUESTION: {prompt}"
+            # Fetch the image thumbnails while the answer is generated
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                executor.submit(get_thumbnail_cache().prefetch, GCP_BUCKET, [chunk["blob"] for chunk in images])
+                with st.chat_message("assistant"), span("gemini.generate_content", stream=STREAM_RESPONSES):
+                    if STREAM_RESPONSES:
+                        # Render the answer as it is generated
+                        response = model.generate_content(prompt_template, generation_config=generation_config, stream=True)
+                        answer = st.write_stream(stream_text(response))
+                    else:
+                        response = model.generate_content(prompt_template,generation_config=generation_config)
+                        record_usage(response, "generate_content")
+                        answer = response.text
+                        st.markdown(answer)
+            answer_cache.put(query_embedding, answer, images, generation_config, scope, history)
+        plot_images(driver, images) 
         add_history_section(st.session_state.chat.history, "user", prompt)
-        add_history_section(st.session_state.chat.history, "model", response.text)
-        add_history_section(st.session_state.chat.history, "image", chunk_names)
+        add_history_section(st.session_state.chat.history, "model", answer)
+        add_history_section(st.session_state.chat.history, "image", images)
 
 
 
@@ -305,6 +308,9 @@ def streamlit_ui(driver):
         initialize_session_parameters()
         st.session_state.container = st.empty()
 
+    # Start the ingestion workers, or restart them if they have died, and resume queued jobs
+    start_workers()
+
     sidebar_menus()
     if st.session_state.chosen_id == "Chat with your Data":
         if st.session_state.chosen_id != st.session_state.chosen_id_prev:
@@ -332,4 +338,6 @@ def streamlit_ui(driver):
             st.session_state.chunk_list = []
             st.session_state.container.empty()
             st.header("Upload Files to RAG", divider="rainbow") 
-            st.write("Files have been processed.")
+            st.write("Files have been queued for processing.")
+        if st.session_state.get("ingestion_batch"):
+            show_ingestion_progress()
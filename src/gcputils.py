@@ -1,31 +1,147 @@
 from google.cloud import storage
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+import google.auth
 import io
+import mimetypes
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
+from src.telemetry import span, count
 import keys
 
 GCP_SERVICE_ACCOUNT = keys.GCP_SERVICE_ACCOUNT
+GCP_PROJECT_ID = keys.GCP_PROJECT_ID
+GCS_LOCAL_ROOT = keys.GCS_LOCAL_ROOT
+GCS_MAX_WORKERS = keys.GCS_MAX_WORKERS
 
-def list_objects_in_bucket(bucket_name):
-    """Lists all the objects in the bucket."""
-    storage_client = storage.Client()
+_client = None
+_client_lock = threading.Lock()
+
+
+class LocalBlob:
+    """Filesystem-backed stand-in for google.cloud.storage.Blob."""
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.path, *name.split("/"))
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def download_as_bytes(self):
+        if not self.exists():
+            raise FileNotFoundError(f"No such object: {self.bucket.name}/{self.name}")
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def upload_from_string(self, data, content_type=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        # Folder placeholders end with a slash and only need the directory
+        if self.name.endswith("/"):
+            return
+        with open(self.path, "wb") as f:
+            f.write(data)
+
+    def upload_from_file(self, file, content_type=None):
+        self.upload_from_string(file.read(), content_type=content_type)
+
+
+class LocalBucket:
+    """Filesystem-backed stand-in for google.cloud.storage.Bucket."""
+
+    def __init__(self, root, name):
+        self.name = name
+        self.path = os.path.join(root, name)
+
+    def blob(self, blob_name):
+        return LocalBlob(self, blob_name)
+
+    def list_blobs(self, prefix=None):
+        for directory, _, files in os.walk(self.path):
+            for file_name in files:
+                name = os.path.relpath(os.path.join(directory, file_name), self.path).replace(os.sep, "/")
+                if prefix is None or name.startswith(prefix):
+                    yield LocalBlob(self, name)
+
+
+class LocalStorageClient:
+    """Filesystem-backed stand-in for google.cloud.storage.Client, rooted at a local directory."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def bucket(self, bucket_name):
+        return LocalBucket(self.root, bucket_name)
+
+    def get_bucket(self, bucket_name):
+        bucket = self.bucket(bucket_name)
+        if not os.path.isdir(bucket.path):
+            raise FileNotFoundError(f"No such bucket: {bucket_name}")
+        return bucket
+
+    def create_bucket(self, bucket_name):
+        bucket = self.bucket(bucket_name)
+        os.makedirs(bucket.path, exist_ok=True)
+        return bucket
+
+
+def create_storage_client():
+    """Creates a storage client for GCS, a GCS emulator or a local directory."""
+    # A local directory stands in for GCS in development and tests
+    if GCS_LOCAL_ROOT:
+        return LocalStorageClient(GCS_LOCAL_ROOT)
+
+    # The client library sends requests to STORAGE_EMULATOR_HOST when it is set
+    if os.getenv("STORAGE_EMULATOR_HOST"):
+        from google.auth.credentials import AnonymousCredentials
+        return storage.Client(project=GCP_PROJECT_ID, credentials=AnonymousCredentials())
+
+    # The client sends its requests through this session, whose connection pool is
+    # sized for the parallel uploads of upload_files_to_folder and the thumbnail downloads
+    credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+    session = AuthorizedSession(credentials)
+    session.mount("https://", HTTPAdapter(pool_connections=GCS_MAX_WORKERS, pool_maxsize=GCS_MAX_WORKERS))
+    return storage.Client(project=project, credentials=credentials, _http=session)
+
+
+def get_storage_client():
+    """Returns the process-wide storage client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = create_storage_client()
+    return _client
+
+
+def list_objects_in_bucket(bucket_name, prefix=None):
+    """Lists the objects in the bucket, optionally only those under a prefix."""
+    storage_client = get_storage_client()
     bucket = storage_client.bucket(bucket_name)
-    blobs = bucket.list_blobs()
+    blobs = bucket.list_blobs(prefix=prefix)
     return [blob.name for blob in blobs]
 
 def read_pdf_from_gcs(bucket_name, source_blob_name):
     """Reads a PDF file from GCS and returns it as a bytes object."""
-    storage_client = storage.Client()
+    storage_client = get_storage_client()
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(source_blob_name)
-    if not blob.exists():
-        raise FileNotFoundError(f"No such object: {bucket_name}/{source_blob_name}")
-    pdf_bytes = blob.download_as_bytes()
+    with span("gcs.download", blob=source_blob_name):
+        if not blob.exists():
+            raise FileNotFoundError(f"No such object: {bucket_name}/{source_blob_name}")
+        pdf_bytes = blob.download_as_bytes()
+    count("bytes", len(pdf_bytes), stage="gcs.download")
     return pdf_bytes
 
 def create_bucket(bucket_name):
     """Creates a new bucket."""
-    # Initialize a client
-    storage_client = storage.Client()
+    # Get the shared client
+    storage_client = get_storage_client()
 
     # Create a new bucket
     bucket = storage_client.create_bucket(bucket_name)
@@ -33,11 +149,11 @@ def create_bucket(bucket_name):
 
 def create_folder(bucket_name, folder_name):
     """Creates a folder-like structure within a bucket."""
-    # Initialize a client
-    storage_client = storage.Client()
+    # Get the shared client
+    storage_client = get_storage_client()
 
     # Get the bucket
-    bucket = storage_client.get_bucket(bucket_name)
+    bucket = storage_client.bucket(bucket_name)
 
     # Create a blob with the folder name and a trailing slash
     blob = bucket.blob(f"{folder_name}/")
@@ -47,25 +163,44 @@ def create_folder(bucket_name, folder_name):
 
 def upload_file_to_folder(bucket_name, folder_name, file, file_name, type='file'):
     """Uploads a file to a specified folder within a bucket."""
-    # Initialize a client
-    storage_client = storage.Client()
+    # Get the shared client
+    storage_client = get_storage_client()
 
     # Get the bucket
-    bucket = storage_client.get_bucket(bucket_name)
+    bucket = storage_client.bucket(bucket_name)
 
     # Create a blob with the folder name and file name
     blob = bucket.blob(f"{folder_name}/{file_name}")
 
     # Upload the file content
-    if type == 'file':
-        blob.upload_from_file(file)
-    else:
-        blob.upload_from_string(file)
+    with span("gcs.upload", blob=blob.name):
+        if type == 'file':
+            blob.upload_from_file(file)
+        else:
+            # Bytes carry no content type, so guess it from the file name
+            blob.upload_from_string(file, content_type=mimetypes.guess_type(file_name)[0] or "application/octet-stream")
+            count("bytes", len(file), stage="gcs.upload")
+
+def upload_files_to_folder(bucket_name, folder_name, files, max_workers=GCS_MAX_WORKERS):
+    """Uploads many byte strings to a folder in parallel.
+    Args:
+        bucket_name (str): The bucket name.
+        folder_name (str): The folder within the bucket.
+        files (list): (file_name, data) tuples.
+        max_workers (int): Maximum number of concurrent uploads.
+    """
+    if not files:
+        return
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(files))) as executor:
+        # list() re-raises the first upload error
+        list(executor.map(lambda item: upload_file_to_folder(bucket_name, folder_name, item[1], item[0], 'string'), files))
 
 def get_image_from_gcp(bucket_name, folder, file_name):
-    client = storage.Client()
+    client = get_storage_client()
     bucket = client.bucket(bucket_name)
     blob = bucket.blob(f"{folder}/{file_name}")
-    image_data = blob.download_as_bytes()
+    with span("gcs.download", blob=blob.name):
+        image_data = blob.download_as_bytes()
+    count("bytes", len(image_data), stage="gcs.download")
     image = Image.open(io.BytesIO(image_data))
-    return image
\ No newline at end of file
+    return image
@@ -1,12 +1,210 @@
+import json
+from src.cache import answer_cache
+from src.index import embedding_index, encode_embedding, to_vector
+from src.schema import ensure_schema
+from src.queries import (UPDATE_CHUNK, CHECK_CHUNK_EXISTS, ALLOCATE_CHUNK_NAME, GET_IMAGE_TEXT_SHORT, GET_CHUNKS,
+                         GET_CHUNK_ATTRIBUTES, CREATE_AND_RETURN_CHUNK, LINK_CONSECUTIVE_CHUNKS, FIND_CHUNKS_BY_HASH, CREATE_NODE)
+from src.telemetry import traced, count
 import keys
 
 GCP_BUCKET = keys.GCP_BUCKET
+RETRIEVAL_BACKEND = keys.RETRIEVAL_BACKEND
+EMBEDDING_DIMENSIONS = keys.EMBEDDING_DIMENSIONS
+VECTOR_QUERY_CANDIDATES = keys.VECTOR_QUERY_CANDIDATES
+CHUNK_WRITE_BATCH_SIZE = keys.CHUNK_WRITE_BATCH_SIZE
+
+VECTOR_INDEX_NAME = "chunk_embedding"
+# The float list copy of each embedding in Chunk.embedding_string is only kept for the Neo4j
+# vector index. The other backends read the binary copy in Chunk.embedding.
+STORE_EMBEDDING_LISTS = RETRIEVAL_BACKEND == "neo4j"
 
 # initialize graph database 
 def initialize_grapdb(driver):
     # create constraint for nodes if already not exist
     with driver.session() as session:
         session.run("CREATE CONSTRAINT unique_node IF NOT EXISTS FOR (node:Node) REQUIRE node.nodename IS UNIQUE")
+        # constraints backing the chunk name allocation in generate_unique_chunk_name
+        session.run("CREATE CONSTRAINT unique_name_counter IF NOT EXISTS FOR (counter:NameCounter) REQUIRE counter.name IS UNIQUE")
+        session.run("CREATE CONSTRAINT unique_chunk_name IF NOT EXISTS FOR (chunk_name:ChunkName) REQUIRE chunk_name.name IS UNIQUE")
+        # one Migration node per data migration records that it has run
+        session.run("CREATE CONSTRAINT unique_migration IF NOT EXISTS FOR (migration:Migration) REQUIRE migration.name IS UNIQUE")
+    # create and verify the indexes used by the Chunk and Node lookups
+    ensure_schema(driver)
+    # store a binary copy of embeddings written before Chunk.embedding existed
+    migrate_embedding_binary(driver)
+    # drop or restore the float list copies when the retrieval backend has changed
+    sync_embedding_lists(driver)
+    if RETRIEVAL_BACKEND == "neo4j":
+        create_vector_index(driver)
+
+def create_vector_index(driver, dimensions=EMBEDDING_DIMENSIONS):
+    """Creates the native vector index on Chunk.embedding_string and converts legacy JSON string embeddings to float lists."""
+    migrate_embedding_strings(driver)
+    with driver.session() as session:
+        session.run(
+            f"CREATE VECTOR INDEX {VECTOR_INDEX_NAME} IF NOT EXISTS "
+            "FOR (c:Chunk) ON (c.embedding_string) "
+            f"OPTIONS {{indexConfig: {{`vector.dimensions`: {int(dimensions)}, `vector.similarity_function`: 'cosine'}}}}"
+        )
+
+def get_migration(session, name):
+    """Returns the value recorded by a data migration, or None if it has not run."""
+    record = session.run("MATCH (m:Migration {name: $name}) RETURN m.value AS value", name=name).single()
+    return record["value"] if record else None
+
+def set_migration(session, name, value=True):
+    """Records that a data migration has run, so later starts skip its scan over every chunk."""
+    session.run("MERGE (m:Migration {name: $name}) SET m.value = $value", name=name, value=value).consume()
+
+def migrate_embedding_strings(driver, batch_size=500):
+    """Rewrites embedding_string properties stored as JSON strings as float lists so the vector index can use them."""
+    with driver.session() as session:
+        if get_migration(session, "embedding_strings"):
+            return 0
+        # STARTS WITH is null for list values, so only string embeddings are returned
+        query = (
+            "MATCH (c:Chunk) "
+            "WHERE c.embedding_string STARTS WITH '[' "
+            "RETURN elementId(c) AS id, c.embedding_string AS embedding_string"
+        )
+        rows = []
+        for record in session.run(query):
+            try:
+                rows.append({"id": record["id"], "embedding": [float(value) for value in json.loads(record["embedding_string"])]})
+            except (json.JSONDecodeError, TypeError, ValueError) as e:
+                print(f"Procedure migrate_embedding_strings: Skipping chunk {record['id']}: {e}")
+        for start in range(0, len(rows), batch_size):
+            session.run(
+                "UNWIND $rows AS row "
+                "MATCH (c:Chunk) WHERE elementId(c) = row.id "
+                "SET c.embedding_string = row.embedding",
+                rows=rows[start:start + batch_size]
+            )
+        set_migration(session, "embedding_strings")
+        return len(rows)
+
+def migrate_embedding_binary(driver, batch_size=500):
+    """Adds the binary Chunk.embedding (float32 bytes) and Chunk.embedding_norm to chunks that only have embedding_string.
+
+    Runs once per database; chunks written since then always get the binary copy.
+    """
+    with driver.session() as session:
+        if get_migration(session, "embedding_binary"):
+            return 0
+        query = (
+            "MATCH (c:Chunk) "
+            "WHERE c.embedding_string IS NOT NULL AND c.embedding IS NULL "
+            "RETURN elementId(c) AS id, c.embedding_string AS embedding_string"
+        )
+        rows = []
+        for record in session.run(query):
+            try:
+                embedding, embedding_norm = encode_embedding(record["embedding_string"])
+                rows.append({"id": record["id"], "embedding": embedding, "embedding_norm": embedding_norm})
+            except (TypeError, ValueError) as e:
+                print(f"Procedure migrate_embedding_binary: Skipping chunk {record['id']}: {e}")
+        for start in range(0, len(rows), batch_size):
+            session.run(
+                "UNWIND $rows AS row "
+                "MATCH (c:Chunk) WHERE elementId(c) = row.id "
+                "SET c.embedding = row.embedding, c.embedding_norm = row.embedding_norm",
+                rows=rows[start:start + batch_size]
+            )
+        set_migration(session, "embedding_binary")
+        return len(rows)
+
+def embedding_list(embedding):
+    """Returns the float list to store in Chunk.embedding_string, or None when only the binary copy is kept."""
+    if not STORE_EMBEDDING_LISTS or embedding is None:
+        return None
+    return embedding if isinstance(embedding, list) else to_vector(embedding).tolist()
+
+def sync_embedding_lists(driver, batch_size=500):
+    """Drops the float list copies of the embeddings that have a binary copy, or restores them for the Neo4j vector index.
+
+    Only runs when STORE_EMBEDDING_LISTS differs from the state recorded by the last run.
+    Returns:
+        int: The number of chunks changed.
+    """
+    with driver.session() as session:
+        if get_migration(session, "embedding_lists") == STORE_EMBEDDING_LISTS:
+            return 0
+        changed = 0
+        if STORE_EMBEDDING_LISTS:
+            query = (
+                "MATCH (c:Chunk) "
+                "WHERE c.embedding IS NOT NULL AND c.embedding_string IS NULL "
+                "RETURN elementId(c) AS id, c.embedding AS embedding"
+            )
+            rows = [{"id": record["id"], "embedding": to_vector(record["embedding"]).tolist()} for record in session.run(query)]
+            for start in range(0, len(rows), batch_size):
+                session.run(
+                    "UNWIND $rows AS row "
+                    "MATCH (c:Chunk) WHERE elementId(c) = row.id "
+                    "SET c.embedding_string = row.embedding",
+                    rows=rows[start:start + batch_size]
+                ).consume()
+            changed = len(rows)
+        else:
+            # Remove the lists batch by batch, so no single transaction holds every chunk
+            while True:
+                removed = session.run(
+                    "MATCH (c:Chunk) "
+                    "WHERE c.embedding IS NOT NULL AND c.embedding_string IS NOT NULL "
+                    "WITH c LIMIT $batch_size "
+                    "REMOVE c.embedding_string "
+                    "RETURN count(c) AS removed",
+                    batch_size=batch_size
+                ).single()["removed"]
+                changed += removed
+                if removed < batch_size:
+                    break
+        set_migration(session, "embedding_lists", STORE_EMBEDDING_LISTS)
+        return changed
+
+@traced("neo4j.query_vector_index")
+def query_vector_index(driver, query_embedding, top_k, kind="text", min_score=None, folders=None, nodes=None):
+    """Answers a top-k similarity query with the native vector index.
+    Args:
+        driver: Neo4j driver.
+        query_embedding (list): The query embedding.
+        top_k (int): Maximum number of hits.
+        kind (str): "text" for page and file chunks, "image" for image chunks.
+        min_score (float): Hits must have a cosine similarity of at least this value.
+        folders (list): Only return chunks in these folders.
+        nodes (list): Only return chunks of the documents that are part of these Nodes.
+    Returns:
+        list: Dictionaries with chunk_name, element, text, folder, chunk_type, blob and similarity
+        sorted by descending similarity.
+    """
+    if kind == "text":
+        kind_filter = "c.element <> -1"
+    else:
+        kind_filter = "(c.element = -1 OR c.chunk_type = 'image')"
+    # The index returns (1 + cosine) / 2 for cosine indexes, convert back so the
+    # existing similarity thresholds keep their meaning. Candidates are over-fetched
+    # because the in_query and element filters are applied after the index lookup.
+    # The Nodes of a PDF image are those of its document, which is linked through IMAGE_OF.
+    query = (
+        "CALL db.index.vector.queryNodes($index_name, $candidates, $query_embedding) "
+        "YIELD node AS c, score "
+        "WITH c, 2 * score - 1 AS similarity "
+        f"WHERE c.in_query = true AND {kind_filter} AND ($min_score IS NULL OR similarity >= $min_score) "
+        "WITH c, similarity, coalesce(head([(c)-[:IMAGE_OF]->(p:Chunk) | p.name]), c.name) AS document "
+        "WHERE NOT EXISTS { MATCH (:Chunk {name: document, folder: c.folder})-[:PART_OF]->(n:Node) WHERE n.in_query = false } "
+        "AND ((size($folders) = 0 AND size($nodes) = 0) OR c.folder IN $folders "
+        "OR EXISTS { MATCH (:Chunk {name: document, folder: c.folder})-[:PART_OF]->(n:Node) WHERE n.name IN $nodes }) "
+        "RETURN c.name AS chunk_name, c.element AS element, c.text AS text, c.folder AS folder, "
+        "c.chunk_type AS chunk_type, coalesce(c.blob, c.folder + '/' + c.name) AS blob, similarity "
+        "ORDER BY similarity DESC LIMIT $top_k"
+    )
+    # A scope filters after the index lookup too, so scoped queries fetch more candidates
+    candidates = max(top_k, VECTOR_QUERY_CANDIDATES) * (4 if folders or nodes else 1)
+    with driver.session() as session:
+        result = session.run(query, index_name=VECTOR_INDEX_NAME, candidates=candidates,
+                             query_embedding=[float(value) for value in query_embedding], min_score=min_score, top_k=top_k,
+                             folders=list(folders or []), nodes=list(nodes or []))
+        return result.data()
 
 # Function to get nodes and their BELONGS_TO relationships if they exist
 def get_nodes_and_relationships(driver):
@@ -33,96 +231,281 @@ def get_list_of_nodes(driver):
         node_list.append(node_name)
     return node_list
     
-def create_and_return_chunk(driver, chunk_name, folder_name, status="new", element=0):
+# Ingestion checkpoints recorded in Chunk.status, in the order they are reached
+CHUNK_STATUSES = ["new", "uploaded", "described", "embedded", "linked"]
+# Status of an image the model cannot describe, e.g. in a format Gemini does not read. It has empty
+# text and no embedding, and counts as having completed every stage, so it is not described again.
+SKIPPED_STATUS = "skipped"
+
+def status_reached(status, stage):
+    """Checks whether a chunk with the given status has completed the given ingestion stage."""
+    if status == SKIPPED_STATUS:
+        return True
+    if status not in CHUNK_STATUSES:
+        return False
+    return CHUNK_STATUSES.index(status) >= CHUNK_STATUSES.index(stage)
+
+@traced("neo4j.get_chunk_states")
+def get_chunk_states(driver, folder_name, chunk_names=None):
+    """Returns the ingestion status and stored descriptions of the chunks of a folder.
+    Args:
+        driver: Neo4j driver.
+        folder_name (str): The folder of the chunks.
+        chunk_names (list): Only return these chunks. None returns every chunk of the folder.
+    Returns:
+        dict: (name, element) -> dictionary with status, text, text_short, content_hash and blob.
+    """
     with driver.session() as session:
         query = (
-            "MERGE (c:Chunk {name: $chunk_name, folder: $folder_name, element: $element}) "
-            "ON CREATE SET c.status = $status, c.in_query = True  "
-            "RETURN c.name AS chunk_name"
+            "MATCH (c:Chunk) "
+            "WHERE c.folder = $folder_name AND ($chunk_names IS NULL OR c.name IN $chunk_names) "
+            "RETURN c.name AS name, c.element AS element, c.status AS status, c.text AS text, c.text_short AS text_short, "
+            "c.content_hash AS content_hash, coalesce(c.blob, c.folder + '/' + c.name) AS blob"
         )
-        result = session.run(query, chunk_name=chunk_name, status=status, element=element, folder_name=folder_name)
-        record = result.single()
-        return record["chunk_name"] if record else None
-    
-def create_consecutive_relationships(driver, folder_name, chunk_name):
+        result = session.run(query, folder_name=folder_name, chunk_names=None if chunk_names is None else list(chunk_names))
+        return {(record["name"], record["element"]): record.data() for record in result}
+
+def set_chunk_status(driver, folder_name, chunk_name, status):
+    """Sets the ingestion status of every chunk of a document."""
     with driver.session() as session:
-        # Retrieve all chunks in the specified folder with the specified name, sorted by the element property
         query = (
             "MATCH (c:Chunk {folder: $folder_name, name: $chunk_name}) "
-            "RETURN c ORDER BY c.element"
+            "SET c.status = $status"
         )
-        result = session.run(query, folder_name=folder_name, chunk_name=chunk_name)
-
-        # Collect all chunks
-        chunks = [record["c"] for record in result]
-
-        # Create relationships between consecutive chunks
-        for i in range(len(chunks) - 1):
-            chunk1 = chunks[i]
-            chunk2 = chunks[i + 1]
+        session.run(query, folder_name=folder_name, chunk_name=chunk_name, status=status).consume()
 
-            # Create a relationship from chunk1 to chunk2
-            session.run(
-                "MATCH (c1:Chunk {name: $chunk1_name, folder: $folder_name, element: $chunk1_element}), "
-                "(c2:Chunk {name: $chunk2_name, folder: $folder_name, element: $chunk2_element}) "
-                "MERGE (c1)-[:NEXT]->(c2)",
-                chunk1_name=chunk1["name"], chunk2_name=chunk2["name"],
-                folder_name=folder_name, chunk1_element=chunk1["element"], chunk2_element=chunk2["element"]
-            )
+def create_and_return_chunk(driver, chunk_name, folder_name, status="new", element=0, content_hash=None, blob=None):
+    with driver.session() as session:
+        result = session.run(CREATE_AND_RETURN_CHUNK, chunk_name=chunk_name, status=status, element=element, folder_name=folder_name,
+                             content_hash=content_hash, blob=blob)
+        record = result.single()
+        return record["chunk_name"] if record else None
+    
+@traced("neo4j.link_consecutive_chunks")
+def link_consecutive_chunks(driver, documents, from_element=None):
+    """Creates the NEXT and PREVIOUS relationships between consecutive chunks of many documents in one statement.
+    Args:
+        driver: Neo4j driver.
+        documents (list): (folder_name, chunk_name) tuples identifying the documents.
+        from_element (int): When pages have been appended to an existing document, the first new element.
+            Only the new chunks and the chunk before them are linked. None links the whole document.
+    """
+    with driver.session() as session:
+        session.run(LINK_CONSECUTIVE_CHUNKS, documents=[{"folder": folder, "name": name} for folder, name in documents], from_element=from_element).consume()
 
-            # Create a relationship from chunk2 to chunk1
-            session.run(
-                "MATCH (c1:Chunk {name: $chunk1_name, folder: $folder_name, element: $chunk1_element}), "
-                "(c2:Chunk {name: $chunk2_name, folder: $folder_name, element: $chunk2_element}) "
-                "MERGE (c2)-[:PREVIOUS]->(c1)",
-                chunk1_name=chunk1["name"], chunk2_name=chunk2["name"],
-                folder_name=folder_name, chunk1_element=chunk1["element"], chunk2_element=chunk2["element"]
-            )
+def create_consecutive_relationships(driver, folder_name, chunk_name, from_element=None):
+    # Link the chunks of a single document, sorted by the element property
+    link_consecutive_chunks(driver, [(folder_name, chunk_name)], from_element=from_element)
 
     
-def update_chunk(driver, chunk_name, text, embedding_string, parent_chunk = "", element = 0, chunk_type="image", text_short=""):
+def update_chunk(driver, folder_name, chunk_name, text, embedding_string, parent_chunk = "", element = 0, chunk_type="image", text_short=""):
     with driver.session() as session:
-        query = (
-            "MATCH (c:Chunk {name: $chunk_name, element: $element}) "
-            "SET c.chunk_type = $chunk_type, c.text = $text, c.embedding_string = $embedding_string, c.text_short = $text_short "
-            "RETURN c.name AS chunk_name"
-        )
-        result = session.run(query, element=element, chunk_name=chunk_name, chunk_type=chunk_type, text=text, embedding_string=embedding_string, text_short=text_short)
+        embedding, embedding_norm = encode_embedding(embedding_string) if embedding_string else (None, None)
+        # Chunk names are only unique within a folder, as are the index rows the update is mirrored to
+        result = session.run(UPDATE_CHUNK, element=element, chunk_name=chunk_name, folder_name=folder_name, chunk_type=chunk_type, text=text,
+                             embedding_string=embedding_list(embedding_string) if embedding_string else None,
+                             text_short=text_short, embedding=embedding, embedding_norm=embedding_norm)
+        record = result.single()
+        # Keep the in-memory retrieval index in step with the stored embedding
+        if embedding_string:
+            answer_cache.invalidate()
+        if embedding_index.loaded and embedding_string and record:
+            try:
+                embedding_index.upsert(chunk_name, element, chunk_type, embedding, norm=embedding_norm,
+                                       folder=record["folder"], document=parent_chunk or chunk_name)
+            except ValueError as e:
+                print(f"Procedure update_chunk: Could not index chunk {chunk_name}: {e}")
         if parent_chunk != "":
+            # Images are linked to the document chunk (element 0) of the same folder, as in write_chunks and copy_document_chunks
             create_relationship_query = (
-                "MATCH (c:Chunk {name: $chunk_name}), (n:Chunk {name: $parent_chunk}) "
+                "MATCH (c:Chunk {name: $chunk_name, folder: $folder_name, element: $element}), "
+                "(n:Chunk {name: $parent_chunk, folder: $folder_name, element: 0}) "
                 "MERGE (c)-[:IMAGE_OF]->(n)"
             )
-            session.run(create_relationship_query, chunk_name=chunk_name, parent_chunk=parent_chunk)
-    
-def check_chunk_exists(driver, chunk_name):
+            session.run(create_relationship_query, chunk_name=chunk_name, folder_name=folder_name, element=element, parent_chunk=parent_chunk)
+
+def _write_chunk_batch(tx, chunks):
+    # Properties that are not given keep their stored value, so a chunk can be written stage by stage
+    query = (
+        "UNWIND $chunks AS chunk "
+        "MERGE (c:Chunk {name: chunk.name, folder: chunk.folder, element: chunk.element}) "
+        "ON CREATE SET c.in_query = True "
+        "SET c.status = coalesce(chunk.status, c.status, 'new'), c.chunk_type = coalesce(chunk.chunk_type, c.chunk_type), "
+        "c.text = coalesce(chunk.text, c.text), "
+        # A new embedding replaces the float list as well, which is null unless the Neo4j backend keeps it
+        "c.embedding_string = CASE WHEN chunk.embedding IS NULL THEN c.embedding_string ELSE chunk.embedding_string END, "
+        "c.embedding = coalesce(chunk.embedding, c.embedding), c.embedding_norm = coalesce(chunk.embedding_norm, c.embedding_norm), "
+        "c.text_short = coalesce(chunk.text_short, c.text_short), c.content_hash = coalesce(chunk.content_hash, c.content_hash), "
+        "c.blob = coalesce(chunk.blob, c.blob) "
+        "WITH c, chunk WHERE chunk.parent_chunk IS NOT NULL AND chunk.parent_chunk <> '' "
+        # The image is linked to the document chunk of its own folder only, not to every page of that name
+        "MATCH (n:Chunk {name: chunk.parent_chunk, folder: chunk.folder, element: 0}) "
+        "MERGE (c)-[:IMAGE_OF]->(n)"
+    )
+    tx.run(query, chunks=chunks).consume()
+
+@traced("neo4j.write_chunks")
+def write_chunks(driver, chunks, batch_size=CHUNK_WRITE_BATCH_SIZE):
+    """Creates or updates many chunks with batched UNWIND transactions.
+    Args:
+        driver: Neo4j driver.
+        chunks (list): Dictionaries with name, folder and element, and optionally text, embedding_string (a float
+            list, or the float32 bytes of a reused embedding),
+            chunk_type, text_short, parent_chunk, status, content_hash and blob (the GCS object holding the
+            content when it is shared with another chunk). Missing properties keep their stored value.
+        batch_size (int): Number of chunks written per transaction.
+    """
+    rows = [
+        {
+            "name": chunk["name"],
+            "folder": chunk["folder"],
+            "element": chunk["element"],
+            "text": chunk.get("text"),
+            "embedding_string": chunk.get("embedding_string") or None,
+            "chunk_type": chunk.get("chunk_type"),
+            "text_short": chunk.get("text_short"),
+            "parent_chunk": chunk.get("parent_chunk"),
+            "status": chunk.get("status"),
+            "content_hash": chunk.get("content_hash"),
+            "blob": chunk.get("blob"),
+        }
+        for chunk in chunks
+    ]
+    # Store a binary float32 copy and the norm of each embedding for fast loading and scoring
+    for row in rows:
+        embedding = row["embedding_string"]
+        row["embedding"], row["embedding_norm"] = encode_embedding(embedding) if embedding else (None, None)
+        row["embedding_string"] = embedding_list(embedding) if embedding else None
     with driver.session() as session:
+        for start in range(0, len(rows), batch_size):
+            session.execute_write(_write_chunk_batch, rows[start:start + batch_size])
+    count("chunks", len(rows), stage="neo4j.write_chunks")
+
+    # Keep the in-memory retrieval index and the cached answers in step with the stored embeddings
+    if any(row["embedding"] for row in rows):
+        answer_cache.invalidate()
+    if embedding_index.loaded:
+        for row in rows:
+            if not row["embedding"]:
+                continue
+            try:
+                embedding_index.upsert(row["name"], row["element"], row["chunk_type"] or "text", row["embedding"], norm=row["embedding_norm"],
+                                       folder=row["folder"], document=row["parent_chunk"] or row["name"])
+            except ValueError as e:
+                print(f"Procedure write_chunks: Could not index chunk {row['name']}: {e}")
+
+@traced("neo4j.find_chunks_by_hash")
+def find_chunks_by_hash(driver, content_hashes):
+    """Looks up described chunks with the given content hashes so their descriptions, embeddings and GCS objects can be reused.
+    Returns:
+        dict: content_hash -> dictionary with text, text_short, embedding (float32 bytes or a float list) and blob.
+    """
+    with driver.session() as session:
+        result = session.run(FIND_CHUNKS_BY_HASH, content_hashes=list(content_hashes))
+        return {record["content_hash"]: record.data() for record in result}
+
+def find_document_by_hash(driver, content_hash, folder_name, chunk_name):
+    """Returns (folder, name) of another fully ingested document with the same content hash, or None."""
+    with driver.session() as session:
+        query = (
+            "MATCH (c:Chunk {content_hash: $content_hash, element: 0}) "
+            "WHERE c.status = 'linked' AND NOT (c.folder = $folder_name AND c.name = $chunk_name) "
+            "RETURN c.folder AS folder, c.name AS name LIMIT 1"
+        )
+        record = session.run(query, content_hash=content_hash, folder_name=folder_name, chunk_name=chunk_name).single()
+        return (record["folder"], record["name"]) if record else None
+
+@traced("neo4j.copy_document_chunks")
+def copy_document_chunks(driver, source_folder, source_name, folder_name, chunk_name):
+    """Copies the page texts and embeddings, and the described images, of an identical document to a new document.
+    Returns:
+        int: The number of page and image chunks copied.
+    """
+    with driver.session() as session:
+        query = (
+            "MATCH (s:Chunk {folder: $source_folder, name: $source_name}) "
+            "WHERE s.element >= 0 "
+            "MERGE (c:Chunk {name: $chunk_name, folder: $folder_name, element: s.element}) "
+            "ON CREATE SET c.in_query = True "
+            "SET c.text = s.text, c.embedding_string = s.embedding_string, c.embedding = s.embedding, "
+            "c.embedding_norm = s.embedding_norm, c.chunk_type = s.chunk_type, "
+            "c.content_hash = CASE WHEN s.element = 0 THEN s.content_hash ELSE c.content_hash END, c.status = 'embedded' "
+            "RETURN c.element AS element, c.chunk_type AS chunk_type, c.embedding_norm AS embedding_norm, "
+            "coalesce(c.embedding, c.embedding_string) AS embedding"
+        )
+        result = session.run(query, source_folder=source_folder, source_name=source_name, folder_name=folder_name, chunk_name=chunk_name)
+        records = result.data()
+        # The images of the document keep their names, which are unique within the new folder as well
         query = (
-            "MATCH (c:Chunk {name: $chunk_name}) "
-            "RETURN c"
+            "MATCH (s:Chunk {folder: $source_folder, element: -1})-[:IMAGE_OF]->(:Chunk {folder: $source_folder, name: $source_name}) "
+            "WITH DISTINCT s "
+            "MATCH (d:Chunk {folder: $folder_name, name: $chunk_name, element: 0}) "
+            "MERGE (c:Chunk {name: s.name, folder: $folder_name, element: -1}) "
+            "ON CREATE SET c.in_query = True "
+            "SET c.text = s.text, c.text_short = s.text_short, c.embedding_string = s.embedding_string, c.embedding = s.embedding, "
+            "c.embedding_norm = s.embedding_norm, c.chunk_type = s.chunk_type, c.content_hash = s.content_hash, "
+            "c.blob = coalesce(s.blob, s.folder + '/' + s.name), c.status = 'linked' "
+            "MERGE (c)-[:IMAGE_OF]->(d) "
+            "RETURN c.name AS name, -1 AS element, c.chunk_type AS chunk_type, c.embedding_norm AS embedding_norm, "
+            "coalesce(c.embedding, c.embedding_string) AS embedding"
         )
-        result = session.run(query, chunk_name=chunk_name)
+        images = session.run(query, source_folder=source_folder, source_name=source_name, folder_name=folder_name, chunk_name=chunk_name).data()
+
+    # Keep the in-memory retrieval index and the cached answers in step with the copied embeddings
+    if records or images:
+        answer_cache.invalidate()
+    if embedding_index.loaded:
+        for record in records + images:
+            if record["embedding"]:
+                name = record.get("name", chunk_name)
+                try:
+                    embedding_index.upsert(name, record["element"], record["chunk_type"] or "text", record["embedding"],
+                                           norm=record["embedding_norm"], folder=folder_name, document=chunk_name)
+                except ValueError as e:
+                    print(f"Procedure copy_document_chunks: Could not index chunk {name}: {e}")
+    return len(records) + len(images)
+
+def check_chunk_exists(driver, chunk_name):
+    with driver.session() as session:
+        result = session.run(CHECK_CHUNK_EXISTS, chunk_name=chunk_name)
         record = result.single()
         return record[0] if record else None
-    
-def generate_unique_chunk_name(driver, file_name_body, file_extension):
-    chunk_name = file_name_body + file_extension
-    counter = 1
-    while check_chunk_exists(driver, chunk_name) is not None:
-        chunk_name = f"{file_name_body}_{counter}{file_extension}"
-        counter += 1
 
+def _allocate_chunk_name(tx, file_name, prefix, file_extension, window):
+    # The NameCounter of a file name holds the next suffix to try. Setting _lock first takes the
+    # write lock on the counter, so concurrent allocations for the same file name are serialized.
+    # Names taken by other file names or by chunks created before the counters existed are skipped,
+    # and the allocated name is registered as a ChunkName so no other allocation can return it.
+    record = tx.run(ALLOCATE_CHUNK_NAME, file_name=file_name, prefix=prefix, file_extension=file_extension, window=window).single()
+    return record["chunk_name"]
+
+def generate_unique_chunk_name(driver, file_name_body, file_extension, window=16):
+    """Allocates a chunk name for an uploaded file, adding _1, _2, ... if the file name is taken.
+
+    The name is allocated by one query against a counter stored per file name, which is safe
+    when several uploads or ingestion workers allocate names at the same time.
+    Args:
+        window (int): Number of suffixes checked per query.
+    Returns:
+        str: The allocated chunk name.
+    """
+    # Imported here, so importing this module does not load the Neo4j driver
+    from neo4j.exceptions import ConstraintError
+    chunk_name = None
+    with driver.session() as session:
+        while chunk_name is None:
+            try:
+                chunk_name = session.execute_write(_allocate_chunk_name, file_name_body + file_extension,
+                                                   f"{file_name_body}_", file_extension, window)
+            except ConstraintError:
+                # Another file name allocated the same name concurrently, so try the next suffix
+                continue
     return chunk_name
 
 def create_node(driver, node_name):
     with driver.session() as session:
         # Create the Node node if it doesn't exist
-        create_node_query = (
-            "MERGE (n:Node {name: $node_name}) "
-            "ON CREATE SET n.in_query = True "
-            "RETURN n"
-        )
-        session.run(create_node_query, node_name=node_name)   
+        session.run(CREATE_NODE, node_name=node_name)   
 
 
 def create_chunk_and_relationship(driver, chunk_name, node_name):
@@ -132,31 +515,68 @@ def create_chunk_and_relationship(driver, chunk_name, node_name):
         create_relationship_query = (
             "MATCH (c:Chunk {name: $chunk_name}), (n:Node {name: $node_name}) "
             "WHERE c.element IN [0, -1] "
-            "MERGE (c)-[:PART_OF]->(n)"
+            "MERGE (c)-[:PART_OF]->(n) "
+            "RETURN DISTINCT c.folder AS folder"
         )
-        session.run(create_relationship_query, chunk_name=chunk_name, node_name=node_name)
+        folders = [record["folder"] for record in session.run(create_relationship_query, chunk_name=chunk_name, node_name=node_name)]
+    # The document now shares the retrieval state of the Node
+    if folders:
+        answer_cache.invalidate()
+    if embedding_index.loaded:
+        for folder in folders:
+            embedding_index.link_node(folder, chunk_name, node_name)
+
+def set_node_in_query(driver, node_name, in_query):
+    """Switches all documents that are part of a Node in or out of retrieval.
+
+    Only the flag on the Node is written; the retrieval index excludes the
+    documents of Nodes that are switched off when it searches.
+    """
+    with driver.session() as session:
+        query = (
+            "MATCH (n:Node {name: $node_name}) "
+            "SET n.in_query = $in_query"
+        )
+        session.run(query, node_name=node_name, in_query=bool(in_query)).consume()
+    answer_cache.invalidate()
+    if embedding_index.loaded:
+        embedding_index.set_node_in_query(node_name, bool(in_query))
+
+def get_node_states(driver):
+    """Returns whether each Node takes part in retrieval.
+    Returns:
+        dict: Node name -> in_query flag.
+    """
+    with driver.session() as session:
+        result = session.run("MATCH (n:Node) RETURN n.name AS name, n.in_query AS in_query ORDER BY n.name")
+        return {record["name"]: record["in_query"] is not False for record in result}
             
     
 def get_image_text_short_by_chunk_name(driver, name, element=-1):
     try:
         with driver.session() as session:
-            query = """
-            MATCH (c:Chunk {name: $name, element: $element})
-            RETURN c.text_short AS text_short
-            """
-            result = session.run(query, name=name, element=element)
+            result = session.run(GET_IMAGE_TEXT_SHORT, name=name, element=element)
             # Extract the text_short values from the result and join them into a single string
             return "\n".join(record["text_short"] for record in result)
     except Exception as e:
         print(f"Procedure get_image_text_short_by_chunk_name: An error occurred in get_image_text_short_by_chunk_name: {e}")
         return ""
 
+@traced("neo4j.get_chunks")
+def get_chunks(driver, chunks):
+    """Fetches the attributes of many chunks with one query.
+    Args:
+        chunks (list): Dictionaries with the folder, name and element of each chunk.
+    Returns:
+        dict: (folder, name, element) -> dictionary with text, folder, chunk_type and blob.
+    """
+    with driver.session() as session:
+        result = session.run(GET_CHUNKS, chunks=chunks)
+        return {(record["folder"], record["name"], record["element"]): {"text": record["text"], "folder": record["folder"],
+                                                                        "chunk_type": record["chunk_type"], "blob": record["blob"]}
+                for record in result}
+
 def get_chunk_attributes(driver, chunk_names):
     with driver.session() as session:
-        query = (
-            "MATCH (c:Chunk) "
-            "WHERE c.name IN $chunk_names "
-            "RETURN c.name AS name, c.folder AS folder"
-        )
-        result = session.run(query, chunk_names=chunk_names)
-        return [{"name": record["name"], "folder": record["folder"]} for record in result]
\ No newline at end of file
+        result = session.run(GET_CHUNK_ATTRIBUTES, chunk_names=chunk_names)
+        return [{"name": record["name"], "folder": record["folder"], "blob": record["blob"]} for record in result]
\ No newline at end of file
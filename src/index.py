@@ -0,0 +1,508 @@
+import json
+import threading
+import time
+import numpy as np
+import keys
+
+# In-memory embedding index shared by the retrieval functions in src/utils.py.
+# Embeddings are kept in one contiguous, pre-normalized matrix so a question is
+# scored with a single matrix-vector product instead of a Python loop over every
+# chunk. The quantized modes keep int8 or sign-bit codes instead of float32 and
+# rescore a shortlist exactly with the full vectors stored in the database.
+
+RETRIEVAL_BACKEND = keys.RETRIEVAL_BACKEND
+EMBEDDING_INDEX_MODE = keys.EMBEDDING_INDEX_MODE
+EMBEDDING_RESCORE_CANDIDATES = keys.EMBEDDING_RESCORE_CANDIDATES
+
+INITIAL_CAPACITY = 1024
+INDEX_MODES = ("float32", "int8", "binary")
+# Rows scored per block in the quantized modes, bounding the float32 temporaries
+SCORE_BLOCK_ROWS = 8192
+# Number of set bits of every byte value, for Hamming distances between sign codes
+POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+# Byte layout of the binary Chunk.embedding property: little-endian float32
+EMBEDDING_DTYPE = np.dtype("<f4")
+
+
+def to_vector(embedding):
+    """Converts a stored embedding (float32 bytes, list or JSON string) to a float32 numpy array.
+    Args:
+        embedding (bytes, list, np.ndarray, or str): The embedding as stored on the chunk.
+    Returns:
+        np.ndarray: The embedding as a 1-dimensional float32 array.
+    """
+    if isinstance(embedding, (bytes, bytearray, memoryview)):
+        # Binary embeddings are decoded without copying
+        return np.frombuffer(embedding, dtype=EMBEDDING_DTYPE)
+    if isinstance(embedding, str):
+        try:
+            embedding = json.loads(embedding)
+        except json.JSONDecodeError:
+            raise ValueError("embedding is a string but not a valid JSON list")
+    vector = np.asarray(embedding, dtype=np.float32)
+    if vector.ndim != 1:
+        raise ValueError("Embedding must be 1-dimensional")
+    return vector
+
+
+def normalize(vector, norm=None):
+    """Returns the vector scaled to unit length, or raises if it is a zero vector.
+    Args:
+        vector (np.ndarray): The vector.
+        norm (float): The precomputed norm of the vector, computed here if not given.
+    """
+    if norm is None:
+        norm = np.linalg.norm(vector)
+    if norm == 0:
+        raise ValueError("Embedding is a zero vector, cannot compute cosine similarity")
+    return vector / norm
+
+
+def encode_embedding(embedding):
+    """Encodes an embedding for the binary Chunk.embedding property.
+    Returns:
+        tuple: (float32 bytes, norm of the vector).
+    """
+    vector = to_vector(embedding).astype(EMBEDDING_DTYPE, copy=False)
+    return vector.tobytes(), float(np.linalg.norm(vector))
+
+
+def quantize(vector, mode):
+    """Encodes a unit-length float32 vector for the given index mode.
+    Returns:
+        tuple: (codes, scale). int8 codes times the scale approximate the vector,
+        binary codes are the packed signs of the components.
+    """
+    if mode == "int8":
+        scale = float(np.abs(vector).max()) / 127 or 1.0
+        return np.round(vector / scale).astype(np.int8), scale
+    if mode == "binary":
+        return np.packbits(vector > 0), 1.0
+    return vector, 1.0
+
+
+def document_of(name, document=None):
+    """Returns the document a chunk belongs to: its parent chunk for PDF images, otherwise its own name."""
+    return document or name
+
+
+class PartitionMap:
+    """Parent Nodes of the (folder, document) partitions of an index, and the Nodes taken out of retrieval.
+
+    Every chunk belongs to the partition of its document. A Node with in_query set
+    to false takes all of its partitions out of retrieval without touching their chunks.
+    """
+
+    def __init__(self):
+        self.node_partitions = {}
+        self.partition_nodes = {}
+        self.disabled_nodes = set()
+        self.version = 0
+
+    def load(self, driver):
+        """Loads the PART_OF links and the in_query flag of every Node."""
+        with driver.session() as session:
+            query = (
+                "MATCH (n:Node) "
+                "OPTIONAL MATCH (d:Chunk)-[:PART_OF]->(n) "
+                "RETURN n.name AS node, n.in_query AS in_query, d.folder AS folder, d.name AS document"
+            )
+            records = session.run(query).data()
+        self.node_partitions = {}
+        self.partition_nodes = {}
+        self.disabled_nodes = {record["node"] for record in records if record["in_query"] is False}
+        for record in records:
+            self.node_partitions.setdefault(record["node"], set())
+            if record["document"] is not None:
+                self.link(record["folder"], record["document"], record["node"])
+        self.version += 1
+
+    def link(self, folder, document, node):
+        """Records that the document in the folder is part of the Node."""
+        self.node_partitions.setdefault(node, set()).add((folder, document))
+        self.partition_nodes.setdefault((folder, document), set()).add(node)
+        self.version += 1
+
+    def set_in_query(self, node, in_query):
+        """Switches a Node in or out of retrieval.
+        Returns:
+            set: The partitions of the Node, whose state may have changed.
+        """
+        if in_query:
+            self.disabled_nodes.discard(node)
+        else:
+            self.disabled_nodes.add(node)
+        self.version += 1
+        return self.node_partitions.get(node, set())
+
+    def enabled(self, partition):
+        """Whether the chunks of the partition take part in retrieval."""
+        return not (self.partition_nodes.get(partition, set()) & self.disabled_nodes)
+
+    def partitions_of(self, nodes):
+        """Returns the partitions of the given Nodes."""
+        partitions = set()
+        for node in nodes:
+            partitions.update(self.node_partitions.get(node, ()))
+        return partitions
+
+
+class EmbeddingIndex:
+    """Pre-normalized embedding matrix with row -> (folder, name, element, chunk_type) metadata.
+
+    Rows are keyed on (folder, name, element), the key a Chunk is unique on, so
+    writing a new embedding for an existing chunk replaces its row, and chunks with
+    the same name in different folders, e.g. PDF images, keep rows of their own.
+    In the "int8" and "binary" modes the matrix holds quantized codes. A search
+    ranks all rows by the codes and rescores the best rescore_candidates exactly
+    with the float32 embeddings fetched from the database, or from fetch_embeddings
+    when it is given. Rows are grouped into
+    (folder, document) partitions, so a search scoped to folders or parent Nodes
+    only scans their rows, and switching a Node off flips one flag per partition.
+    """
+
+    def __init__(self, mode=EMBEDDING_INDEX_MODE, rescore_candidates=EMBEDDING_RESCORE_CANDIDATES, fetch_embeddings=None):
+        if mode not in INDEX_MODES:
+            raise ValueError(f"Unknown embedding index mode {mode}, use one of {', '.join(INDEX_MODES)}")
+        self._lock = threading.RLock()
+        self.mode = mode
+        self.rescore_candidates = rescore_candidates
+        # Returns {(folder, name, element): float32 embedding} for a list of keys, in place of the database
+        self.fetch_embeddings = fetch_embeddings
+        self._matrix = None
+        self._dimensions = None
+        self._size = 0
+        self.folders = []
+        self.names = []
+        self.elements = []
+        self.chunk_types = []
+        self._scales = np.zeros(0, dtype=np.float32)
+        self._in_query = np.zeros(0, dtype=bool)
+        self._is_text = np.zeros(0, dtype=bool)
+        self._is_image = np.zeros(0, dtype=bool)
+        self._partition = np.zeros(0, dtype=np.int32)
+        self.rows = {}
+        self.partitions = PartitionMap()
+        self._partition_ids = {}
+        self._partition_rows = []
+        self._partition_enabled = np.zeros(0, dtype=bool)
+        self._folder_partitions = {}
+        self._driver = None
+        self.loaded = False
+        self.synced_at = 0.0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def dimensions(self):
+        return self._dimensions
+
+    @property
+    def nbytes(self):
+        """Memory held by the vectors or codes of the index."""
+        return 0 if self._matrix is None else self._matrix.nbytes + self._scales.nbytes
+
+    def _grow(self, dimensions):
+        # Grow the backing arrays geometrically so appends stay amortized O(1)
+        if self._matrix is None:
+            capacity = INITIAL_CAPACITY
+            self._dimensions = dimensions
+            width, dtype = {"float32": (dimensions, np.float32), "int8": (dimensions, np.int8),
+                            "binary": ((dimensions + 7) // 8, np.uint8)}[self.mode]
+            self._matrix = np.zeros((capacity, width), dtype=dtype)
+        elif self._size < self._matrix.shape[0]:
+            return
+        else:
+            capacity = self._matrix.shape[0] * 2
+            matrix = np.zeros((capacity, self._matrix.shape[1]), dtype=self._matrix.dtype)
+            matrix[:self._size] = self._matrix[:self._size]
+            self._matrix = matrix
+        for attribute in ("_scales", "_in_query", "_is_text", "_is_image", "_partition"):
+            current = getattr(self, attribute)
+            array = np.zeros(capacity, dtype=current.dtype)
+            array[:len(current)] = current
+            setattr(self, attribute, array)
+
+    def _partition_id(self, partition):
+        # Partitions are numbered in order of appearance
+        partition_id = self._partition_ids.get(partition)
+        if partition_id is None:
+            partition_id = len(self._partition_rows)
+            self._partition_ids[partition] = partition_id
+            self._partition_rows.append([])
+            # Doubled like the row arrays so that loading many partitions stays linear
+            if partition_id == len(self._partition_enabled):
+                enabled = np.zeros(max(16, 2 * partition_id), dtype=bool)
+                enabled[:partition_id] = self._partition_enabled
+                self._partition_enabled = enabled
+            self._partition_enabled[partition_id] = self.partitions.enabled(partition)
+            self._folder_partitions.setdefault(partition[0], []).append(partition_id)
+        return partition_id
+
+    def _refresh_partitions(self, partitions):
+        for partition in partitions:
+            if partition in self._partition_ids:
+                self._partition_enabled[self._partition_ids[partition]] = self.partitions.enabled(partition)
+
+    def link_node(self, folder, document, node):
+        """Records that a document is part of a parent Node."""
+        with self._lock:
+            self.partitions.link(folder, document, node)
+            self._refresh_partitions([(folder, document)])
+
+    def set_node_in_query(self, node, in_query):
+        """Switches the partitions of a parent Node in or out of retrieval without touching their rows."""
+        with self._lock:
+            self._refresh_partitions(self.partitions.set_in_query(node, in_query))
+
+    def upsert(self, name, element, chunk_type, embedding, in_query=True, norm=None, folder=None, document=None):
+        """Adds or replaces the embedding of the chunk identified by (folder, name, element).
+        Args:
+            name (str): Chunk name.
+            element (int): Chunk element (page number, 0 for files, -1 for images).
+            chunk_type (str): Chunk type, e.g. "text", "image" or "pdf_image".
+            embedding (bytes, list, np.ndarray, or str): The embedding vector.
+            in_query (bool): Whether the chunk takes part in retrieval.
+            norm (float): The stored norm of the embedding, computed here if not given.
+            folder (str): Folder of the chunk.
+            document (str): Name of the document the chunk belongs to, the chunk name if not given.
+        Returns:
+            int: The row of the chunk in the index.
+        """
+        vector = normalize(to_vector(embedding), norm)
+        codes, scale = quantize(vector, self.mode)
+        with self._lock:
+            if self._dimensions is not None and vector.shape[0] != self._dimensions:
+                raise ValueError(f"Embedding has {vector.shape[0]} dimensions, index has {self._dimensions}")
+            key = (folder, name, element)
+            row = self.rows.get(key)
+            if row is None:
+                self._grow(vector.shape[0])
+                row = self._size
+                self._size += 1
+                self.rows[key] = row
+                self.folders.append(folder)
+                self.names.append(name)
+                self.elements.append(element)
+                self.chunk_types.append(chunk_type)
+            else:
+                self.chunk_types[row] = chunk_type
+                self._partition_rows[self._partition[row]].remove(row)
+            partition_id = self._partition_id((folder, document_of(name, document)))
+            self._partition[row] = partition_id
+            self._partition_rows[partition_id].append(row)
+            self._matrix[row] = codes
+            self._scales[row] = scale
+            self._in_query[row] = bool(in_query)
+            self._is_text[row] = element != -1
+            self._is_image[row] = element == -1 or chunk_type == "image"
+            return row
+
+    def load(self, driver, folder=None):
+        """Loads chunk embeddings from the graph database into the index.
+        Args:
+            driver: Neo4j driver.
+            folder (str): Only load the chunks of this folder, e.g. after a background ingestion job.
+                None loads every chunk.
+        """
+        started_at = time.time()
+        # Quantized searches fetch the full vectors of their shortlist through the same driver
+        self._driver = driver
+        with driver.session() as session:
+            query = (
+                "MATCH (c:Chunk) "
+                "WHERE (c.embedding IS NOT NULL OR c.embedding_string IS NOT NULL) AND ($folder IS NULL OR c.folder = $folder) "
+                "RETURN c.name AS chunk_name, c.element AS element, c.chunk_type AS chunk_type, c.in_query AS in_query, "
+                # PDF images belong to the partition of their document
+                "c.folder AS folder, coalesce(head([(c)-[:IMAGE_OF]->(p:Chunk) | p.name]), c.name) AS document, "
+                # The binary embedding is under half the size of the float list on the wire
+                # (about 3 KB instead of 6.9 KB at 768 dimensions) and needs no parsing
+                "c.embedding AS embedding, c.embedding_norm AS embedding_norm, "
+                "CASE WHEN c.embedding IS NULL THEN c.embedding_string END AS embedding_string"
+            )
+            result = session.run(query, folder=folder)
+            with self._lock:
+                if folder is None:
+                    self.partitions.load(driver)
+                    self._refresh_partitions(self._partition_ids)
+                for record in result:
+                    chunk_name = record["chunk_name"]
+                    embedding = record["embedding"] or record["embedding_string"]
+                    if not embedding:
+                        print(f"Procedure EmbeddingIndex.load: Skipping chunk {chunk_name} due to empty embedding")
+                        continue
+                    try:
+                        self.upsert(chunk_name, record["element"], record["chunk_type"], embedding,
+                                    in_query=record["in_query"] is True,
+                                    norm=record["embedding_norm"] if record["embedding"] else None,
+                                    folder=record["folder"], document=record["document"])
+                    except ValueError as e:
+                        print(f"Procedure EmbeddingIndex.load: Error processing chunk {chunk_name}: {e}")
+                if folder is None:
+                    self.loaded = True
+                    self.synced_at = started_at
+
+    def _coarse_scores(self, query, size, rows=None):
+        # Approximate cosine similarities of the query with the given rows, or with the first size rows
+        count = size if rows is None else len(rows)
+        if self.mode == "float32":
+            return self._matrix[:size] @ query if rows is None else self._matrix[rows] @ query
+        scores = np.empty(count, dtype=np.float32)
+        if self.mode == "binary":
+            query_bits = np.packbits(query > 0)
+        for start in range(0, count, SCORE_BLOCK_ROWS):
+            end = min(start + SCORE_BLOCK_ROWS, count)
+            block = slice(start, end) if rows is None else rows[start:end]
+            if self.mode == "int8":
+                scores[start:end] = (self._matrix[block].astype(np.float32) @ query) * self._scales[block]
+            else:
+                # The fraction of differing signs estimates the angle between the vectors
+                distance = POPCOUNT[np.bitwise_xor(self._matrix[block], query_bits)].sum(axis=1, dtype=np.int32)
+                scores[start:end] = np.cos(np.pi * distance / self._dimensions)
+        return scores
+
+    def _scope_rows(self, folders, nodes):
+        # Rows of the enabled partitions in the given folders or parent Nodes
+        partition_ids = set()
+        for folder in folders or ():
+            partition_ids.update(self._folder_partitions.get(folder, ()))
+        for partition in self.partitions.partitions_of(nodes or ()):
+            if partition in self._partition_ids:
+                partition_ids.add(self._partition_ids[partition])
+        rows = [row for partition_id in sorted(partition_ids) if self._partition_enabled[partition_id]
+                for row in self._partition_rows[partition_id]]
+        return np.array(sorted(rows), dtype=np.int64)
+
+    def _stored_embeddings(self, keys):
+        # Unit-length float32 embeddings of the keys, from fetch_embeddings or the database; None if neither is available
+        if self.fetch_embeddings is not None:
+            return {key: normalize(to_vector(embedding)) for key, embedding in self.fetch_embeddings(keys).items()}
+        if self._driver is None:
+            return None
+        with self._driver.session() as session:
+            result = session.run(
+                "UNWIND $chunks AS chunk "
+                "MATCH (c:Chunk {name: chunk.name, folder: chunk.folder, element: chunk.element}) "
+                "RETURN c.folder AS folder, c.name AS name, c.element AS element, c.embedding AS embedding, "
+                "c.embedding_norm AS embedding_norm, CASE WHEN c.embedding IS NULL THEN c.embedding_string END AS embedding_string",
+                chunks=[{"folder": folder, "name": name, "element": element} for folder, name, element in keys]
+            )
+            vectors = {}
+            for record in result:
+                try:
+                    vectors[(record["folder"], record["name"], record["element"])] = normalize(
+                        to_vector(record["embedding"] or record["embedding_string"]),
+                        record["embedding_norm"] if record["embedding"] else None)
+                except (TypeError, ValueError) as e:
+                    print(f"Procedure EmbeddingIndex.search: Cannot rescore chunk {record['name']}: {e}")
+        return vectors
+
+    def _exact_scores(self, query, keys):
+        # Cosine similarities with the stored float32 embeddings, None where unavailable
+        vectors = self._stored_embeddings(keys)
+        if vectors is None:
+            return None
+        return [float(vectors[key] @ query) if key in vectors else None for key in keys]
+
+    def search(self, query_embedding, top_k, kind="text", folders=None, nodes=None):
+        """Returns the top_k most similar chunks of the given kind.
+        Args:
+            query_embedding (list or np.ndarray): The query embedding.
+            top_k (int): Maximum number of hits.
+            kind (str): "text" for page and file chunks, "image" for image chunks.
+            folders (list): Only search the chunks in these folders.
+            nodes (list): Only search the chunks of the documents that are part of these Nodes.
+                With neither folders nor nodes every chunk is searched.
+        Returns:
+            list: (folder, chunk_name, element, similarity) tuples sorted by descending similarity.
+        """
+        query = normalize(to_vector(query_embedding))
+        with self._lock:
+            size = self._size
+            if size == 0 or top_k <= 0:
+                return []
+            if query.shape[0] != self._dimensions:
+                raise ValueError(f"Query has {query.shape[0]} dimensions, index has {self._dimensions}")
+            if folders or nodes:
+                # A scoped search only scans the rows of its partitions
+                rows = self._scope_rows(folders, nodes)
+                mask = (self._is_text if kind == "text" else self._is_image)[rows] & self._in_query[rows]
+                scores = self._coarse_scores(query, size, rows)
+            else:
+                rows = None
+                mask = ((self._is_text if kind == "text" else self._is_image)[:size] & self._in_query[:size]
+                        & self._partition_enabled[self._partition[:size]])
+                # One pass over the contiguous matrix, then mask out other rows
+                scores = self._coarse_scores(query, size)
+            scores[~mask] = -np.inf
+            # The quantized modes shortlist more rows than asked for and rescore them exactly
+            shortlist = top_k if self.mode == "float32" else max(top_k, self.rescore_candidates)
+            count = min(shortlist, int(mask.sum()))
+            if count == 0:
+                return []
+            top = np.argpartition(-scores, count - 1)[:count] if count < len(scores) else np.arange(len(scores))
+            top = top[np.argsort(-scores[top], kind="stable")][:count]
+            if rows is not None:
+                scores, top = scores[top], rows[top]
+                hits = [(self.folders[row], self.names[row], self.elements[row], float(score)) for row, score in zip(top, scores)]
+            else:
+                hits = [(self.folders[row], self.names[row], self.elements[row], float(scores[row])) for row in top]
+        if self.mode != "float32":
+            exact = self._exact_scores(query, [hit[:3] for hit in hits])
+            if exact is not None:
+                hits = [hit[:3] + (score,) for hit, score in zip(hits, exact) if score is not None]
+                hits.sort(key=lambda hit: -hit[3])
+        return hits[:top_k]
+
+
+def create_embedding_index():
+    """Creates the process-wide index for the configured retrieval backend."""
+    if RETRIEVAL_BACKEND == "ivf":
+        # Imported here because src.ann builds on this module
+        from src.ann import IvfIndex
+        return IvfIndex()
+    return EmbeddingIndex()
+
+
+embedding_index = create_embedding_index()
+
+
+def get_embedding_index(driver):
+    """Returns the process-wide embedding index, loading it from the database on first use."""
+    if not embedding_index.loaded:
+        with embedding_index._lock:
+            if not embedding_index.loaded:
+                embedding_index.load(driver)
+    return embedding_index
+
+
+def measure_recall(driver, modes=("int8", "binary"), sample_size=100, top_k=5, seed=0):
+    """Measures how many of the exact top_k text hits each quantized mode returns.
+
+    Stored text embeddings serve as the sample queries.
+    Returns:
+        dict: mode -> {"recall": mean recall@top_k, "bytes": memory of the index}.
+    """
+    exact = EmbeddingIndex(mode="float32")
+    exact.load(driver)
+    rows = np.flatnonzero(exact._is_text[:len(exact)] & exact._in_query[:len(exact)])
+    rows = np.random.default_rng(seed).choice(rows, size=min(sample_size, len(rows)), replace=False)
+    queries = [exact._matrix[row].copy() for row in rows]
+    expected = [{hit[:3] for hit in exact.search(query, top_k)} for query in queries]
+    results = {"float32": {"recall": 1.0, "bytes": exact.nbytes}}
+    for mode in modes:
+        index = EmbeddingIndex(mode=mode)
+        index.load(driver)
+        found = [len(truth & {hit[:3] for hit in index.search(query, top_k)}) / max(len(truth), 1)
+                 for query, truth in zip(queries, expected)]
+        results[mode] = {"recall": float(np.mean(found)) if found else 1.0, "bytes": index.nbytes}
+    return results
+
+
+if __name__ == "__main__":
+    from neo4j import GraphDatabase
+    with GraphDatabase.driver(keys.NEO4J_URI, auth=(keys.NEO4J_USERNAME, keys.NEO4J_PASSWORD)) as driver:
+        for mode, result in measure_recall(driver).items():
+            print(f"{mode}: recall@5 {result['recall']:.3f}, {result['bytes'] / 1024 / 1024:.1f} MB")
@@ -0,0 +1,169 @@
+import os
+from src import graphdb
+from src.graphdb import status_reached, SKIPPED_STATUS
+from src.documents import read_pdf, content_hash, split_pdf_to_chunks
+from src.gcputils import read_pdf_from_gcs, upload_files_to_folder
+from src.descriptions import describe_image, describe_images
+from src.utils import generate_embedding, generate_embeddings
+from src.telemetry import traced
+import keys
+
+GCP_BUCKET = keys.GCP_BUCKET
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+@traced("ingestion.file")
+def ingest_file(driver, model_image, generation_config, folder_name, file_name_body, file_extension, chunk_name, file_bytes=None, progress=None,
+                store=None):
+    """Describes, embeds and stores one uploaded file whose chunk has already been created.
+
+    Every stage records a checkpoint in Chunk.status, so running the function
+    again after a crash skips the images and pages that are already done.
+    Images and documents whose content hash matches earlier content reuse its
+    GCS object, descriptions and embeddings instead of calling the models.
+    An image the model cannot describe, e.g. in an unsupported format or with a
+    blocked response, is recorded with empty text and the skipped status, and the
+    pages are still chunked and embedded. An image whose description fails with
+    a transient error keeps its status and the function raises, so running it
+    again describes only the images that are still missing.
+    Args:
+        driver: Neo4j driver.
+        model_image: The Gemini model used to read images.
+        generation_config (dict): Generation parameters for the image descriptions.
+        folder_name (str): Folder of the file in the bucket.
+        file_name_body (str): File name without extension.
+        file_extension (str): File extension.
+        chunk_name (str): Unique chunk name of the file.
+        file_bytes (bytes): The file content. PDFs are read back from GCS if not given.
+        progress (callable): Called with (stage, fraction) as the ingestion advances.
+        store: Provides the Chunk functions of src.graphdb, which it is by default. The benchmarks pass an in-memory graph.
+    Raises:
+        RuntimeError: If the description of an image of a PDF failed with a transient error.
+        Exception: The transient error of the description of an image file.
+    """
+    store = graphdb if store is None else store
+
+    def report(stage, fraction):
+        if progress is not None:
+            progress(stage, fraction)
+
+    # Checkpoints of an earlier, interrupted run of this file
+    states = store.get_chunk_states(driver, folder_name)
+    state = states.get((chunk_name, 0), {})
+
+    if file_extension in IMAGE_EXTENSIONS:
+        if not status_reached(state.get("status"), "embedded"):
+            # Reuse the description and embedding of an identical image
+            known = store.find_chunks_by_hash(driver, [state["content_hash"]]).get(state["content_hash"], {}) if state.get("content_hash") else {}
+            image_text = state.get("text") or known.get("text")
+            if not status_reached(state.get("status"), "described") and not image_text:
+                report("describing", 0.1)
+                image_text = describe_image(f"gs://{GCP_BUCKET}/{state['blob']}", file_extension, model_image, generation_config)
+                if not image_text:
+                    print(f"Procedure ingest_file: Image {chunk_name} cannot be described and is skipped")
+                    store.write_chunks(driver, [{"name": chunk_name, "folder": folder_name, "element": 0, "text": "", "text_short": "",
+                                                 "chunk_type": "image", "status": SKIPPED_STATUS}])
+                    report("done", 1.0)
+                    return
+            store.write_chunks(driver, [{"name": chunk_name, "folder": folder_name, "element": 0, "text": image_text, "text_short": "",
+                                   "chunk_type": "image", "status": "described"}])
+            report("embedding", 0.6)
+            embedding_string = known.get("embedding") if known.get("text") == image_text else None
+            embedding_string = embedding_string or generate_embedding(image_text)
+            store.write_chunks(driver, [{"name": chunk_name, "folder": folder_name, "element": 0, "embedding_string": embedding_string,
+                                   "chunk_type": "image", "status": "embedded"}])
+    elif file_extension in ('.pdf') and not status_reached(state.get("status"), "linked"):
+        if file_bytes is None:
+            # The object the chunk points to, which is another upload's when the file was deduplicated
+            file_bytes = read_pdf_from_gcs(GCP_BUCKET, state.get("blob") or f"{folder_name}/{file_name_body}{file_extension}")
+        document_hash = state.get("content_hash") or content_hash(file_bytes)
+
+        # An identical document that has been ingested before only needs its pages copied
+        source = store.find_document_by_hash(driver, document_hash, folder_name, chunk_name)
+        if source is not None:
+            report("copying", 0.5)
+            store.copy_document_chunks(driver, source[0], source[1], folder_name, chunk_name)
+            store.create_consecutive_relationships(driver, folder_name, chunk_name)
+            store.set_chunk_status(driver, folder_name, chunk_name, "linked")
+            report("done", 1.0)
+            return
+
+        # Parse the bytes once for both the images and the page text
+        report("parsing", 0.05)
+        images, md_text = read_pdf(file_bytes, file_name_body)
+        image_list = [(image["name"], image["page"]) for image in images]
+        image_hashes = {image["name"]: image["content_hash"] for image in images}
+
+        def image_status(image_name):
+            return states.get((image_name, -1), {}).get("status")
+
+        # Identical images, within this document or from earlier uploads, share one GCS object,
+        # description and embedding. Only the first image with new content is uploaded and described.
+        known = store.find_chunks_by_hash(driver, set(image_hashes.values()))
+        blobs = {content: record["blob"] for content, record in known.items()}
+        uploads = []
+        for image in images:
+            if image["content_hash"] not in blobs:
+                blobs[image["content_hash"]] = f"{folder_name}/{image['name']}"
+                if not status_reached(image_status(image["name"]), "uploaded"):
+                    uploads.append((image["name"], image["data"]))
+        upload_files_to_folder(GCP_BUCKET, folder_name, uploads)
+        store.write_chunks(driver, [
+            {"name": image_name, "folder": folder_name, "element": -1, "chunk_type": "pdf_image", "status": "uploaded",
+             "content_hash": image_hashes[image_name], "blob": blobs[image_hashes[image_name]]}
+            for image_name, page_number in image_list if not status_reached(image_status(image_name), "uploaded")
+        ])
+
+        # Describe each new image content once, concurrently
+        report("describing", 0.2)
+        descriptions = {content: (record["text"], record["text_short"]) for content, record in known.items() if record["text"]}
+        for image_name, page_number in image_list:
+            if status_reached(image_status(image_name), "described"):
+                descriptions.setdefault(image_hashes[image_name], (states[(image_name, -1)]["text"], states[(image_name, -1)]["text_short"]))
+        pending = list(dict.fromkeys(image_hashes[image_name] for image_name, page_number in image_list if image_hashes[image_name] not in descriptions))
+        failed = set()
+        for content, description in zip(pending, describe_images(
+                [(f"gs://{GCP_BUCKET}/{blobs[content]}", os.path.splitext(blobs[content].lower())[1]) for content in pending],
+                model_image, generation_config)):
+            if description[0] is None:
+                failed.add(content)
+            else:
+                descriptions[content] = description
+        # Images whose description failed transiently stay at "uploaded", so running the job again retries them.
+        # Images the model cannot describe get empty text and are skipped by the later stages.
+        store.write_chunks(driver, [
+            {"name": image_name, "folder": folder_name, "element": -1, "text": descriptions[image_hashes[image_name]][0],
+             "text_short": descriptions[image_hashes[image_name]][1],
+             "status": "described" if descriptions[image_hashes[image_name]][0] else SKIPPED_STATUS}
+            for image_name, page_number in image_list
+            if not status_reached(image_status(image_name), "described") and image_hashes[image_name] in descriptions
+        ])
+        if failed:
+            raise RuntimeError(f"Could not describe {len(failed)} of the images of {chunk_name}")
+
+        # Embed the image descriptions in batches and link the images to the document in the same write
+        report("embedding", 0.6)
+        pending = [image_name for image_name, page_number in image_list
+                   if not status_reached(image_status(image_name), "linked") and descriptions[image_hashes[image_name]][0]]
+        reused = {content: record["embedding"] for content, record in known.items()
+                  if record["embedding"] and descriptions.get(content, (None,))[0] == record["text"]}
+        generated = generate_embeddings([descriptions[image_hashes[image_name]][0] for image_name in pending
+                                         if image_hashes[image_name] not in reused])
+        generated = iter(generated)
+        store.write_chunks(driver, [
+            {"name": image_name, "folder": folder_name, "element": -1,
+             "embedding_string": reused[image_hashes[image_name]] if image_hashes[image_name] in reused else next(generated),
+             "parent_chunk": chunk_name, "status": "linked"}
+            for image_name in pending
+        ])
+
+        report("chunking", 0.7)
+        completed_pages = {element for (name, element), page_state in states.items()
+                           if name == chunk_name and element >= 0 and status_reached(page_state["status"], "embedded")}
+        split_pdf_to_chunks(driver, GCP_BUCKET, folder_name, file_name_body, file_extension, image_list, md_text=md_text,
+                            image_texts={image_name: descriptions[image_hashes[image_name]][1] for image_name, page_number in image_list},
+                            completed_pages=completed_pages, chunk_name=chunk_name, store=store)
+        # Record the document hash so a later upload of the same file can reuse this one
+        store.write_chunks(driver, [{"name": chunk_name, "folder": folder_name, "element": 0, "content_hash": document_hash}])
+    report("done", 1.0)
@@ -0,0 +1,264 @@
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from src.cache import answer_cache
+from src.index import embedding_index
+from src.ingestion import ingest_file
+from src.resources import get_driver, get_generative_model
+import keys
+
+JOB_QUEUE_PATH = keys.JOB_QUEUE_PATH
+JOB_SPOOL_DIR = keys.JOB_SPOOL_DIR
+INGESTION_WORKERS = keys.INGESTION_WORKERS
+JOB_LEASE_SECONDS = keys.JOB_LEASE_SECONDS
+
+# Seconds an idle worker waits before polling the queue again
+POLL_INTERVAL = 1.0
+
+_workers = []
+_workers_lock = threading.Lock()
+
+
+class JobQueue:
+    """Persistent ingestion job queue stored in SQLite.
+
+    The Streamlit app enqueues one job per uploaded file and worker processes
+    claim jobs, report per-file progress and mark them done or failed. Jobs
+    survive restarts of the app, so closing the tab does not lose the work.
+    A claimed job is leased to its worker for lease_seconds and the worker renews
+    the lease while it runs the job, so a job whose worker died, in this or any
+    other app process, is claimed again once its lease expires.
+    """
+
+    def __init__(self, path=JOB_QUEUE_PATH, lease_seconds=JOB_LEASE_SECONDS):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.lease_seconds = lease_seconds
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, batch TEXT NOT NULL, folder TEXT NOT NULL, "
+                "file_name_body TEXT NOT NULL, file_extension TEXT NOT NULL, chunk_name TEXT NOT NULL, "
+                "spool_path TEXT, generation_config TEXT NOT NULL, status TEXT NOT NULL, stage TEXT, "
+                "progress REAL NOT NULL DEFAULT 0, error TEXT, worker INTEGER, "
+                "created_at REAL NOT NULL, finished_at REAL, lease_expires_at REAL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (batch)")
+
+    def _connect(self):
+        # A connection per call keeps the queue safe to use from several threads and processes
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return _Transaction(connection)
+
+    def enqueue(self, batch, folder, file_name_body, file_extension, chunk_name, generation_config, file_bytes=None):
+        """Adds a file to the queue, spooling its bytes to local disk for the workers.
+        Returns:
+            int: The job id.
+        """
+        spool_path = None
+        if file_bytes is not None:
+            os.makedirs(JOB_SPOOL_DIR, exist_ok=True)
+            spool_path = os.path.join(JOB_SPOOL_DIR, f"{uuid.uuid4().hex}{file_extension}")
+            with open(spool_path, "wb") as f:
+                f.write(file_bytes)
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "INSERT INTO jobs (batch, folder, file_name_body, file_extension, chunk_name, spool_path, "
+                "generation_config, status, stage, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, 'queued', 'queued', ?)",
+                (batch, folder, file_name_body, file_extension, chunk_name, spool_path, json.dumps(generation_config), time.time())
+            )
+            return cursor.lastrowid
+
+    def claim(self, worker):
+        """Leases the oldest queued job, or a running job whose lease has expired, to the worker.
+        Returns:
+            dict: The job, or None if there is no job to run.
+        """
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' "
+                "OR (status = 'running' AND coalesce(lease_expires_at, 0) < ?) ORDER BY id LIMIT 1", (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE jobs SET status = 'running', worker = ?, lease_expires_at = ? WHERE id = ?",
+                               (worker, now + self.lease_seconds, row["id"]))
+            return dict(row)
+
+    def renew_lease(self, job_id, worker):
+        """Extends the lease of a running job held by the worker.
+        Returns:
+            bool: False if the worker no longer holds the job.
+        """
+        with self._connect() as connection:
+            return connection.execute(
+                "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time() + self.lease_seconds, job_id, worker)
+            ).rowcount > 0
+
+    def update_progress(self, job_id, stage, progress):
+        with self._connect() as connection:
+            connection.execute("UPDATE jobs SET stage = ?, progress = ? WHERE id = ?", (stage, progress, job_id))
+
+    def complete(self, job_id):
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = 'done', stage = 'done', progress = 1, finished_at = ? WHERE id = ?",
+                (time.time(), job_id)
+            )
+
+    def fail(self, job_id, error):
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                (str(error), time.time(), job_id)
+            )
+
+    def retry_failed(self, batch):
+        """Puts the failed jobs of a batch back in the queue."""
+        with self._connect() as connection:
+            return connection.execute(
+                "UPDATE jobs SET status = 'queued', error = NULL, finished_at = NULL WHERE batch = ? AND status = 'failed'",
+                (batch,)
+            ).rowcount
+
+    def requeue_expired(self):
+        """Puts running jobs whose lease has expired back in the queue, so their progress shows them as waiting."""
+        with self._connect() as connection:
+            return connection.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL, lease_expires_at = NULL "
+                "WHERE status = 'running' AND coalesce(lease_expires_at, 0) < ?", (time.time(),)
+            ).rowcount
+
+    def batch_jobs(self, batch):
+        """Returns the jobs of an upload batch with their status and progress."""
+        with self._connect() as connection:
+            rows = connection.execute("SELECT * FROM jobs WHERE batch = ? ORDER BY id", (batch,)).fetchall()
+            return [dict(row) for row in rows]
+
+    def finished_since(self, timestamp):
+        """Returns the jobs that were completed after the given time."""
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT * FROM jobs WHERE status = 'done' AND finished_at > ? ORDER BY finished_at", (timestamp,)
+            ).fetchall()
+            return [dict(row) for row in rows]
+
+
+class _Transaction:
+    """Context manager that commits or rolls back and always closes the connection."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, exc_type, exc, traceback):
+        try:
+            if self.connection.in_transaction:
+                self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.connection.close()
+
+
+def run_job(queue, job, driver, model_image, worker=None):
+    """Runs one claimed job, renewing its lease while it runs, and records its outcome in the queue."""
+    worker = os.getpid() if worker is None else worker
+    finished = threading.Event()
+
+    def heartbeat():
+        # Renew the lease well before it expires, until the job finishes
+        while not finished.wait(queue.lease_seconds / 3):
+            try:
+                queue.renew_lease(job["id"], worker)
+            except sqlite3.Error as e:
+                print(f"Procedure run_job: Could not renew the lease of job {job['id']}: {e}")
+
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+    try:
+        file_bytes = None
+        if job["spool_path"]:
+            with open(job["spool_path"], "rb") as f:
+                file_bytes = f.read()
+        ingest_file(driver, model_image, json.loads(job["generation_config"]), job["folder"],
+                    job["file_name_body"], job["file_extension"], job["chunk_name"], file_bytes=file_bytes,
+                    progress=lambda stage, fraction: queue.update_progress(job["id"], stage, fraction))
+    except Exception as e:
+        print(f"Procedure run_job: Job {job['id']} for {job['chunk_name']} failed: {e}")
+        queue.fail(job["id"], e)
+        return
+    finally:
+        finished.set()
+        heartbeat_thread.join()
+    queue.complete(job["id"])
+    if job["spool_path"]:
+        os.remove(job["spool_path"])
+
+
+def worker_main(queue_path):
+    """Entry point of an ingestion worker process."""
+    model_image = get_generative_model(keys.GEMINI_IMAGE_MODEL)
+    queue = JobQueue(queue_path)
+    worker = os.getpid()
+    # The app has already created the schema
+    driver = get_driver(initialize=False)
+    while True:
+        job = queue.claim(worker)
+        if job is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+        run_job(queue, job, driver, model_image, worker)
+
+
+def start_workers(count=INGESTION_WORKERS, queue_path=JOB_QUEUE_PATH):
+    """Starts the ingestion worker processes once per app process and restarts any that have died."""
+    with _workers_lock:
+        _workers[:] = [process for process in _workers if process.is_alive()]
+        queue = JobQueue(queue_path)
+        # Jobs of workers that died, here or in another app process, run again once their lease expires
+        queue.requeue_expired()
+        # Spawn rather than fork so workers do not inherit Streamlit threads or open connections
+        context = multiprocessing.get_context("spawn")
+        while len(_workers) < count:
+            process = context.Process(target=worker_main, args=(queue_path,), daemon=True)
+            process.start()
+            _workers.append(process)
+        return queue
+
+
+def sync_embedding_index(driver, queue):
+    """Loads the chunks written by the worker processes into this process's embedding index
+    and drops the cached answers that the new chunks may change."""
+    since = answer_cache.synced_at
+    if embedding_index.loaded:
+        since = min(since, embedding_index.synced_at)
+    jobs = queue.finished_since(since)
+    if not jobs:
+        return
+    if jobs[-1]["finished_at"] > answer_cache.synced_at:
+        answer_cache.invalidate()
+        answer_cache.synced_at = jobs[-1]["finished_at"]
+    if not embedding_index.loaded:
+        # The first search loads everything, including finished jobs
+        return
+    jobs = [job for job in jobs if job["finished_at"] > embedding_index.synced_at]
+    for folder in dict.fromkeys(job["folder"] for job in jobs):
+        embedding_index.load(driver, folder=folder)
+    if jobs:
+        embedding_index.synced_at = max(job["finished_at"] for job in jobs)
+
+
+def new_batch_id():
+    return uuid.uuid4().hex
@@ -0,0 +1,80 @@
+# Cypher of the hot Chunk and Node lookups. src/graphdb.py runs these queries and
+# src/schema.py EXPLAINs the same text to check that they use the declared indexes.
+
+UPDATE_CHUNK = (
+    "MATCH (c:Chunk {name: $chunk_name, folder: $folder_name, element: $element}) "
+    "SET c.chunk_type = $chunk_type, c.text = $text, c.embedding_string = $embedding_string, c.text_short = $text_short, "
+    "c.embedding = $embedding, c.embedding_norm = $embedding_norm "
+    "RETURN c.name AS chunk_name, c.folder AS folder"
+)
+
+CHECK_CHUNK_EXISTS = (
+    "MATCH (c:Chunk {name: $chunk_name}) "
+    "RETURN c"
+)
+
+ALLOCATE_CHUNK_NAME = (
+    "MERGE (counter:NameCounter {name: $file_name}) "
+    "ON CREATE SET counter.next = 0 "
+    "SET counter._lock = true "
+    "WITH counter, [k IN range(counter.next, counter.next + $window - 1) | "
+    "    [k, CASE WHEN k = 0 THEN $file_name ELSE $prefix + toString(k) + $file_extension END]] AS candidates "
+    "WITH counter, [candidate IN candidates WHERE "
+    "    NOT EXISTS { MATCH (:ChunkName {name: candidate[1]}) } AND "
+    "    NOT EXISTS { MATCH (:Chunk {name: candidate[1]}) }] AS free "
+    "SET counter.next = CASE WHEN size(free) > 0 THEN free[0][0] + 1 ELSE counter.next + $window END "
+    "REMOVE counter._lock "
+    "FOREACH (candidate IN free[0..1] | CREATE (:ChunkName {name: candidate[1]})) "
+    "RETURN free[0][1] AS chunk_name"
+)
+
+GET_IMAGE_TEXT_SHORT = (
+    "MATCH (c:Chunk {name: $name, element: $element}) "
+    "RETURN c.text_short AS text_short"
+)
+
+GET_CHUNKS = (
+    "UNWIND $chunks AS chunk "
+    "MATCH (c:Chunk {name: chunk.name, folder: chunk.folder, element: chunk.element}) "
+    "RETURN c.name AS name, c.element AS element, c.text AS text, c.folder AS folder, "
+    "c.chunk_type AS chunk_type, coalesce(c.blob, c.folder + '/' + c.name) AS blob"
+)
+
+GET_CHUNK_ATTRIBUTES = (
+    "MATCH (c:Chunk) "
+    "WHERE c.name IN $chunk_names "
+    "RETURN c.name AS name, c.folder AS folder, coalesce(c.blob, c.folder + '/' + c.name) AS blob"
+)
+
+CREATE_AND_RETURN_CHUNK = (
+    "MERGE (c:Chunk {name: $chunk_name, folder: $folder_name, element: $element}) "
+    "ON CREATE SET c.status = $status, c.in_query = True, c.content_hash = $content_hash, c.blob = $blob "
+    "RETURN c.name AS chunk_name"
+)
+
+LINK_CONSECUTIVE_CHUNKS = (
+    "UNWIND $documents AS document "
+    "MATCH (c:Chunk {folder: document.folder, name: document.name}) "
+    "WHERE $from_element IS NULL OR c.element >= $from_element - 1 "
+    "WITH document, c ORDER BY c.element "
+    "WITH document, collect(c) AS chunks "
+    "UNWIND range(0, size(chunks) - 2) AS i "
+    "WITH chunks[i] AS c1, chunks[i + 1] AS c2 "
+    "MERGE (c1)-[:NEXT]->(c2) "
+    "MERGE (c2)-[:PREVIOUS]->(c1)"
+)
+
+FIND_CHUNKS_BY_HASH = (
+    "UNWIND $content_hashes AS content_hash "
+    "MATCH (c:Chunk {content_hash: content_hash}) "
+    "WITH content_hash, c ORDER BY c.embedding IS NULL AND c.embedding_string IS NULL, c.text IS NULL "
+    "WITH content_hash, head(collect(c)) AS c "
+    "RETURN content_hash, c.text AS text, c.text_short AS text_short, coalesce(c.embedding, c.embedding_string) AS embedding, "
+    "coalesce(c.blob, c.folder + '/' + c.name) AS blob"
+)
+
+CREATE_NODE = (
+    "MERGE (n:Node {name: $node_name}) "
+    "ON CREATE SET n.in_query = True "
+    "RETURN n"
+)
@@ -0,0 +1,123 @@
+import atexit
+import threading
+import keys
+
+NEO4J_URI = keys.NEO4J_URI
+NEO4J_USERNAME = keys.NEO4J_USERNAME
+NEO4J_PASSWORD = keys.NEO4J_PASSWORD
+GCP_PROJECT_ID = keys.GCP_PROJECT_ID
+GCP_LOCATION = keys.GCP_LOCATION
+GEMINI_MODEL = keys.GEMINI_MODEL
+EMBEDDING_MODEL = keys.EMBEDDING_MODEL
+
+# Process-wide models, clients and caches, created on first use and shared by every session and rerun.
+# The Vertex AI and Neo4j libraries are only imported, and the cache files only opened, when first needed.
+_lock = threading.RLock()
+_vertexai_initialized = False
+_embedding_model = None
+_generative_models = {}
+_driver = None
+_driver_initialized = False
+_embedding_cache = None
+_thumbnail_cache = None
+
+
+def init_vertexai():
+    """Initializes the Vertex AI SDK once per process."""
+    global _vertexai_initialized
+    if not _vertexai_initialized:
+        with _lock:
+            if not _vertexai_initialized:
+                import vertexai
+                vertexai.init(project=GCP_PROJECT_ID, location=GCP_LOCATION)
+                _vertexai_initialized = True
+
+
+def get_embedding_model():
+    """Returns the Vertex AI embedding model, loading it on first use."""
+    global _embedding_model
+    if _embedding_model is None:
+        with _lock:
+            if _embedding_model is None:
+                init_vertexai()
+                from vertexai.language_models import TextEmbeddingModel
+                _embedding_model = TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL)
+    return _embedding_model
+
+
+def set_embedding_model(model):
+    """Replaces the embedding model of this process, e.g. with the local model of the benchmarks."""
+    global _embedding_model
+    _embedding_model = model
+
+
+def get_generative_model(model_name=GEMINI_MODEL):
+    """Returns the Gemini model with the given name, creating it on first use."""
+    model = _generative_models.get(model_name)
+    if model is None:
+        with _lock:
+            model = _generative_models.get(model_name)
+            if model is None:
+                init_vertexai()
+                from vertexai.generative_models import GenerativeModel
+                model = _generative_models[model_name] = GenerativeModel(model_name)
+    return model
+
+
+def get_embedding_cache():
+    """Returns the embedding cache of this process, opening its SQLite file on first use."""
+    global _embedding_cache
+    if _embedding_cache is None:
+        with _lock:
+            if _embedding_cache is None:
+                from src.cache import EmbeddingCache
+                _embedding_cache = EmbeddingCache()
+    return _embedding_cache
+
+
+def get_thumbnail_cache():
+    """Returns the thumbnail cache of this process, creating its directory on first use."""
+    global _thumbnail_cache
+    if _thumbnail_cache is None:
+        with _lock:
+            if _thumbnail_cache is None:
+                from src.thumbnails import ThumbnailCache
+                _thumbnail_cache = ThumbnailCache()
+    return _thumbnail_cache
+
+
+def get_driver(initialize=True):
+    """Returns the process-wide Neo4j driver, connecting on first use.
+    Args:
+        initialize (bool): Also create the constraints, indexes and migrations of initialize_grapdb,
+            once per process. The ingestion workers leave this to the app.
+    Raises:
+        RuntimeError: If NEO4J_URI is not set.
+    """
+    global _driver, _driver_initialized
+    if _driver is None or (initialize and not _driver_initialized):
+        with _lock:
+            if _driver is None:
+                if not NEO4J_URI:
+                    raise RuntimeError("NEO4J_URI is not set. Add the parameters to the .env file or the environment.")
+                from neo4j import GraphDatabase
+                _driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USERNAME, NEO4J_PASSWORD))
+            if initialize and not _driver_initialized:
+                # Imported here because src.graphdb depends on modules that use this one
+                from src.graphdb import initialize_grapdb
+                initialize_grapdb(_driver)
+                _driver_initialized = True
+    return _driver
+
+
+def close_driver():
+    """Closes the Neo4j driver if it has been opened."""
+    global _driver, _driver_initialized
+    with _lock:
+        if _driver is not None:
+            _driver.close()
+        _driver = None
+        _driver_initialized = False
+
+
+atexit.register(close_driver)
@@ -0,0 +1,108 @@
+from src.queries import (UPDATE_CHUNK, CHECK_CHUNK_EXISTS, ALLOCATE_CHUNK_NAME, GET_IMAGE_TEXT_SHORT, GET_CHUNKS,
+                         GET_CHUNK_ATTRIBUTES, CREATE_AND_RETURN_CHUNK, LINK_CONSECUTIVE_CHUNKS, FIND_CHUNKS_BY_HASH, CREATE_NODE)
+import keys
+
+SCHEMA_CHECK_PLANS = keys.SCHEMA_CHECK_PLANS
+
+# Indexes backing the Chunk and Node lookups in src/graphdb.py and src/utils.py
+SCHEMA_INDEXES = [
+    {"name": "chunk_name", "label": "Chunk", "properties": ["name"]},
+    {"name": "chunk_name_element", "label": "Chunk", "properties": ["name", "element"]},
+    {"name": "chunk_folder_name_element", "label": "Chunk", "properties": ["folder", "name", "element"]},
+    {"name": "chunk_content_hash", "label": "Chunk", "properties": ["content_hash"]},
+    {"name": "node_name", "label": "Node", "properties": ["name"]},
+]
+
+# The hot lookups of src/graphdb.py with sample parameters, checked with EXPLAIN by check_query_plans
+HOT_QUERIES = {
+    "update_chunk": (
+        UPDATE_CHUNK,
+        {"chunk_name": "", "folder_name": "", "element": 0, "chunk_type": "text", "text": "", "embedding_string": None,
+         "text_short": "", "embedding": None, "embedding_norm": None},
+    ),
+    "check_chunk_exists": (CHECK_CHUNK_EXISTS, {"chunk_name": ""}),
+    "generate_unique_chunk_name": (
+        ALLOCATE_CHUNK_NAME,
+        {"file_name": "", "prefix": "", "file_extension": "", "window": 16},
+    ),
+    "get_image_text_short_by_chunk_name": (GET_IMAGE_TEXT_SHORT, {"name": "", "element": -1}),
+    "get_chunks": (GET_CHUNKS, {"chunks": [{"name": "", "folder": "", "element": 0}]}),
+    "get_chunk_attributes": (GET_CHUNK_ATTRIBUTES, {"chunk_names": [""]}),
+    "create_and_return_chunk": (
+        CREATE_AND_RETURN_CHUNK,
+        {"chunk_name": "", "folder_name": "", "element": 0, "status": "new", "content_hash": None, "blob": None},
+    ),
+    "link_consecutive_chunks": (LINK_CONSECUTIVE_CHUNKS, {"documents": [{"folder": "", "name": ""}], "from_element": None}),
+    "find_chunks_by_hash": (FIND_CHUNKS_BY_HASH, {"content_hashes": [""]}),
+    "create_node": (CREATE_NODE, {"node_name": ""}),
+}
+
+SCAN_OPERATORS = ("NodeByLabelScan", "AllNodesScan")
+
+
+def ensure_schema(driver):
+    """Creates the declared indexes if they do not exist and verifies them."""
+    with driver.session() as session:
+        for index in SCHEMA_INDEXES:
+            properties = ", ".join(f"n.{prop}" for prop in index["properties"])
+            session.run(
+                f"CREATE INDEX {index['name']} IF NOT EXISTS FOR (n:{index['label']}) ON ({properties})"
+            ).consume()
+    verify_schema(driver)
+    if SCHEMA_CHECK_PLANS:
+        check_query_plans(driver)
+
+
+def verify_schema(driver):
+    """Checks that every declared index exists and has not failed.
+    Raises:
+        RuntimeError: If an index is missing or in a failed state.
+    """
+    with driver.session() as session:
+        result = session.run("SHOW INDEXES YIELD name, state, labelsOrTypes, properties")
+        existing = {record["name"]: record for record in result}
+    problems = []
+    for index in SCHEMA_INDEXES:
+        record = existing.get(index["name"])
+        if record is None:
+            problems.append(f"index {index['name']} is missing")
+        elif record["labelsOrTypes"] != [index["label"]] or record["properties"] != index["properties"]:
+            problems.append(f"index {index['name']} is defined on {record['labelsOrTypes']} {record['properties']}")
+        elif record["state"] == "FAILED":
+            problems.append(f"index {index['name']} has failed")
+        elif record["state"] != "ONLINE":
+            print(f"Procedure verify_schema: Index {index['name']} is {record['state']}")
+    if problems:
+        raise RuntimeError("Schema verification failed: " + "; ".join(problems))
+
+
+def _find_scans(plan):
+    operator = plan.get("operatorType", "").split("@")[0]
+    scans = [operator] if operator in SCAN_OPERATORS else []
+    for child in plan.get("children", []):
+        scans.extend(_find_scans(child))
+    return scans
+
+
+def check_query_plans(driver):
+    """EXPLAINs the hot queries and fails if any of them falls back to a label or full node scan.
+    Raises:
+        RuntimeError: If a hot query plan contains a NodeByLabelScan or AllNodesScan.
+    """
+    problems = []
+    with driver.session() as session:
+        for name, (query, parameters) in HOT_QUERIES.items():
+            summary = session.run(f"EXPLAIN {query}", parameters).consume()
+            scans = _find_scans(summary.plan or {})
+            if scans:
+                problems.append(f"{name} uses {', '.join(scans)}")
+    if problems:
+        raise RuntimeError("Query plan check failed: " + "; ".join(problems))
+
+
+if __name__ == "__main__":
+    from neo4j import GraphDatabase
+    with GraphDatabase.driver(keys.NEO4J_URI, auth=(keys.NEO4J_USERNAME, keys.NEO4J_PASSWORD)) as driver:
+        ensure_schema(driver)
+        check_query_plans(driver)
+        print("Schema and query plans are OK.")
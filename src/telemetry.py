@@ -0,0 +1,279 @@
+import atexit
+import functools
+import os
+import threading
+import time
+import keys
+
+TELEMETRY_SINKS = keys.TELEMETRY_SINKS
+TELEMETRY_PROMETHEUS_DIR = keys.TELEMETRY_PROMETHEUS_DIR
+TELEMETRY_FLUSH_SECONDS = keys.TELEMETRY_FLUSH_SECONDS
+
+# Span duration buckets of the Prometheus histograms, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metrics:
+    """Counters and span duration histograms of this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.durations = {}
+
+    def add(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self.durations.get(name)
+            if histogram is None:
+                histogram = self.durations[name] = {"count": 0, "sum": 0.0, "buckets": [0] * len(DURATION_BUCKETS)}
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters), {name: {**histogram, "buckets": list(histogram["buckets"])}
+                                         for name, histogram in self.durations.items()}
+
+
+class LogSink:
+    """Prints every finished span with its duration and attributes."""
+
+    def on_span(self, name, seconds, attributes):
+        details = " ".join(f"{key}={value}" for key, value in attributes.items())
+        print(f"Telemetry: {name} took {1000 * seconds:.1f} ms {details}".rstrip())
+
+    def on_count(self, name, value, labels):
+        pass
+
+    def flush(self, metrics):
+        pass
+
+
+class PrometheusFileSink:
+    """Writes the metrics in the Prometheus text format for the node exporter textfile collector.
+
+    Every process writes its own file, labelled with its pid, at most once every
+    flush_seconds and when it exits.
+    """
+
+    def __init__(self, directory=TELEMETRY_PROMETHEUS_DIR, flush_seconds=TELEMETRY_FLUSH_SECONDS):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self._flushed_at = 0.0
+
+    def on_span(self, name, seconds, attributes):
+        if time.monotonic() - self._flushed_at >= self.flush_seconds:
+            flush()
+
+    def on_count(self, name, value, labels):
+        pass
+
+    @staticmethod
+    def _name(name):
+        return "rag_" + "".join(character if character.isalnum() else "_" for character in name)
+
+    @staticmethod
+    def _escape(value):
+        # Backslashes, double quotes and newlines must be escaped in label values
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    @classmethod
+    def _labels(cls, labels):
+        return "{" + ",".join(f'{key}="{cls._escape(value)}"' for key, value in labels) + "}"
+
+    def flush(self, metrics):
+        self._flushed_at = time.monotonic()
+        counters, durations = metrics.snapshot()
+        pid = ("pid", os.getpid())
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(counters.items()):
+            metric = self._name(name) + "_total"
+            # One TYPE line per metric, before its first sample
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} counter")
+                typed.add(metric)
+            lines.append(f"{metric}{self._labels(labels + (pid,))} {value}")
+        for name, histogram in sorted(durations.items()):
+            metric = self._name(name) + "_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for bound, count in zip(DURATION_BUCKETS, histogram["buckets"]):
+                lines.append(f"{metric}_bucket{self._labels((('le', bound), pid))} {count}")
+            lines.append(f"{metric}_bucket{self._labels((('le', '+Inf'), pid))} {histogram['count']}")
+            lines.append(f"{metric}_sum{self._labels((pid,))} {histogram['sum']}")
+            lines.append(f"{metric}_count{self._labels((pid,))} {histogram['count']}")
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"rag_{os.getpid()}.prom")
+        # Write and rename, so the collector never reads a partial file
+        with open(path + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+
+
+class OtlpSink:
+    """Exports spans and counters through OpenTelemetry to the OTLP endpoint in OTEL_EXPORTER_OTLP_ENDPOINT.
+
+    Needs the opentelemetry-sdk and opentelemetry-exporter-otlp packages.
+    """
+
+    def __init__(self):
+        from opentelemetry import metrics as otel_metrics, trace
+        from opentelemetry.exporter.otlp.proto.http.metric_exporter import OTLPMetricExporter
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.metrics import MeterProvider
+        from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        tracer_provider = TracerProvider()
+        tracer_provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        trace.set_tracer_provider(tracer_provider)
+        otel_metrics.set_meter_provider(MeterProvider(metric_readers=[PeriodicExportingMetricReader(OTLPMetricExporter())]))
+        self._tracer = trace.get_tracer("multimodal-rag")
+        self._meter = otel_metrics.get_meter("multimodal-rag")
+        self._counters = {}
+
+    def on_span(self, name, seconds, attributes):
+        end = time.time_ns()
+        span = self._tracer.start_span(name, start_time=end - int(seconds * 1e9),
+                                       attributes={key: value for key, value in attributes.items() if isinstance(value, (str, int, float, bool))})
+        span.end(end_time=end)
+
+    def on_count(self, name, value, labels):
+        if name not in self._counters:
+            self._counters[name] = self._meter.create_counter(name)
+        self._counters[name].add(value, labels)
+
+    def flush(self, metrics):
+        pass
+
+
+SINK_TYPES = {"log": LogSink, "prometheus": PrometheusFileSink, "otlp": OtlpSink}
+
+metrics = Metrics()
+sinks = []
+# Checked first by span and count, so instrumentation costs one attribute lookup when no sink is configured
+enabled = False
+
+
+def add_sink(sink):
+    """Adds a sink with on_span(name, seconds, attributes), on_count(name, value, labels) and flush(metrics) methods."""
+    global enabled
+    sinks.append(sink)
+    enabled = True
+
+
+def configure(names=TELEMETRY_SINKS):
+    """Adds the sinks named in a comma-separated list, e.g. "log,prometheus"."""
+    for name in [name.strip() for name in names.split(",") if name.strip()]:
+        if name not in SINK_TYPES:
+            print(f"Procedure telemetry.configure: Unknown sink {name}, use one of {', '.join(SINK_TYPES)}")
+            continue
+        try:
+            add_sink(SINK_TYPES[name]())
+        except ImportError as e:
+            print(f"Procedure telemetry.configure: Sink {name} is not available: {e}")
+
+
+class _NoSpan:
+    # Shared by every span while telemetry is disabled
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Span:
+    """A timed stage. Attributes can be added while it runs with set()."""
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self._started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        seconds = time.perf_counter() - self._started_at
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        metrics.observe(self.name, seconds)
+        metrics.add(f"{self.name}.calls", 1, {})
+        for sink in sinks:
+            try:
+                sink.on_span(self.name, seconds, self.attributes)
+            except Exception as e:
+                print(f"Procedure telemetry.span: Sink {type(sink).__name__} failed: {e}")
+        return False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+def span(name, **attributes):
+    """Times the enclosed block as a stage of the pipeline, e.g. `with span("gcs.download", blob=name):`."""
+    if not enabled:
+        return _NO_SPAN
+    return Span(name, attributes)
+
+
+def traced(name):
+    """Decorator that runs the function in a span."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with Span(name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1, **labels):
+    """Adds value to a counter, e.g. bytes transferred, tokens used or cache hits."""
+    if not enabled or not value:
+        return
+    metrics.add(name, value, labels)
+    for sink in sinks:
+        try:
+            sink.on_count(name, value, labels)
+        except Exception as e:
+            print(f"Procedure telemetry.count: Sink {type(sink).__name__} failed: {e}")
+
+
+def flush():
+    """Passes the current metrics to every sink."""
+    for sink in sinks:
+        try:
+            sink.flush(metrics)
+        except Exception as e:
+            print(f"Procedure telemetry.flush: Sink {type(sink).__name__} failed: {e}")
+
+
+def record_usage(response, stage):
+    """Counts the prompt and output tokens reported in a Gemini response, if it has usage metadata."""
+    usage = getattr(response, "usage_metadata", None)
+    if not enabled or usage is None:
+        return
+    count("tokens", getattr(usage, "prompt_token_count", 0) or 0, stage=stage, kind="prompt")
+    count("tokens", getattr(usage, "candidates_token_count", 0) or 0, stage=stage, kind="output")
+
+
+configure()
+atexit.register(flush)
@@ -0,0 +1,162 @@
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from src.gcputils import get_storage_client
+from src.telemetry import span, count
+import keys
+
+IMAGE_CACHE_DIR = keys.IMAGE_CACHE_DIR
+IMAGE_CACHE_MEMORY_MB = keys.IMAGE_CACHE_MEMORY_MB
+IMAGE_CACHE_DISK_MB = keys.IMAGE_CACHE_DISK_MB
+THUMBNAIL_WIDTH = keys.THUMBNAIL_WIDTH
+GCS_MAX_WORKERS = keys.GCS_MAX_WORKERS
+
+
+def render_thumbnail(image_data, width=THUMBNAIL_WIDTH):
+    """Scales an image down to the display width and encodes it as PNG, or JPEG for opaque photos.
+    Returns:
+        bytes: The encoded thumbnail.
+    """
+    image = Image.open(io.BytesIO(image_data))
+    image.thumbnail((width, width * 10))
+    output = io.BytesIO()
+    if image.mode in ("RGBA", "LA", "P"):
+        image.save(output, format="PNG", optimize=True)
+    else:
+        image.convert("RGB").save(output, format="JPEG", quality=85)
+    return output.getvalue()
+
+
+class ThumbnailCache:
+    """Two-tier cache of display-size thumbnails of the images stored in GCS.
+
+    Thumbnails are keyed by bucket and object path (folder/name). The memory tier
+    is an LRU bounded by bytes, and the disk tier is a directory of files whose
+    least recently used entries are deleted once it grows past max_disk_bytes.
+    Missing thumbnails are downloaded and rendered in parallel.
+    """
+
+    def __init__(self, directory=IMAGE_CACHE_DIR, width=THUMBNAIL_WIDTH, max_memory_bytes=IMAGE_CACHE_MEMORY_MB * 1024 * 1024,
+                 max_disk_bytes=IMAGE_CACHE_DISK_MB * 1024 * 1024, max_workers=GCS_MAX_WORKERS):
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self.width = width
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.max_workers = max_workers
+        self.directory = directory
+        self._disk_bytes = 0
+        if directory:
+            try:
+                os.makedirs(directory, exist_ok=True)
+                self._disk_bytes = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+            except OSError as e:
+                print(f"Procedure ThumbnailCache: Disk tier disabled, could not open {directory}: {e}")
+                self.directory = None
+
+    def _key(self, bucket_name, blob_name):
+        return hashlib.sha256(f"{bucket_name}/{blob_name}\0{self.width}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key, data):
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _read_disk(self, key):
+        if not self.directory:
+            return None
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # The modification time records the last access for eviction
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def _write_disk(self, key, data):
+        if not self.directory:
+            return
+        path = os.path.join(self.directory, key)
+        try:
+            # Write to a temporary file first so a reader never sees a partial thumbnail
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print(f"Procedure ThumbnailCache: Could not store thumbnail {key}: {e}")
+            return
+        with self._lock:
+            self._disk_bytes += len(data)
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Delete the least recently used files until the disk tier is back under 90% of its budget
+        target = int(self.max_disk_bytes * 0.9)
+        entries = sorted((entry for entry in os.scandir(self.directory) if entry.is_file()), key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= target:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                total -= size
+            except OSError:
+                pass
+        self._disk_bytes = total
+
+    def _fetch(self, bucket_name, blob_name, key):
+        data = self._read_disk(key)
+        if data is None:
+            try:
+                with span("gcs.download", blob=blob_name):
+                    image_data = get_storage_client().bucket(bucket_name).blob(blob_name).download_as_bytes()
+                count("bytes", len(image_data), stage="gcs.download")
+                data = render_thumbnail(image_data, self.width)
+            except Exception as e:
+                print(f"Procedure ThumbnailCache: Could not load image {bucket_name}/{blob_name}: {e}")
+                return None
+            self._write_disk(key, data)
+        with self._lock:
+            self._remember(key, data)
+        return data
+
+    def get_many(self, bucket_name, blob_names):
+        """Returns the thumbnails of the objects, loading the missing ones in parallel.
+        Returns:
+            list: The encoded thumbnail of each object, or None where the image could not be loaded.
+        """
+        cache_keys = [self._key(bucket_name, blob_name) for blob_name in blob_names]
+        thumbnails = [None] * len(blob_names)
+        missing = {}
+        with self._lock:
+            for i, key in enumerate(cache_keys):
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    thumbnails[i] = self._memory[key]
+                else:
+                    missing.setdefault(key, blob_names[i])
+        count("cache.hits", len(blob_names) - len(missing), cache="thumbnail")
+        count("cache.misses", len(missing), cache="thumbnail")
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(missing))) as executor:
+                loaded = dict(zip(missing, executor.map(lambda key: self._fetch(bucket_name, missing[key], key), missing)))
+            thumbnails = [loaded.get(key) if thumbnail is None else thumbnail for key, thumbnail in zip(cache_keys, thumbnails)]
+        return thumbnails
+
+    def prefetch(self, bucket_name, blob_names):
+        """Loads the thumbnails of the objects into the cache."""
+        self.get_many(bucket_name, list(dict.fromkeys(blob_names)))
+
@@ -1,10 +1,17 @@
-import json
-import numpy as np
-from vertexai.language_models import TextEmbeddingModel
+from concurrent.futures import ThreadPoolExecutor
+from src.index import get_embedding_index
+from src.resources import get_embedding_model, get_embedding_cache
+from src.graphdb import query_vector_index, get_chunks
+from src.telemetry import span, count
 import keys
 
 EMBEDDING_MODEL = keys.EMBEDDING_MODEL
-embedding_model = TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL)
+RETRIEVAL_BACKEND = keys.RETRIEVAL_BACKEND
+EMBEDDING_BATCH_SIZE = keys.EMBEDDING_BATCH_SIZE
+EMBEDDING_MAX_BATCH_TOKENS = keys.EMBEDDING_MAX_BATCH_TOKENS
+
+# Rough characters-per-token ratio used to keep batches under the request token limit
+CHARS_PER_TOKEN = 4
 
 def generate_embedding(query_text):
     """Generates an embedding for the given query text using Vertex AI.
@@ -16,12 +23,78 @@ def generate_embedding(query_text):
     # Return an empty list if there is no input string
     if not query_text:
         return []
-    
-    # Generate the embedding
-    embeddings = embedding_model.get_embeddings([query_text])
 
-    # Return the embedding vector for the input text
-    return embeddings[0].values
+    # Generate the embedding, served from the embedding cache when the text has been seen before
+    return generate_embeddings([query_text])[0]
+
+def estimate_tokens(text):
+    """Estimates the number of tokens in the text from its length."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def make_embedding_batches(texts, batch_size=EMBEDDING_BATCH_SIZE, max_batch_tokens=EMBEDDING_MAX_BATCH_TOKENS):
+    """Splits the indexes of the texts into batches that respect the model's batch size and token limit.
+    Args:
+        texts (list): The texts to be embedded.
+        batch_size (int): Maximum number of texts per request.
+        max_batch_tokens (int): Maximum estimated number of tokens per request.
+    Returns:
+        list: Lists of indexes into texts, one list per request.
+    """
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if batch and (len(batch) >= batch_size or batch_tokens + tokens > max_batch_tokens):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def generate_embeddings(texts):
+    """Generates embeddings for many texts with as few Vertex AI requests as possible.
+    Args:
+        texts (list): The texts to be embedded.
+    Returns:
+        list: The embedding vectors in the same order as the texts. Empty texts get an empty list.
+    """
+    vectors = [[] for _ in texts]
+
+    # Only non-empty texts that are not in the embedding cache are sent to the model
+    non_empty = [i for i, text in enumerate(texts) if text]
+    embedding_cache = get_embedding_cache()
+    cached = embedding_cache.get_many(EMBEDDING_MODEL, [texts[i] for i in non_empty])
+    positions = []
+    for i, vector in zip(non_empty, cached):
+        if vector is not None:
+            vectors[i] = vector
+        else:
+            positions.append(i)
+
+    count("cache.hits", len(non_empty) - len(positions), cache="embedding")
+    count("cache.misses", len(positions), cache="embedding")
+
+    # Identical texts, such as overlapping page text, are embedded only once
+    unique_texts = list(dict.fromkeys(texts[i] for i in positions))
+    generated = {}
+    for batch in make_embedding_batches(unique_texts):
+        batch_texts = [unique_texts[i] for i in batch]
+        # The embedding API reports no usage, so the tokens are estimated
+        tokens = sum(estimate_tokens(text) for text in batch_texts)
+        with span("vertex.embed", texts=len(batch_texts), tokens=tokens):
+            embeddings = get_embedding_model().get_embeddings(batch_texts)
+        count("tokens", tokens, stage="embedding", kind="prompt")
+        batch_vectors = [embedding.values for embedding in embeddings]
+        embedding_cache.put_many(EMBEDDING_MODEL, batch_texts, batch_vectors)
+        generated.update(zip(batch_texts, batch_vectors))
+
+    for i in positions:
+        vectors[i] = generated[texts[i]]
+    return vectors
 
 def get_substring_before_keyword(input_string, keyword="(whose parent is"):
     # Split the string at the keyword
@@ -39,169 +112,115 @@ def get_substring_before_keyword(input_string, keyword="(whose parent is"):
 
     return result
 
-def compute_cosine_similarity(vec1, vec2):
-    """
-    Compute the cosine similarity between two vectors.
-
+def search_documents(driver, query_embedding, top_k=5, folders=None, nodes=None, index=None):
+    """Finds the text chunks most similar to the query embedding.
     Args:
-        vec1 (list, np.ndarray, or str): The first input vector.
-        vec2 (list, np.ndarray, or str): The second input vector.
-
+        folders (list): Only search these folders.
+        nodes (list): Only search the documents that are part of these Nodes.
+        index: The embedding index to search instead of the process-wide one.
     Returns:
-        float: The cosine similarity between vec1 and vec2.
+        tuple: (hits, lowest_score). Each hit is a dictionary with folder, chunk_name, element and
+        similarity, plus the chunk attributes when the Neo4j backend returns them with the scores.
     """
-    # Check if vec1 is a string and convert it to a list if needed
-    if isinstance(vec1, str):
-        try:
-            vec1 = json.loads(vec1)
-        except json.JSONDecodeError:
-            raise ValueError("vec1 is a string but not a valid JSON list")
-
-    # Check if vec2 is a string and convert it to a list if needed
-    if isinstance(vec2, str):
+    lowest_score = 0
+    if RETRIEVAL_BACKEND == "neo4j":
+        # Score, filter and fetch the chunk attributes in a single vector index query
+        hits = query_vector_index(driver, query_embedding, top_k, kind="text", folders=folders, nodes=nodes)
+    else:
         try:
-            vec2 = json.loads(vec2)
-        except json.JSONDecodeError:
-            raise ValueError("vec2 is a string but not a valid JSON list")
-
-    # Convert the lists to numpy arrays if they are not already
-    vec1 = np.array(vec1)
-    vec2 = np.array(vec2)
-
-    # Ensure the vectors are 1-dimensional
-    if vec1.ndim != 1 or vec2.ndim != 1:
-        raise ValueError("Both vectors must be 1-dimensional")
-
-    # Compute cosine similarity using numpy
-    dot_product = np.dot(vec1, vec2)
-    norm_vec1 = np.linalg.norm(vec1)
-    norm_vec2 = np.linalg.norm(vec2)
-
-    # Handle the case where one of the vectors is zero
-    if norm_vec1 == 0 or norm_vec2 == 0:
-        raise ValueError("One of the vectors is zero, cannot compute cosine similarity")
-
-    cosine_similarity = dot_product / (norm_vec1 * norm_vec2)
-
-    return cosine_similarity
+            hits = [{"folder": folder, "chunk_name": chunk_name, "element": element, "similarity": similarity}
+                    for folder, chunk_name, element, similarity in (index if index is not None else get_embedding_index(driver)).search(
+                        query_embedding, top_k, kind="text", folders=folders, nodes=nodes)]
+        except ValueError as e:
+            print(f"Procedure search_documents: Error processing query embedding: {e}")
+            hits = []
+
+    # Keep only the hits above the similarity threshold
+    hits = [hit for hit in hits if hit["similarity"] > 0.5]
+    if hits:
+        # Extract the lowest score of the selected hits
+        lowest_score = hits[-1]["similarity"]
+    return hits, lowest_score
+
+def search_images(driver, query_embedding, score, top_k=3, folders=None, nodes=None, index=None):
+    """Finds the image chunks whose similarity reaches the score of the text hits.
+    Returns:
+        list: Hits in the same form as search_documents.
+    """
+    # Select the top_k hits whose similarity reaches the score of the text hits
+    if score < 0.55:
+        score = 0.55
+    if RETRIEVAL_BACKEND == "neo4j":
+        return query_vector_index(driver, query_embedding, top_k, kind="image", min_score=score, folders=folders, nodes=nodes)
+    try:
+        hits = (index if index is not None else get_embedding_index(driver)).search(query_embedding, top_k, kind="image",
+                                                                                     folders=folders, nodes=nodes)
+    except ValueError as e:
+        print(f"Procedure search_images: Error processing query embedding: {e}")
+        hits = []
+    return [{"folder": folder, "chunk_name": chunk_name, "element": element, "similarity": similarity}
+            for folder, chunk_name, element, similarity in hits if similarity >= score]
+
+def hydrate_hits(driver, *hit_lists, store=None):
+    """Adds text, chunk_type and blob to hits that lack them, with one query for all lists.
+
+    Hits are matched on folder, name and element, since chunk names are only unique within a folder.
+    Args:
+        store: Provides get_chunks in place of src.graphdb, e.g. the in-memory graph of the benchmarks.
+    Returns:
+        list: One list per argument, keeping the hits that still exist in their original order.
+    """
+    missing = [{"folder": hit["folder"], "name": hit["chunk_name"], "element": hit["element"]}
+               for hits in hit_lists for hit in hits if "text" not in hit]
+    chunks = (store.get_chunks if store is not None else get_chunks)(driver, missing) if missing else {}
+    hydrated = []
+    for hits in hit_lists:
+        hydrated.append([])
+        for hit in hits:
+            if "text" not in hit:
+                key = (hit["folder"], hit["chunk_name"], hit["element"])
+                if key not in chunks:
+                    continue
+                hit = {**hit, **chunks[key]}
+            hydrated[-1].append(hit)
+    return hydrated
+
+def retrieve_context(driver, query_embedding, top_k=5, top_k_images=3, folders=None, nodes=None, index=None, store=None):
+    """Retrieves the text and image chunks for a question.
+
+    The in-memory backend scores both kinds locally and fetches all hits with one
+    query. The Neo4j backend answers each kind with one vector index query, run concurrently.
+    Args:
+        folders (list): Only retrieve chunks in these folders.
+        nodes (list): Only retrieve chunks of the documents that are part of these Nodes.
+            With neither, every document of a Node that is switched on is searched.
+        index: The embedding index to search instead of the process-wide one.
+        store: Provides get_chunks in place of src.graphdb.
+    Returns:
+        tuple: (documents, image_text, images), where images are dictionaries with
+        name, folder and blob that plot_images can show without another query.
+    """
+    with span("retrieval", backend=RETRIEVAL_BACKEND, scoped=bool(folders or nodes)) as retrieval_span:
+        if RETRIEVAL_BACKEND == "neo4j":
+            # Run the image query alongside the text query. Filtering its top-k hits by the
+            # text score afterwards selects the same hits as waiting for the score first.
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                images = executor.submit(search_images, driver, query_embedding, 0, top_k_images, folders, nodes)
+                documents, score = search_documents(driver, query_embedding, top_k, folders, nodes)
+                images = [hit for hit in images.result() if hit["similarity"] >= score]
+        else:
+            documents, score = search_documents(driver, query_embedding, top_k, folders, nodes, index)
+            images = search_images(driver, query_embedding, score, top_k_images, folders, nodes, index)
+        documents, images = hydrate_hits(driver, documents, images, store=store)
+        retrieval_span.set(documents=len(documents), images=len(images))
+    return ([hit["text"] for hit in documents], [hit["text"] for hit in images],
+            [{"name": hit["chunk_name"], "folder": hit["folder"], "blob": hit["blob"]} for hit in images])
 
-    
 def retrieve_relevant_documents(driver, query_embedding, top_k=5):
-    lowest_score = 0
-    with driver.session() as session:
-        query = (
-            "MATCH (c:Chunk) "
-            "WHERE c.in_query = true AND c.element <> -1 "
-            "RETURN c.name AS chunk_name, c.element AS element, c.embedding_string AS embedding_string"
-        )
-        result = session.run(query)
-        similarities = []
-        for record in result:
-            chunk_name = record["chunk_name"]
-            element = record["element"]
-            embedding_string = record["embedding_string"]
-
-            # Check if embedding_string is empty or invalid
-            if not embedding_string:
-                print(f"Procedure retrieve_relevant_documents: Skipping chunk {chunk_name} due to empty embedding_string")
-                continue
-
-            # Assuming embedding_string needs to be converted to a list or array
-            try:
-                # embedding = json.loads(embedding_string)  # Uncomment if needed
-                similarity = compute_cosine_similarity(query_embedding, embedding_string)
-                if similarity > 0.5:
-                    similarities.append((chunk_name, element, similarity))
-            except Exception as e:
-                print(f"Procedure retrieve_relevant_documents: Error processing chunk {chunk_name}: {e}")
-                continue
-
-        # Sort by similarity in descending order
-        similarities.sort(key=lambda x: x[2], reverse=True)
-
-        # Select top_k unique combinations of chunk_name and element
-        top_chunks = []
-        seen_combinations = set()
-        for chunk_name, element, similarity in similarities:
-            if (chunk_name, element) not in seen_combinations:
-                top_chunks.append((chunk_name, element, similarity))
-                seen_combinations.add((chunk_name, element))
-            if len(top_chunks) >= top_k:
-                break
-
-        if top_chunks:
-            # Extract the highest score
-            lowest_score = top_chunks[-1][2]   
-
-        # Retrieve the corresponding documents
-        documents = []
-        chunk_names = []
-        for chunk_name, element, similarity in top_chunks:
-            doc_query = (
-                "MATCH (c:Chunk {name: $chunk_name, element: $element}) "
-                "RETURN c.text AS text"
-            )
-            doc_result = session.run(doc_query, chunk_name=chunk_name, element=element)
-            for doc_record in doc_result:
-                if doc_record:
-                    documents.append(doc_record["text"])
-                    chunk_names.append((chunk_name, element))
-        return documents, lowest_score
+    hits, lowest_score = search_documents(driver, query_embedding, top_k)
+    hits, = hydrate_hits(driver, hits)
+    return [hit["text"] for hit in hits], lowest_score
 
 def retrieve_relevant_images(driver, query_embedding, score, top_k=3):
-    with driver.session() as session:
-        query = (
-            "MATCH (c:Chunk) "
-            "WHERE c.in_query = true AND (c.element = -1 OR c.chunk_type = 'image') "
-            "RETURN c.name AS chunk_name, c.element AS element, c.embedding_string AS embedding_string"
-        )
-        result = session.run(query)
-        similarities = []
-        for record in result:
-            chunk_name = record["chunk_name"]
-            element = record["element"]
-            embedding_string = record["embedding_string"]
-
-            # Check if embedding_string is empty or invalid
-            if not embedding_string:
-                print(f"Procedure retrieve_relevant_images: Skipping chunk {chunk_name} due to empty embedding_string")
-                continue
-
-            # Assuming embedding_string needs to be converted to a list or array
-            try:
-                # embedding = json.loads(embedding_string)  # Uncomment if needed
-                similarity = compute_cosine_similarity(query_embedding, embedding_string)
-                similarities.append((chunk_name, element, similarity))
-            except Exception as e:
-                print(f"Procedure retrieve_relevant_images: Error processing chunk {chunk_name}: {e}")
-                continue
-
-        # Sort by similarity in descending order
-        similarities.sort(key=lambda x: x[2], reverse=True)
-
-        # Select top_k unique combinations of chunk_name and element
-        top_chunks = []
-        seen_combinations = set()
-        if score < 0.55:
-            score = 0.55
-        for chunk_name, element, similarity in similarities:
-            if (chunk_name, element) not in seen_combinations and similarity >= score:
-                top_chunks.append((chunk_name, element, similarity))
-                seen_combinations.add((chunk_name, element))
-            if len(top_chunks) >= top_k or similarity < score:
-                break 
-
-        # Retrieve the corresponding documents
-        image_text = []
-        chunk_names = []
-        for chunk_name, element, similarity in top_chunks:
-            doc_query = (
-                "MATCH (c:Chunk {name: $chunk_name, element: $element}) "
-                "RETURN c.text AS text"
-            )
-            doc_result = session.run(doc_query, chunk_name=chunk_name, element=element)
-            for doc_record in doc_result:
-                if doc_record:
-                    image_text.append(doc_record["text"])
-                    chunk_names.append((chunk_name))
-        return image_text, chunk_names
\ No newline at end of file
+    hits, = hydrate_hits(driver, search_images(driver, query_embedding, score, top_k))
+    return [hit["text"] for hit in hits], [hit["chunk_name"] for hit in hits]
@@ -0,0 +1,17 @@
+import os
+import tempfile
+
+# Keep the caches, job queue and index files of the tests out of the working tree.
+# The modules read these settings from keys.py when they are first imported.
+WORK_DIR = tempfile.mkdtemp(prefix="rag-tests-")
+os.environ.update({
+    "RETRIEVAL_BACKEND": "memory",
+    "EMBEDDING_CACHE_PATH": os.path.join(WORK_DIR, "embeddings.sqlite"),
+    "IMAGE_CACHE_DIR": os.path.join(WORK_DIR, "thumbnails"),
+    "ANN_INDEX_DIR": os.path.join(WORK_DIR, "ann"),
+    "JOB_QUEUE_PATH": os.path.join(WORK_DIR, "jobs.sqlite"),
+    "JOB_SPOOL_DIR": os.path.join(WORK_DIR, "spool"),
+    "GCP_BUCKET": "tests",
+    "GCS_LOCAL_ROOT": os.path.join(WORK_DIR, "gcs"),
+    "TELEMETRY_SINKS": "",
+})
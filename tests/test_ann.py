@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+import src.ann
+from src.ann import IvfIndex, HEADER_ROWS
+
+
+def unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def chunk(name, vector, folder="docs", element=1, chunk_type="text"):
+    return (name, element, chunk_type, unit(vector), True, None, folder, None)
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = IvfIndex(directory=str(tmp_path), lists=4, probes=4, train_rows=1000)
+    index._open()
+    return index
+
+
+def test_same_name_in_two_folders_keeps_both_rows(index):
+    index.upsert_many([chunk("report_image_1_0.png", [1, 0, 0], folder="a", element=-1, chunk_type="pdf_image"),
+                       chunk("report_image_1_0.png", [1, 0.1, 0], folder="b", element=-1, chunk_type="pdf_image")])
+    assert len(index) == 2
+    assert [hit[0] for hit in index.search(unit([1, 0, 0]), 5, kind="image", folders=["b"])] == ["b"]
+    assert {hit[0] for hit in index.search(unit([1, 0, 0]), 5, kind="image")} == {"a", "b"}
+
+
+def test_bad_chunks_are_skipped_without_failing_the_batch(index):
+    index.upsert_many([chunk("a.pdf", [1, 0, 0]),
+                       ("broken.pdf", 1, "text", "not an embedding", True, None, "docs", None),
+                       ("short.pdf", 1, "text", unit([1, 0]), True, None, "docs", None),
+                       chunk("b.pdf", [0, 1, 0])])
+    assert len(index) == 2
+    assert [hit[1] for hit in index.search(unit([1, 0.1, 0]), 5)] == ["a.pdf", "b.pdf"]
+
+
+def test_lists_are_trained_outside_the_write(index):
+    index.train_rows = 100
+    rng = np.random.default_rng(0)
+    index.upsert_many([chunk(f"doc_{i}.pdf", vector) for i, vector in enumerate(rng.standard_normal((120, 8)))])
+    # The rows are searchable while the lists are trained in the background
+    assert len(index.search(rng.standard_normal(8), 5)) == 5
+    index._training.join()
+    assert index._centroids is not None
+    assert not index.train()
+    assert len(index.search(rng.standard_normal(8), 5)) == 5
+
+
+def test_rows_beyond_the_mapped_capacity_are_not_scanned(index):
+    index.upsert_many([chunk("a.pdf", [1, 0, 0])])
+    # Another process has added rows and grown the files since this one mapped them
+    index._header[HEADER_ROWS] = index._capacity + 10
+    index._sync()
+    assert index._rows() == index._capacity
+    assert [hit[1] for hit in index.search(unit([1, 0, 0]), 5)] == ["a.pdf"]
+
+def test_rows_written_during_training_are_assigned_to_the_new_lists(index, monkeypatch):
+    rng = np.random.default_rng(0)
+    index.upsert_many([chunk(f"doc_{i}.pdf", vector) for i, vector in enumerate(rng.standard_normal((40, 8)))])
+    train_centroids = src.ann.train_centroids
+
+    def train_while_writing(vectors, lists):
+        # Another writer appends one row and replaces another while the centroids are computed
+        index.upsert_many([chunk("late.pdf", rng.standard_normal(8)), chunk("doc_0.pdf", rng.standard_normal(8))])
+        return train_centroids(vectors, lists)
+
+    monkeypatch.setattr(src.ann, "train_centroids", train_while_writing)
+    assert index.train(force=True)
+    rows = index._rows()
+    assert rows == 41
+    expected = src.ann.nearest_centroids(index._vectors[:rows], index._centroids)
+    assert np.array_equal(index._lists[:rows], expected)
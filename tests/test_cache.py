@@ -0,0 +1,79 @@
+import os
+import subprocess
+import sys
+import numpy as np
+from src.cache import AnswerCache, EmbeddingCache
+
+
+def vector(seed, dimensions=768):
+    return np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32).tolist()
+
+
+def test_hits_and_misses(tmp_path):
+    cache = EmbeddingCache(path=str(tmp_path / "embeddings.sqlite"))
+    assert cache.get_many("model", ["a", "b"]) == [None, None]
+    cache.put_many("model", ["a"], [vector(0)])
+    assert cache.get_many("model", ["a", "b"]) == [vector(0), None]
+    assert cache.get_many("other-model", ["a"]) == [None]
+    stats = cache.stats()
+    assert (stats["memory_hits"], stats["disk_hits"], stats["misses"]) == (1, 0, 4)
+
+
+def test_disk_tier_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite")
+    EmbeddingCache(path=path).put_many("model", ["a"], [vector(0)])
+    cache = EmbeddingCache(path=path)
+    assert cache.get_many("model", ["a"]) == [vector(0)]
+    assert cache.stats()["disk_hits"] == 1
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = EmbeddingCache(path=str(tmp_path / "embeddings.sqlite"), max_memory_items=0, max_disk_bytes=256 * 1024)
+    texts = [f"text {i}" for i in range(200)]
+    for i, text in enumerate(texts):
+        cache.put_many("model", [text], [vector(i)])
+        if i == 0:
+            # Keep the first entry in use, so the entries written after it are older
+            continue
+        cache.get_many("model", [texts[0]])
+    assert cache.stats()["disk_bytes"] <= 256 * 1024
+    found = cache.get_many("model", texts)
+    assert found[0] == vector(0)
+    assert found[1] is None
+    assert found[-1] == vector(199)
+
+
+def test_disk_errors_count_as_misses(tmp_path):
+    cache = EmbeddingCache(path=str(tmp_path / "embeddings.sqlite"), max_memory_items=0)
+    cache.put_many("model", ["a"], [vector(0)])
+    cache._connection.execute("DROP TABLE embeddings")
+    assert cache.get_many("model", ["a"]) == [None]
+    cache.put_many("model", ["b"], [vector(1)])
+
+
+def test_answer_cache_matches_similar_questions():
+    cache = AnswerCache(threshold=0.95)
+    cache.put([1.0, 0.0], "answer", [], {"temperature": 0.1})
+    assert cache.get([1.0, 0.01], {"temperature": 0.1}) == ("answer", [])
+    assert cache.get([0.0, 1.0], {"temperature": 0.1}) is None
+    assert cache.get([1.0, 0.0], {"temperature": 0.5}) is None
+    assert cache.get([1.0, 0.0], {"temperature": 0.1}, scope={"folders": ["a"]}) is None
+
+
+def test_answer_cache_keys_on_the_conversation_history():
+    # "What about last year?" means different things after different conversations
+    cache = AnswerCache(threshold=0.95)
+    first = [{"role": "user", "text": "What was the revenue of A?"}, {"role": "model", "text": "10 M"}]
+    second = [{"role": "user", "text": "What was the revenue of B?"}, {"role": "model", "text": "20 M"}]
+    cache.put([1.0, 0.0], "answer about A", [], history=first)
+    assert cache.get([1.0, 0.0], history=first) == ("answer about A", [])
+    assert cache.get([1.0, 0.0], history=second) is None
+    assert cache.get([1.0, 0.0]) is None
+
+
+def test_importing_does_not_create_the_cache_files(tmp_path):
+    env = {**os.environ, "EMBEDDING_CACHE_PATH": str(tmp_path / "cache" / "embeddings.sqlite"),
+           "IMAGE_CACHE_DIR": str(tmp_path / "cache" / "thumbnails")}
+    subprocess.run([sys.executable, "-c", "import src.cache, src.utils, src.thumbnails"], env=env, check=True,
+                   cwd=os.path.dirname(os.path.dirname(__file__)))
+    assert not os.path.exists(tmp_path / "cache")
@@ -0,0 +1,50 @@
+from neo4j.exceptions import ConstraintError
+from src.graphdb import generate_unique_chunk_name
+
+
+class FakeSession:
+    """Session whose allocation transactions return the given outcomes in turn."""
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute_write(self, function, *args):
+        self.calls.append(args)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class FakeDriver:
+    def __init__(self, session):
+        self._session = session
+
+    def session(self):
+        return self._session
+
+
+def test_allocates_the_returned_name():
+    session = FakeSession(["report.pdf"])
+    assert generate_unique_chunk_name(FakeDriver(session), "report", ".pdf") == "report.pdf"
+    assert session.calls == [("report.pdf", "report_", ".pdf", 16)]
+
+
+def test_retries_when_a_concurrent_allocation_took_the_name():
+    # A concurrent upload registered the same ChunkName first, so the constraint rejects the write
+    session = FakeSession([ConstraintError("ChunkName already exists"), ConstraintError("ChunkName already exists"), "report_2.pdf"])
+    assert generate_unique_chunk_name(FakeDriver(session), "report", ".pdf") == "report_2.pdf"
+    assert len(session.calls) == 3
+
+
+def test_retries_when_the_window_is_full():
+    # No free suffix in the checked window returns None and the next window is tried
+    session = FakeSession([None, "report_17.pdf"])
+    assert generate_unique_chunk_name(FakeDriver(session), "report", ".pdf", window=16) == "report_17.pdf"
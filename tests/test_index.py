@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+from src.index import EmbeddingIndex
+
+
+def unit(*values):
+    vector = np.array(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_upsert_replaces_the_row_of_the_same_chunk():
+    index = EmbeddingIndex(mode="float32")
+    first = index.upsert("report.pdf", 1, "text", unit(1, 0, 0), folder="a")
+    second = index.upsert("report.pdf", 1, "text", unit(0, 1, 0), folder="a")
+    assert first == second
+    assert len(index) == 1
+    assert index.search(unit(0, 1, 0), 1) == [("a", "report.pdf", 1, pytest.approx(1.0))]
+
+
+def test_same_name_in_two_folders_keeps_both_rows():
+    # PDF images get the same name when the same file is uploaded to two folders
+    index = EmbeddingIndex(mode="float32")
+    index.upsert("report_image_1_0.png", -1, "pdf_image", unit(1, 0, 0), folder="a", document="report.pdf")
+    index.upsert("report_image_1_0.png", -1, "pdf_image", unit(1, 0.1, 0), folder="b", document="report.pdf")
+    assert len(index) == 2
+    assert [hit[0] for hit in index.search(unit(1, 0, 0), 5, kind="image", folders=["a"])] == ["a"]
+    assert [hit[0] for hit in index.search(unit(1, 0, 0), 5, kind="image", folders=["b"])] == ["b"]
+    assert {hit[0] for hit in index.search(unit(1, 0, 0), 5, kind="image")} == {"a", "b"}
+
+
+def test_search_by_folder_and_kind():
+    index = EmbeddingIndex(mode="float32")
+    index.upsert("a.pdf", 1, "text", unit(1, 0, 0), folder="a")
+    index.upsert("b.pdf", 1, "text", unit(1, 0.2, 0), folder="b")
+    index.upsert("b.png", -1, "image", unit(1, 0, 0.1), folder="b")
+    assert [hit[:3] for hit in index.search(unit(1, 0, 0), 5)] == [("a", "a.pdf", 1), ("b", "b.pdf", 1)]
+    assert [hit[:3] for hit in index.search(unit(1, 0, 0), 5, folders=["b"])] == [("b", "b.pdf", 1)]
+    assert [hit[:3] for hit in index.search(unit(1, 0, 0), 5, kind="image", folders=["a"])] == []
+    assert [hit[:3] for hit in index.search(unit(1, 0, 0), 5, kind="image", folders=["b"])] == [("b", "b.png", -1)]
+
+
+def test_switched_off_node_leaves_retrieval():
+    index = EmbeddingIndex(mode="float32")
+    index.upsert("a.pdf", 1, "text", unit(1, 0, 0), folder="a")
+    index.upsert("b.pdf", 1, "text", unit(1, 0.2, 0), folder="b")
+    index.link_node("a", "a.pdf", "Finance")
+    index.set_node_in_query("Finance", False)
+    assert [hit[:3] for hit in index.search(unit(1, 0, 0), 5)] == [("b", "b.pdf", 1)]
+    index.set_node_in_query("Finance", True)
+    assert [hit[0] for hit in index.search(unit(1, 0, 0), 5, nodes=["Finance"])] == ["a"]
+
+
+def test_rejects_embeddings_of_another_dimension():
+    index = EmbeddingIndex(mode="float32")
+    index.upsert("a.pdf", 1, "text", unit(1, 0, 0), folder="a")
+    with pytest.raises(ValueError):
+        index.upsert("b.pdf", 1, "text", unit(1, 0), folder="a")
+
+
+def test_hits_are_hydrated_by_folder():
+    from src import utils
+    index = EmbeddingIndex(mode="float32")
+    index.upsert("report_image_1_1.png", -1, "pdf_image", unit(1, 0, 0), folder="a", document="report.pdf")
+    index.upsert("report_image_1_1.png", -1, "pdf_image", unit(1, 0.1, 0), folder="b", document="report.pdf")
+    stored = {(folder, "report_image_1_1.png", -1): {"text": f"Image in {folder}", "folder": folder, "chunk_type": "pdf_image",
+                                                   "blob": f"{folder}/report_image_1_1.png"} for folder in ("a", "b")}
+    requested = []
+
+    class Store:
+        def get_chunks(self, driver, chunks):
+            requested.extend(chunks)
+            return {key: value for key, value in stored.items() if {"folder": key[0], "name": key[1], "element": key[2]} in chunks}
+
+    hits, = utils.hydrate_hits(None, utils.search_images(None, unit(1, 0, 0), 0.6, folders=["b"], index=index), store=Store())
+    assert [hit["text"] for hit in hits] == ["Image in b"]
+    assert requested == [{"folder": "b", "name": "report_image_1_1.png", "element": -1}]
+
+
+# Sign bits lose more of the ordering, so the binary mode rescores a longer shortlist
+@pytest.mark.parametrize("mode, candidates, tolerance", [("int8", 50, 0.98), ("binary", 200, 0.95)])
+def test_quantized_modes_recall_the_exact_top_5(mode, candidates, tolerance):
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((20, 256))
+    points = centers[rng.integers(0, 20, size=2000)] + 0.4 * rng.standard_normal((2000, 256))
+    vectors = {("docs", f"doc_{i}.pdf", 1): unit(*point) for i, point in enumerate(points)}
+    exact = EmbeddingIndex(mode="float32")
+    quantized = EmbeddingIndex(mode=mode, rescore_candidates=candidates, fetch_embeddings=lambda keys: {key: vectors[key] for key in keys})
+    for (folder, name, element), vector in vectors.items():
+        exact.upsert(name, element, "text", vector, folder=folder)
+        quantized.upsert(name, element, "text", vector, folder=folder)
+    queries = [unit(*point) for point in points[:100] + 0.2 * rng.standard_normal((100, 256))]
+    recall = np.mean([len({hit[:3] for hit in exact.search(query, 5)} & {hit[:3] for hit in quantized.search(query, 5)}) / 5
+                      for query in queries])
+    assert recall >= tolerance
+    # Rescored hits carry the exact similarity
+    hit = quantized.search(queries[0], 1)[0]
+    assert hit[3] == pytest.approx(float(vectors[hit[:3]] @ queries[0]), abs=1e-5)
@@ -0,0 +1,62 @@
+import fitz
+import pytest
+from google.api_core.exceptions import ServiceUnavailable
+from benchmarks.fakes import FakeEmbeddingModel, FakeGenerativeModel, InMemoryGraph
+from src import ingestion, resources
+from src.documents import content_hash
+from src.gcputils import upload_file_to_folder
+
+
+class FailingModel(FakeGenerativeModel):
+    """Raises the given error for every image description."""
+
+    def __init__(self, error):
+        super().__init__()
+        self.error = error
+
+    def generate_content(self, prompt, generation_config=None, stream=False):
+        raise self.error
+
+
+def make_pdf():
+    document = fitz.open()
+    for page_number in range(2):
+        page = document.new_page()
+        page.insert_text((72, 72), f"Page {page_number + 1} of the report", fontsize=12)
+    pixmap = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 16, 16), False)
+    pixmap.clear_with(128)
+    document[0].insert_image(fitz.Rect(72, 100, 136, 164), stream=pixmap.tobytes("png"))
+    data = document.tobytes()
+    document.close()
+    return data
+
+
+def upload_pdf(folder):
+    resources.set_embedding_model(FakeEmbeddingModel(dimensions=8))
+    graph = InMemoryGraph()
+    data = make_pdf()
+    upload_file_to_folder(ingestion.GCP_BUCKET, folder, data, "report.pdf", "string")
+    graph.create_and_return_chunk(graph, "report.pdf", folder, "uploaded", content_hash=content_hash(data), blob=f"{folder}/report.pdf")
+    return graph, data
+
+
+def test_undescribable_image_is_skipped_and_pages_are_embedded():
+    graph, data = upload_pdf("skipped")
+    ingestion.ingest_file(graph, FailingModel(ValueError("Response was blocked")), {}, "skipped", "report", ".pdf", "report.pdf",
+                          file_bytes=data, store=graph)
+    images = [chunk for (folder, name, element), chunk in graph.chunks.items() if element == -1]
+    pages = [chunk for (folder, name, element), chunk in graph.chunks.items() if element >= 0]
+    assert [(image["status"], image["text"]) for image in images] == [("skipped", "")]
+    assert len(pages) == 2 and all(page["status"] == "linked" and page.get("embedding_string") for page in pages)
+
+
+def test_transient_description_error_is_retried():
+    graph, data = upload_pdf("transient")
+    with pytest.raises(RuntimeError):
+        ingestion.ingest_file(graph, FailingModel(ServiceUnavailable("Try again")), {}, "transient", "report", ".pdf", "report.pdf",
+                              file_bytes=data, store=graph)
+    assert [chunk["status"] for (folder, name, element), chunk in graph.chunks.items() if element == -1] == ["uploaded"]
+    # The next run describes the image and finishes the document
+    ingestion.ingest_file(graph, FakeGenerativeModel(), {}, "transient", "report", ".pdf", "report.pdf", file_bytes=data, store=graph)
+    assert [chunk["status"] for (folder, name, element), chunk in graph.chunks.items() if element == -1] == ["linked"]
+    assert graph.chunks[("transient", "report.pdf", 0)]["status"] == "linked"
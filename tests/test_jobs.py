@@ -0,0 +1,57 @@
+import time
+from src.jobs import JobQueue, run_job
+
+
+def enqueue(queue, name="report"):
+    return queue.enqueue("batch", "folder", name, ".pdf", f"{name}.pdf", {})
+
+
+def test_claim_leases_the_oldest_job(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite"), lease_seconds=60)
+    first, second = enqueue(queue, "a"), enqueue(queue, "b")
+    assert queue.claim(1)["id"] == first
+    assert queue.claim(2)["id"] == second
+    assert queue.claim(3) is None
+
+
+def test_live_lease_is_not_requeued(tmp_path):
+    # Another app process must not take over a job whose worker is still renewing its lease
+    queue = JobQueue(str(tmp_path / "jobs.sqlite"), lease_seconds=60)
+    job_id = enqueue(queue)
+    queue.claim(1)
+    assert queue.requeue_expired() == 0
+    assert queue.claim(2) is None
+    assert queue.batch_jobs("batch")[0]["status"] == "running"
+    assert queue.renew_lease(job_id, 1)
+    assert not queue.renew_lease(job_id, 2)
+
+
+def test_expired_lease_is_requeued(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite"), lease_seconds=0.05)
+    job_id = enqueue(queue)
+    queue.claim(1)
+    time.sleep(0.1)
+    assert queue.requeue_expired() == 1
+    job = queue.claim(2)
+    assert job["id"] == job_id
+    assert queue.batch_jobs("batch")[0]["worker"] == 2
+
+
+def test_expired_lease_can_be_claimed_directly(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite"), lease_seconds=0.05)
+    job_id = enqueue(queue)
+    queue.claim(1)
+    time.sleep(0.1)
+    assert queue.claim(2)["id"] == job_id
+    assert not queue.renew_lease(job_id, 1)
+
+
+def test_missing_spool_file_fails_the_job(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite"), lease_seconds=60)
+    queue.enqueue("batch", "folder", "report", ".pdf", "report.pdf", {}, file_bytes=b"%PDF")
+    job = queue.claim(1)
+    job["spool_path"] = str(tmp_path / "missing.pdf")
+    run_job(queue, job, None, None, worker=1)
+    job = queue.batch_jobs("batch")[0]
+    assert job["status"] == "failed"
+    assert "missing.pdf" in job["error"]
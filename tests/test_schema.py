@@ -0,0 +1,16 @@
+import os
+import re
+import subprocess
+import sys
+from src.schema import HOT_QUERIES
+
+
+def test_hot_queries_have_every_parameter():
+    for name, (query, parameters) in HOT_QUERIES.items():
+        assert set(re.findall(r"\$(\w+)", query)) == set(parameters), name
+
+
+def test_importing_the_app_modules_does_not_load_neo4j():
+    code = ("import sys; import src.schema, src.graphdb, src.utils, src.ingestion; "
+            "sys.exit(any(name.split('.')[0] == 'neo4j' for name in sys.modules))")
+    assert subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(__file__))).returncode == 0
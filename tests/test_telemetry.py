@@ -0,0 +1,27 @@
+import os
+from src.telemetry import Metrics, PrometheusFileSink
+
+
+def read_metrics(tmp_path, metrics):
+    PrometheusFileSink(directory=str(tmp_path)).flush(metrics)
+    with open(os.path.join(str(tmp_path), f"rag_{os.getpid()}.prom")) as f:
+        return f.read().splitlines()
+
+
+def test_every_metric_has_one_type_line(tmp_path):
+    metrics = Metrics()
+    metrics.add("cache.hits", 2, {"cache": "embedding"})
+    metrics.add("cache.hits", 1, {"cache": "answer"})
+    metrics.observe("retrieval", 0.02)
+    lines = read_metrics(tmp_path, metrics)
+    assert lines.count("# TYPE rag_cache_hits_total counter") == 1
+    assert lines.count("# TYPE rag_retrieval_seconds histogram") == 1
+    assert lines.index("# TYPE rag_cache_hits_total counter") < lines.index(next(line for line in lines if line.startswith("rag_cache_hits_total")))
+    assert f'rag_retrieval_seconds_bucket{{le="0.025",pid="{os.getpid()}"}} 1' in lines
+
+
+def test_label_values_are_escaped(tmp_path):
+    metrics = Metrics()
+    metrics.add("errors", 1, {"message": 'path C:\\tmp "quoted"\nnext line'})
+    lines = read_metrics(tmp_path, metrics)
+    assert f'rag_errors_total{{message="path C:\\\\tmp \\"quoted\\"\\nnext line",pid="{os.getpid()}"}} 1' in lines